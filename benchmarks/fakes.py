@@ -0,0 +1,322 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import discord
+from audio.track import Track, TrackInfo
+from bot import Bot
+from common.config import ConfigMap
+from common.config_store import ConfigStore
+from stubs import video_id
+
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+OPUS_SILENCE = b"\xf8\xff\xfe"
+PIPE_BLOCKSIZE = 8192
+
+
+class StubExtractor:
+    """Answers yt-dlp extractions with urls of the stub server after a latency."""
+
+    def __init__(self, base_url: str, latency: float, audio_file: str = None):
+        self.base_url = base_url
+        self.latency = latency
+        self.audio_file = audio_file
+
+    def extract_info(
+        self, opts: Dict[str, Any], url: str, download: bool
+    ) -> Dict[str, Any]:
+        time.sleep(self.latency)
+        if url.startswith("ytsearch"):
+            query = url.split(":", 1)[1]
+            return {"entries": [{"id": video_id(query), "title": f"Video {query}"}]}
+
+        query = parse_qs(urlparse(url).query)
+        if "list" in query and "v" not in query:
+            playlist = query["list"][0]
+            return {
+                "entries": [
+                    {"id": video_id(f"{playlist}-{i}"), "title": f"Video {i}"}
+                    for i in range(opts.get("playlistend") or 5)
+                ]
+            }
+
+        id = query["v"][0] if "v" in query else video_id(url)
+        return {
+            "id": id,
+            "url": f"{self.base_url}/audio/{id}",
+            "acodec": "opus",
+            "filename": self.audio_file,
+        }
+
+
+class StubExecutor(ThreadPoolExecutor):
+    """Runs the stub instead of yt-dlp for everything the ExtractionEngine submits.
+    The engine itself, with its guild limits and bookkeeping, stays untouched.
+    """
+
+    def __init__(self, extractor: StubExtractor, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix="ytdl")
+        self.extractor = extractor
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(self.extractor.extract_info, *args, **kwargs)
+
+
+class FakeOpusSource(discord.AudioSource):
+    """Plays silence for duration seconds instead of running FFmpeg.
+    Sources that would be piped into FFmpeg are drained like FFmpeg would.
+    """
+
+    def __init__(self, duration: float, pipe=None):
+        self.remaining = int(duration / FRAME_LENGTH)
+        self.pipe = pipe
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self.pipe is not None and self.pipe.read(PIPE_BLOCKSIZE) == b"":
+            self.pipe = None
+        if self.remaining <= 0:
+            return b""
+        self.remaining -= 1
+        return OPUS_SILENCE
+
+
+def fake_player(duration: float) -> Callable:
+    """Returns a replacement of Track._spawn_player that builds FakeOpusSources."""
+
+    async def spawn_player(
+        self: Track, track_info: TrackInfo, start: float = 0
+    ) -> discord.AudioSource:
+        return FakeOpusSource(max(duration - start, 0), track_info.source)
+
+    return spawn_player
+
+
+@dataclass
+class Playback:
+    started: float
+    first_frame: Optional[float] = None
+    finished: Optional[float] = None
+    frames: int = 0
+    late_frames: int = 0
+    error: Optional[Exception] = None
+
+
+class FakeVoiceClient:
+    """Stands in for discord.VoiceClient. Reads a frame of the source every 20ms on a
+    thread like the AudioPlayer of discord.py, but does not send it anywhere.
+    PCM sources are encoded to opus like they would be before sending.
+    """
+
+    def __init__(self, guild: "FakeGuild", loop: asyncio.AbstractEventLoop):
+        self.guild = guild
+        self.loop = loop
+        self.source: Optional[discord.AudioSource] = None
+        self.playbacks: List[Playback] = []
+        self._playing = False
+        self._paused = threading.Event()
+        self._stopped = threading.Event()
+        self._changed = asyncio.Event()
+        self._encoder = None
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        return self._playing and not self._paused.is_set()
+
+    def is_paused(self) -> bool:
+        return self._playing and self._paused.is_set()
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self):
+        self._paused.clear()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+
+    async def move_to(self, channel):
+        pass
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self._playing:
+            raise discord.ClientException("Already playing audio.")
+
+        playback = Playback(time.monotonic())
+        self.playbacks.append(playback)
+        self.source = source
+        self._playing = True
+        self._stopped = threading.Event()
+        threading.Thread(
+            target=self._run,
+            args=(source, playback, after, self._stopped),
+            name=f"voice-{self.guild.id}",
+            daemon=True,
+        ).start()
+
+    def _encode(self, source: discord.AudioSource, data: bytes):
+        if source.is_opus():
+            return
+        if self._encoder is None:
+            self._encoder = discord.opus.Encoder()
+        self._encoder.encode(data, self._encoder.SAMPLES_PER_FRAME)
+
+    def _run(self, source, playback: Playback, after, stopped: threading.Event):
+        start = None
+        try:
+            while not stopped.is_set():
+                if self._paused.is_set():
+                    time.sleep(FRAME_LENGTH)
+                    start = None
+                    continue
+
+                data = source.read()
+                if not data:
+                    break
+                self._encode(source, data)
+
+                now = time.perf_counter()
+                if playback.frames == 0:
+                    playback.first_frame = time.monotonic()
+                    self.notify()
+                if start is None:
+                    start, sent = now, 0
+                elif now > start + (sent + 1) * FRAME_LENGTH:
+                    # the frame was not ready when it should have been sent
+                    playback.late_frames += 1
+                playback.frames += 1
+                sent += 1
+                time.sleep(max(0, start + sent * FRAME_LENGTH - time.perf_counter()))
+        except Exception as e:
+            playback.error = e
+        finally:
+            self._playing = False
+            playback.finished = time.monotonic()
+            if after is not None:
+                after(playback.error)
+            source.cleanup()
+            self.notify()
+
+    def notify(self):
+        """Wake up wait_until. Can be called from any thread."""
+        self.loop.call_soon_threadsafe(self._changed.set)
+
+    async def wait_until(self, predicate: Callable[[], bool], timeout: float):
+        """Wait until predicate is true. It is checked whenever notify is called."""
+
+        async def wait():
+            while not predicate():
+                self._changed.clear()
+                await self._changed.wait()
+
+        await asyncio.wait_for(wait(), timeout)
+
+
+class FakeGuild:
+    def __init__(self, id: int, loop: asyncio.AbstractEventLoop):
+        self.id = id
+        self.name = f"Guild {id}"
+        self.voice_client = FakeVoiceClient(self, loop)
+
+
+class FakeAuthor:
+    id = 1
+    name = "benchmark"
+    display_name = "benchmark"
+    avatar = None
+    voice = None
+
+
+class FakeMessage:
+    def __init__(self, guild: FakeGuild, content: str):
+        self.guild = guild
+        self.content = content
+        self.author = FakeAuthor()
+        self.embeds = []
+        self.attachments = []
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class _Typing:
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeContext:
+    """Stands in for the Context of a command. Replies are recorded instead of sent."""
+
+    prefix = "!"
+    command = None
+
+    def __init__(self, guild: FakeGuild, content: str = ""):
+        self.guild = guild
+        self.message = FakeMessage(guild, content)
+        self.author = self.message.author
+        self.replies: List[str] = []
+        self.errors: List[str] = []
+
+    @property
+    def voice_client(self) -> FakeVoiceClient:
+        return self.guild.voice_client
+
+    def typing(self):
+        return _Typing()
+
+    async def send(self, content=None, **kwargs):
+        self.replies.append(content if content is not None else kwargs.get("embed"))
+
+    async def reply(self, content=None, **kwargs):
+        await self.send(content, **kwargs)
+
+    async def tick(self, value):
+        pass
+
+    async def reply_formatted_msg(self, msg, title=None, thumbnail_url=None):
+        self.replies.append(msg)
+
+    async def reply_formatted_error(
+        self, error_msg, error_title=None, thumbnail_url=None
+    ):
+        self.errors.append(str(error_msg))
+        self.voice_client.notify()
+
+
+class BenchBot(Bot):
+    """Bot that never connects to Discord. Its guilds only exist in the benchmark."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, dir: str):
+        super().__init__(
+            command_prefix="!",
+            description="Benchmark",
+            configstore=ConfigStore(),
+            configmap=ConfigMap([]),
+            dir=dir,
+        )
+        self.loop = loop
+        self.fake_guilds: Dict[int, FakeGuild] = {}
+
+    def add_fake_guild(self, id: int) -> FakeGuild:
+        self.fake_guilds[id] = FakeGuild(id, self.loop)
+        return self.fake_guilds[id]
+
+    def get_guild(self, id: int) -> Optional[FakeGuild]:
+        return self.fake_guilds.get(id)
+
+    async def join_author(self, ctx):
+        pass
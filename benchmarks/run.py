@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+"""Offline benchmark of the audio pipeline of the bot.
+
+The real Music and TextToSpeech cogs, TrackQueue, QueueRunner and services are wired
+like in Bot.setup_hook, but the YouTube Data API, Spotify, Polly and the audio streams
+are answered by a local stub server with configurable latency and yt-dlp is replaced
+by a stub. Every simulated guild has a fake voice client that consumes the frames of
+the player in real time. FFmpeg is used if it is installed, otherwise a fake player.
+
+    python benchmarks/run.py --guilds 20 --tracks 3 --json results.json
+    python benchmarks/run.py --baseline results.json  # exits with 1 on regressions
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "discordbot"))
+
+import boto3
+import spotipy
+from audio import (
+    PLAYBACK_MODE_WORKER,
+    EncoderPool,
+    ExtractionEngine,
+    LinksService,
+    QueueRunner,
+    SpotifyService,
+    TextToSpeechService,
+    Track,
+    TrackQueue,
+    YoutubeApiClient,
+    YoutubeService,
+)
+from audio.youtube.service import YOUTUBE_VIDEO_BASE_URL
+from cogs import Music, TextToSpeech
+from common.cache import TTLCache
+from common.ffmpeg import FFmpegProcessManager
+from common.latency import LatencyStats
+from common.single_flight import SingleFlight
+from fakes import (
+    FRAME_LENGTH,
+    BenchBot,
+    FakeContext,
+    FakeGuild,
+    StubExecutor,
+    StubExtractor,
+    fake_player,
+)
+from googleapiclient.discovery import build
+from stubs import DEFAULT_LATENCY, StubServer, parse_latency, video_id
+
+SCENARIOS = ["youtube", "search", "spotify", "tts"]
+SAMPLE_WINDOW = 1_000_000
+MB = 1024 * 1024
+
+# a regression must exceed the baseline by the tolerance and by this absolute amount
+REGRESSION_SLACK = {
+    "first_frame_p95": 0.05,
+    "gap_p95": 0.05,
+    "late_frame_ratio": 0.01,
+    "cpu_per_stream": 0.005,
+    "rss_growth_mb": 5,
+}
+
+log = logging.getLogger("benchmark")
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_times():
+    """Returns the CPU time of this process and of its terminated children, like FFmpeg."""
+    times = os.times()
+    return times.user + times.system, times.children_user + times.children_system
+
+
+def generate_audio(dir: str, duration: float) -> Dict[str, str]:
+    """Generates a track like the opus streams of YouTube and speech like the mp3 of Polly."""
+    files = {
+        "audio": os.path.join(dir, "track.ogg"),
+        "speech": os.path.join(dir, "speech.mp3"),
+    }
+    for name, codec in [("audio", "libopus"), ("speech", "libmp3lame")]:
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-v",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                f"sine=frequency=440:duration={duration}",
+                "-c:a",
+                codec,
+                files[name],
+            ],
+            check=True,
+        )
+    return files
+
+
+class ScenarioResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.first_frame = LatencyStats(window=SAMPLE_WINDOW)
+        self.gaps = LatencyStats(window=SAMPLE_WINDOW)
+        self.commands = 0
+        self.plays = 0
+        self.frames = 0
+        self.late_frames = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.children_cpu_seconds = 0.0
+        self.errors: List[str] = []
+
+    @property
+    def audio_seconds(self) -> float:
+        return self.frames * FRAME_LENGTH
+
+    def to_dict(self) -> Dict[str, Any]:
+        audio_seconds = self.audio_seconds
+        return {
+            "commands": self.commands,
+            "plays": self.plays,
+            "errors": len(self.errors),
+            "first_frame": self.first_frame.stats(),
+            "first_frame_p95": self.first_frame.percentile(0.95),
+            "gap": self.gaps.stats(),
+            "gap_p95": self.gaps.percentile(0.95),
+            "late_frame_ratio": self.late_frames / self.frames if self.frames else 0.0,
+            # concurrent streams that were played in real time on average
+            "streams": audio_seconds / self.wall_seconds if self.wall_seconds else 0.0,
+            "cpu_seconds": self.cpu_seconds,
+            "children_cpu_seconds": self.children_cpu_seconds,
+            # CPU seconds per second of audio, i. e. the share of a core per stream
+            "cpu_per_stream": (self.cpu_seconds + self.children_cpu_seconds)
+            / audio_seconds
+            if audio_seconds
+            else 0.0,
+        }
+
+
+class Harness:
+    def __init__(self, args: argparse.Namespace, server: StubServer, dir: str):
+        self.args = args
+        self.server = server
+        self.dir = dir
+        self.guilds: List[FakeGuild] = []
+        self.timeout = args.timeout or args.tracks * (args.duration + 10) + 30
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        args = self.args
+
+        self.bot = BenchBot(loop, os.path.join(self.dir, "uploads"))
+        self.bot.queue = TrackQueue(50, loop)
+        self.bot.runner = QueueRunner(
+            self.bot,
+            self.bot.queue,
+            loop,
+            prefetch_count=args.prefetch,
+            prefetch_player=args.prefetch_player,
+        )
+
+        self.extractor = ExtractionEngine(max_workers=args.extractor_workers)
+        self.extractor.executor.shutdown()
+        self.extractor.executor = StubExecutor(
+            StubExtractor(
+                self.server.base_url,
+                self.server.latency["ytdl"],
+                self.server.audio_file,
+            ),
+            args.extractor_workers,
+        )
+
+        flight = SingleFlight()
+        self.youtube = YoutubeService(
+            build(
+                "youtube",
+                "v3",
+                developerKey="benchmark",
+                client_options={"api_endpoint": self.server.base_url + "/"},
+                static_discovery=True,
+            ),
+            extractor=self.extractor,
+            url_cache=TTLCache(maxsize=2048),
+            api=YoutubeApiClient(),
+            flight=flight,
+        )
+        self.spotify = SpotifyService(spotipy.Spotify(auth="benchmark"), flight=flight)
+        self.spotify.service.prefix = self.server.base_url + "/v1/"
+        self.links = LinksService(flight=flight)
+        self.music = Music(self.bot, self.youtube, self.spotify, self.links)
+        await self.bot.add_cog(self.music)
+
+        self.speech = TextToSpeechService(
+            boto3.client(
+                "polly",
+                endpoint_url=self.server.base_url,
+                region_name="eu-central-1",
+                aws_access_key_id="benchmark",
+                aws_secret_access_key="benchmark",
+            ),
+            dir=os.path.join(self.dir, "polly"),
+        )
+        self.tts = TextToSpeech(self.bot, self.speech)
+        await self.bot.add_cog(self.tts)
+
+        for id in range(1, args.guilds + 1):
+            self.guilds.append(self.bot.add_fake_guild(id))
+
+    async def stop(self):
+        for guild in self.guilds:
+            guild.voice_client.stop()
+            self.bot.runner.remove(guild.id)
+        self.extractor.shutdown()
+        self.youtube.api.shutdown()
+        self.spotify.shutdown()
+        self.links.shutdown()
+        self.speech.shutdown()
+
+    def key(self, guild: FakeGuild, round: int, i: int = 0) -> str:
+        """Identifies what is requested. Guilds request the same content if --shared is set."""
+        if self.args.shared:
+            return f"r{round}t{i}"
+        return f"r{round}g{guild.id}t{i}"
+
+    async def command(
+        self, result: ScenarioResult, guild: FakeGuild, command, plays: int, **kwargs
+    ):
+        """Invokes command and waits until plays entries were played."""
+        ctx = FakeContext(guild)
+        voice_client = guild.voice_client
+        first = len(voice_client.playbacks)
+
+        def started() -> bool:
+            return (
+                len(voice_client.playbacks) > first
+                and voice_client.playbacks[first].first_frame is not None
+            )
+
+        def finished() -> bool:
+            return len(voice_client.playbacks) >= first + plays and all(
+                p.finished is not None for p in voice_client.playbacks[first:]
+            )
+
+        result.commands += 1
+        start = time.monotonic()
+        try:
+            await command(ctx, **kwargs)
+            await voice_client.wait_until(
+                lambda: started() or len(ctx.errors) > 0, self.timeout
+            )
+            if started():
+                result.first_frame.record(
+                    voice_client.playbacks[first].first_frame - start
+                )
+            await voice_client.wait_until(
+                lambda: finished() or len(ctx.errors) > 0, self.timeout
+            )
+        except asyncio.TimeoutError:
+            result.errors.append(f"{guild.id}: timed out")
+        result.errors.extend(f"{guild.id}: {e}" for e in ctx.errors)
+
+        playbacks = [p for p in voice_client.playbacks[first:] if p.finished]
+        for previous, playback in zip(playbacks, playbacks[1:]):
+            if playback.first_frame is not None:
+                result.gaps.record(playback.first_frame - previous.finished)
+        for playback in playbacks:
+            result.plays += 1
+            result.frames += playback.frames
+            result.late_frames += playback.late_frames
+            if playback.error is not None:
+                result.errors.append(f"{guild.id}: {playback.error}")
+
+    async def youtube_scenario(self, result, guild, round):
+        for i in range(self.args.tracks):
+            url = YOUTUBE_VIDEO_BASE_URL + video_id(self.key(guild, round, i))
+            await self.command(result, guild, self.music.stream, 1, query_or_url=url)
+
+    async def search_scenario(self, result, guild, round):
+        for i in range(self.args.tracks):
+            query = f"artist {self.key(guild, round, i)} - song"
+            await self.command(result, guild, self.music.stream, 1, query_or_url=query)
+
+    async def spotify_scenario(self, result, guild, round):
+        playlist = f"{self.key(guild, round)}n{self.args.tracks}"
+        url = f"https://open.spotify.com/playlist/{playlist}?si=benchmark"
+        await self.command(
+            result, guild, self.music.stream, self.args.tracks, query_or_url=url
+        )
+
+    async def tts_scenario(self, result, guild, round):
+        for i in range(self.args.tracks):
+            key = self.key(guild, round, i)
+            message = " ".join(
+                f"This is sentence {j} of the message {key}."
+                for j in range(self.args.sentences)
+            )
+            await self.command(result, guild, self.tts.say, 1, message=message)
+
+    async def run(self, name: str, result: ScenarioResult, round: int):
+        scenario = getattr(self, f"{name}_scenario")
+        start = time.monotonic()
+        cpu, children_cpu = cpu_times()
+        await asyncio.gather(*(scenario(result, g, round) for g in self.guilds))
+        # the players of the last tracks are cleaned up by now, FFmpeg was reaped
+        end_cpu, end_children_cpu = cpu_times()
+        result.wall_seconds += time.monotonic() - start
+        result.cpu_seconds += end_cpu - cpu
+        result.children_cpu_seconds += end_children_cpu - children_cpu
+
+
+async def benchmark(args: argparse.Namespace, server: StubServer, dir: str):
+    harness = Harness(args, server, dir)
+    await harness.start()
+
+    results = {name: ScenarioResult(name) for name in args.scenarios}
+    memory = []
+    snapshot = None
+    try:
+        for round in range(args.rounds):
+            for name in args.scenarios:
+                log.info(f"Round {round + 1}: running {name}")
+                await harness.run(name, results[name], round)
+            gc.collect()
+            memory.append(rss_bytes())
+            if args.tracemalloc and snapshot is None:
+                snapshot = tracemalloc.take_snapshot()
+    finally:
+        await harness.stop()
+
+    report = {
+        "player": args.player,
+        "audio_mode": args.audio_mode,
+        "guilds": args.guilds,
+        "tracks": args.tracks,
+        "duration": args.duration,
+        "rounds": args.rounds,
+        "latency": server.latency,
+        "scenarios": {name: r.to_dict() for name, r in results.items()},
+        "rss_mb": [m / MB for m in memory],
+        # the first round warms up caches, pools and imports
+        "rss_growth_mb": (memory[-1] - memory[0]) / MB if len(memory) > 1 else 0.0,
+    }
+    if snapshot is not None:
+        stats = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+        report["allocations"] = [str(stat) for stat in stats[:10]]
+    return report, results
+
+
+def format_seconds(stats: Dict[str, float]) -> str:
+    if stats["count"] == 0:
+        return "-"
+    return f'p50 {stats["p50"] * 1000:.0f}ms p95 {stats["p95"] * 1000:.0f}ms max {stats["max"] * 1000:.0f}ms'
+
+
+def print_report(report: Dict[str, Any], results: Dict[str, ScenarioResult]):
+    print(
+        f'\nPlayer: {report["player"]} ({report["audio_mode"]}), {report["guilds"]} guilds, '
+        f'{report["tracks"]} tracks of {report["duration"]}s, {report["rounds"]} rounds'
+    )
+    for name, scenario in report["scenarios"].items():
+        print(
+            f'{name:8} commands {scenario["commands"]:4}  plays {scenario["plays"]:4}  errors {scenario["errors"]}\n'
+            f'         first frame {format_seconds(scenario["first_frame"])}\n'
+            f'         gap between tracks {format_seconds(scenario["gap"])}\n'
+            f'         {scenario["streams"]:.1f} streams in real time, {scenario["late_frame_ratio"] * 100:.2f}% late frames\n'
+            f'         cpu {scenario["cpu_seconds"]:.1f}s + {scenario["children_cpu_seconds"]:.1f}s children, '
+            f'{scenario["cpu_per_stream"] * 100:.2f}% of a core per stream'
+        )
+        for error in results[name].errors[:5]:
+            print(f"         error: {error}")
+
+    rss = ", ".join(f"{m:.1f}MB" for m in report["rss_mb"])
+    print(f'Memory: rss after each round {rss} ({report["rss_growth_mb"]:+.1f}MB)')
+    for allocation in report.get("allocations", []):
+        print(f"  {allocation}")
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float):
+    """Returns the metrics that got worse than the baseline by more than tolerance."""
+    pairs = [("rss_growth_mb", report, baseline)]
+    for name, scenario in report["scenarios"].items():
+        if name in baseline["scenarios"]:
+            for metric in ["first_frame_p95", "gap_p95", "late_frame_ratio"]:
+                pairs.append((metric, scenario, baseline["scenarios"][name], name))
+            pairs.append(
+                ("cpu_per_stream", scenario, baseline["scenarios"][name], name)
+            )
+
+    regressions = []
+    for metric, current, base, *scenario in pairs:
+        limit = base[metric] * (1 + tolerance) + REGRESSION_SLACK[metric]
+        if current[metric] > limit:
+            name = f"{scenario[0]}.{metric}" if scenario else metric
+            regressions.append(
+                f"{name}: {current[metric]:.4f} (baseline {base[metric]:.4f})"
+            )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--tracks", type=int, default=3, help="tracks per scenario")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per track")
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument(
+        "--shared", action="store_true", help="all guilds request the same content"
+    )
+    parser.add_argument(
+        "--sentences", type=int, default=3, help="sentences per speech message"
+    )
+    parser.add_argument(
+        "--latency",
+        default="",
+        help=f"latency of the stubs in seconds, e. g. youtube=0.1,ytdl=1 (default {DEFAULT_LATENCY})",
+    )
+    parser.add_argument("--player", choices=["auto", "ffmpeg", "fake"], default="auto")
+    parser.add_argument(
+        "--audio-mode", choices=["opus", "pcm", PLAYBACK_MODE_WORKER], default="opus"
+    )
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--prefetch-player", action="store_true")
+    parser.add_argument("--extractor-workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, help="seconds to wait per command")
+    parser.add_argument("--tracemalloc", action="store_true")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--log-level", default="ERROR")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(
+        level=args.log_level,
+        format="[%(asctime)s] %(name)s %(levelname)s - %(message)s",
+    )
+    log.setLevel(min(logging.INFO, logging.getLevelName(args.log_level)))
+
+    if args.player == "auto":
+        args.player = "ffmpeg" if shutil.which("ffmpeg") is not None else "fake"
+        if args.player == "fake":
+            log.warning("FFmpeg is not installed, using a fake player")
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    Track.playback_mode = args.audio_mode
+    Track.ffmpeg = FFmpegProcessManager()
+    if args.audio_mode == PLAYBACK_MODE_WORKER:
+        Track.encoder = EncoderPool(max_workers=os.cpu_count() or 1)
+    with tempfile.TemporaryDirectory(prefix="discordbot-benchmark-") as dir:
+        files = {"audio": None, "speech": None}
+        if args.player == "ffmpeg":
+            files = generate_audio(dir, args.duration)
+        else:
+            Track._spawn_player = fake_player(args.duration)
+
+        # started before the event loop, the stub process must not inherit it
+        server = StubServer(
+            parse_latency(args.latency), files["audio"], files["speech"]
+        )
+        server.start()
+        try:
+            report, results = asyncio.run(benchmark(args, server, dir))
+        finally:
+            server.stop()
+            if Track.encoder is not None:
+                Track.encoder.shutdown()
+
+    print_report(report, results)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import re
+import socket
+import time
+import urllib.request
+from typing import Dict, Optional
+
+from aiohttp import web
+
+DEFAULT_LATENCY = {
+    "youtube": 0.08,
+    "spotify": 0.1,
+    "polly": 0.15,
+    "ytdl": 0.8,
+    "audio": 0.02,
+}
+SPOTIFY_PLAYLIST_SIZE_REGEX = re.compile(r"n(\d+)$")
+# roughly the size of 24kHz mp3 speech per character
+SPEECH_BYTES_PER_CHARACTER = 160
+READY_TIMEOUT = 10
+
+
+def video_id(value: str) -> str:
+    """Returns a stable video id of eleven characters like the ones of YouTube."""
+    return hashlib.sha1(value.encode("utf-8")).hexdigest()[:11]
+
+
+def parse_latency(value: str) -> Dict[str, float]:
+    """Parses service=seconds pairs separated by commas, e. g. "youtube=0.1,ytdl=1"."""
+    latency = dict(DEFAULT_LATENCY)
+    for pair in filter(None, value.split(",")):
+        service, seconds = pair.split("=")
+        if service not in latency:
+            raise ValueError(f"Unknown service {service}")
+        latency[service] = float(seconds)
+    return latency
+
+
+class StubServer:
+    """Answers the requests of the YouTube Data API, the Spotify Web API and Polly like the
+    real services after a configurable latency. Audio files are served as the streams that
+    yt-dlp would resolve. Runs in its own process so it does not compete with the bot for
+    the event loop and its CPU time is not counted as the one of the bot.
+    """
+
+    log = logging.getLogger("stubs")
+
+    def __init__(
+        self,
+        latency: Dict[str, float] = None,
+        audio_file: Optional[str] = None,
+        speech_file: Optional[str] = None,
+    ):
+        self.latency = latency if latency is not None else dict(DEFAULT_LATENCY)
+        self.audio_file = audio_file
+        self.speech_file = speech_file
+        self.port = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+
+        self._process = multiprocessing.Process(
+            target=serve,
+            args=(self.port, self.latency, self.audio_file, self.speech_file),
+            name="stubs",
+            daemon=True,
+        )
+        self._process.start()
+
+        deadline = time.monotonic() + READY_TIMEOUT
+        while True:
+            try:
+                urllib.request.urlopen(f"{self.base_url}/ready", timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or not self._process.is_alive():
+                    raise RuntimeError("The stub server did not start")
+                time.sleep(0.05)
+        self.log.info(f"Serving stubs on {self.base_url}")
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+
+def serve(port: int, latency: Dict[str, float], audio_file: str, speech_file: str):
+    audio = None
+    if audio_file is not None:
+        with open(audio_file, "rb") as f:
+            audio = f.read()
+    speech = None
+    if speech_file is not None:
+        with open(speech_file, "rb") as f:
+            speech = f.read()
+
+    async def delay(service: str):
+        if latency[service] > 0:
+            await asyncio.sleep(latency[service])
+
+    def video(id: str, base_url: str) -> Dict:
+        return {
+            "id": id,
+            "snippet": {
+                "title": f"Video {id}",
+                "thumbnails": {"medium": {"url": f"{base_url}/thumbnails/{id}.jpg"}},
+            },
+        }
+
+    def track(id: str) -> Dict:
+        return {
+            "name": f"Song {id}",
+            "artists": [{"name": f"Artist {id}"}],
+            "album": {"images": [{"url": f"https://i.scdn.co/image/{id}"}]},
+            "external_ids": {"isrc": f"BENCH{video_id(id)}"},
+        }
+
+    async def ready(request: web.Request):
+        return web.Response(text="ok")
+
+    async def youtube_videos(request: web.Request):
+        await delay("youtube")
+        base_url = f"{request.scheme}://{request.host}"
+        ids = request.query["id"].split(",")
+        return web.json_response({"items": [video(id, base_url) for id in ids]})
+
+    async def youtube_search(request: web.Request):
+        await delay("youtube")
+        base_url = f"{request.scheme}://{request.host}"
+        item = video(video_id(request.query["q"]), base_url)
+        item["id"] = {"kind": "youtube#video", "videoId": item["id"]}
+        return web.json_response({"items": [item]})
+
+    async def youtube_playlist_items(request: web.Request):
+        await delay("youtube")
+        base_url = f"{request.scheme}://{request.host}"
+        playlist = request.query["playlistId"]
+        items = []
+        for i in range(int(request.query.get("maxResults", 5))):
+            item = video(video_id(f"{playlist}-{i}"), base_url)
+            item["snippet"]["resourceId"] = {"videoId": item.pop("id")}
+            items.append(item)
+        return web.json_response({"items": items})
+
+    async def spotify_track(request: web.Request):
+        await delay("spotify")
+        return web.json_response(track(request.match_info["id"]))
+
+    async def spotify_playlist_tracks(request: web.Request):
+        await delay("spotify")
+        playlist = request.match_info["id"]
+        match = SPOTIFY_PLAYLIST_SIZE_REGEX.search(playlist)
+        size = int(match.group(1)) if match else 1
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+
+        items = [
+            {"track": track(f"{playlist}x{i}")}
+            for i in range(offset, min(offset + limit, size))
+        ]
+        next = None
+        if offset + limit < size:
+            next = str(request.url.update_query(offset=offset + limit))
+        return web.json_response({"items": items, "next": next, "total": size})
+
+    async def polly_speech(request: web.Request):
+        await delay("polly")
+        text = json.loads(await request.read())["Text"]
+        body = speech
+        if body is None:
+            body = bytes(SPEECH_BYTES_PER_CHARACTER * len(text))
+        return web.Response(
+            body=body,
+            content_type="audio/mpeg",
+            headers={"x-amzn-RequestCharacters": str(len(text))},
+        )
+
+    async def stream(request: web.Request):
+        await delay("audio")
+        if audio is None:
+            return web.Response(body=bytes(64 * 1024), content_type="audio/ogg")
+        return web.Response(body=audio, content_type="audio/ogg")
+
+    app = web.Application()
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/youtube/v3/videos", youtube_videos)
+    app.router.add_get("/youtube/v3/search", youtube_search)
+    app.router.add_get("/youtube/v3/playlistItems", youtube_playlist_items)
+    app.router.add_get("/v1/tracks/{id}", spotify_track)
+    app.router.add_get("/v1/playlists/{id}/tracks", spotify_playlist_tracks)
+    # newer versions of spotipy request the items of playlists
+    app.router.add_get("/v1/playlists/{id}/items", spotify_playlist_tracks)
+    app.router.add_post("/v1/speech", polly_speech)
+    app.router.add_get("/audio/{id}", stream)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
@@ -2,21 +2,31 @@
 
 import logging
 import os
+import sys
 
 import coloredlogs
 from bot import Bot
 from common import ConfigMap, ConfigStore, install
+from common.sharding import (
+    ShardSupervisor,
+    parse_shard_ids,
+    recommended_shard_count,
+    shard_of,
+    worker_overrides,
+)
 from discord.ext import commands
 
+LOG_FORMAT = "[%(asctime)s] [%(pathname)s:%(lineno)d] %(levelname)s - %(message)s"
+if "SHARD_WORKER" in os.environ:
+    LOG_FORMAT = f'[worker {os.environ["SHARD_WORKER"]}] {LOG_FORMAT}'
+
 logging.basicConfig(
     level=os.environ.get("LOGLEVEL", "INFO"),
-    format="[%(asctime)s] [%(pathname)s:%(lineno)d] %(levelname)s - %(message)s",
+    format=LOG_FORMAT,
     datefmt="%Y-%m-%dT%H:%M:%S",
     force=True,
 )
-coloredlogs.install(
-    fmt="[%(asctime)s] [%(pathname)s:%(lineno)d] %(levelname)s - %(message)s"
-)
+coloredlogs.install(fmt=LOG_FORMAT)
 
 CONFIG_VERSION = os.environ.get("CONFIG_VERSION", None)
 CONFIG_TYPE = os.environ.get("CONFIG_TYPE", "s3")
@@ -28,24 +38,57 @@ elif CONFIG_TYPE == "env_file":
 else:
     config = ConfigStore()
 
+overrides = worker_overrides(os.environ)
 config.set_in_env()
+os.environ.update(overrides)
 
 TOKEN = config.get("DISCORD_SECRET_TOKEN")
 FFMPEG_VERSION = config.get("FFMPEG_VERSION", fallback="5.1.1")
+SHARD_WORKERS = int(config.get_env_first("SHARD_WORKERS", "1"))
+SHARD_IDS = config.get_env_first("SHARD_IDS")
+SHARD_COUNT = config.get_env_first("SHARD_COUNT")
 
 if __name__ == "__main__":
 
-    install(FFMPEG_VERSION, force=False)
+    if SHARD_IDS is None:
+        install(FFMPEG_VERSION, force=False)
 
-    configmap = ConfigMap.from_file(
-        config.get_env_first("CONFIGFILE", "discordbot_config.json")
-    )
+    if SHARD_WORKERS > 1 and SHARD_IDS is None:
+        # this process only supervises the workers that run the shards
+        shard_count = (
+            int(SHARD_COUNT)
+            if SHARD_COUNT is not None
+            else recommended_shard_count(TOKEN) or SHARD_WORKERS
+        )
+        supervisor = ShardSupervisor(SHARD_WORKERS, max(shard_count, SHARD_WORKERS))
+        sys.exit(supervisor.run())
+
+    shard_ids = parse_shard_ids(SHARD_IDS) if SHARD_IDS is not None else None
+    shard_count = int(SHARD_COUNT) if SHARD_COUNT is not None else None
+
+    owns = None
+    if shard_ids is not None:
+        # other workers write the configs of their guilds to the same file
+        owns = lambda id: shard_of(id, shard_count) in shard_ids
+
+    configfile = config.get_env_first("CONFIGFILE", "discordbot_config.json")
+    if config.get_env_first("CONFIG_STORAGE", "sqlite") == "sqlite":
+        configmap = ConfigMap.from_database(
+            config.get_env_first("CONFIGDB", "discordbot_config.db"),
+            configfile,
+            owns,
+            maxsize=int(config.get_env_first("CONFIG_CACHE_SIZE", "1024")),
+        )
+    else:
+        configmap = ConfigMap.from_file(configfile, owns)
 
     bot = Bot(
         command_prefix=commands.when_mentioned_or("!"),
         description="Bottich",
         configmap=configmap,
         configstore=config,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
     )
 
     bot.run(TOKEN)
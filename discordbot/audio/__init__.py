@@ -1,3 +1,5 @@
+from .audio_cache import *
+from .encoder import *
 from .links import *
 from .priority_queue import *
 from .runner import *
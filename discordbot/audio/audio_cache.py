@@ -0,0 +1,277 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from asyncio import Semaphore, Task
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+
+from common.cache import TTLCache
+
+DEFAULT_AUDIO_CACHE_DIR = "./audio_cache/"
+DEFAULT_AUDIO_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_MIN_PLAYS = 2
+DEFAULT_MAX_JOBS = 1
+# a download that takes longer than this is considered broken
+DOWNLOAD_TIMEOUT = 600
+INDEX_FILENAME = "index.json"
+CACHE_BITRATE = "128k"
+
+SAFE_KEY_REGEX = re.compile(r"^[\w-]+$")
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AudioCache:
+    """On-disk cache of audio stored as opus, keyed by the id of its source.
+    A source is cached in the background once it was played min_plays times.
+    The least recently used files are evicted when the cache exceeds max_bytes.
+    Every file is checked against the size and checksum recorded when it was
+    written before it is played the first time after a restart.
+    """
+
+    log = logging.getLogger("audio_cache")
+    _entries: "OrderedDict[str, Dict[str, Any]]"
+    _jobs: Dict[str, Task]
+    _verified: Set[str]
+    _pinned: Dict[str, int]
+
+    def __init__(
+        self,
+        dir: str = DEFAULT_AUDIO_CACHE_DIR,
+        max_bytes: int = DEFAULT_AUDIO_CACHE_MAX_BYTES,
+        min_plays: int = DEFAULT_MIN_PLAYS,
+        max_jobs: int = DEFAULT_MAX_JOBS,
+        executable: str = "ffmpeg",
+    ):
+        self.dir = dir
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.executable = executable
+        self.plays = TTLCache(maxsize=4096, ttl=7 * 24 * 3600)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._jobs = {}
+        self._verified = set()
+        self._pinned = {}
+        self._slots = Semaphore(max_jobs)
+
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+
+    def _filename(self, key: str) -> str:
+        if not SAFE_KEY_REGEX.match(key):
+            key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return f"{key}.opus"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.dir, self._filename(key))
+
+    def size(self) -> int:
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size(),
+            "max_bytes": self.max_bytes,
+            "jobs": len(self._jobs),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def load(self):
+        """Restore the index. Entries whose file is missing or has the wrong size are dropped,
+        files that are not in the index are removed.
+        """
+        try:
+            with open(os.path.join(self.dir, INDEX_FILENAME), "r") as f:
+                entries = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warn(f"failed to restore audio cache index: {e}")
+            entries = []
+
+        for key, entry in sorted(entries, key=lambda e: e[1]["last_used"]):
+            path = self.path(key)
+            if os.path.exists(path) and os.path.getsize(path) == entry["size"]:
+                self._entries[key] = entry
+            else:
+                self.log.warn(f"Dropping corrupt audio cache entry {key}")
+
+        known = {self._filename(key) for key in self._entries}
+        known.add(INDEX_FILENAME)
+        for entry in os.scandir(self.dir):
+            if entry.is_file() and entry.name not in known:
+                os.remove(entry.path)
+
+        self.evict()
+        self.log.info(
+            f"Restored {len(self._entries)} entries with {self.size()} bytes from {self.dir}"
+        )
+
+    def persist(self):
+        tmp = os.path.join(self.dir, f"{INDEX_FILENAME}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(list(self._entries.items()), f)
+        os.replace(tmp, os.path.join(self.dir, INDEX_FILENAME))
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        self._verified.discard(key)
+        try:
+            os.remove(self.path(key))
+        except OSError as e:
+            self.log.warn(f"Failed to remove {key} from the audio cache: {e}")
+
+    def pin(self, key: str):
+        """Protect key from eviction until FFmpeg opened its file."""
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    def release(self, key: str):
+        count = self._pinned.get(key, 0) - 1
+        if count > 0:
+            self._pinned[key] = count
+        else:
+            self._pinned.pop(key, None)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into max_bytes.
+        Pinned entries are skipped. Files that are being played stay readable until
+        FFmpeg closes them.
+        """
+        total = self.size()
+        for key, entry in list(self._entries.items()):
+            if total <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            self._remove(key)
+            total -= entry["size"]
+            self.log.debug(f"Evicted {key} from the audio cache")
+
+    async def get(self, key: str) -> Optional[str]:
+        """Returns the path of the cached audio of key, if it is cached and intact.
+        The entry is pinned and must be released once FFmpeg opened the file.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        path = self.path(key)
+        try:
+            intact = os.path.getsize(path) == entry["size"]
+            if intact and key not in self._verified:
+                checksum = await asyncio.get_running_loop().run_in_executor(
+                    None, _sha256, path
+                )
+                intact = checksum == entry["sha256"]
+        except OSError:
+            intact = False
+
+        if not intact:
+            self.log.warn(f"Audio cache entry {key} is corrupt, removing it")
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._verified.add(key)
+        entry["last_used"] = time.time()
+        self._entries.move_to_end(key)
+        self.pin(key)
+        return path
+
+    def record_play(self, key: str, download_url: str, codec: str = None):
+        """Count a play of key. Once it was played min_plays times it is cached in the background."""
+        plays = self.plays.get(key, 0) + 1
+        self.plays.set(key, plays)
+        if plays < self.min_plays or key in self._entries or key in self._jobs:
+            return
+
+        task = self._jobs[key] = asyncio.ensure_future(
+            self._populate(key, download_url, codec)
+        )
+        task.add_done_callback(lambda _: self._jobs.pop(key, None))
+
+    def shutdown(self):
+        for task in list(self._jobs.values()):
+            task.cancel()
+        self.persist()
+
+    async def _populate(self, key: str, download_url: str, codec: str = None):
+        async with self._slots:
+            path = self.path(key)
+            tmp = f"{path}.tmp"
+            # opus streams are only remuxed, everything else is encoded
+            encode = (
+                ["-c:a", "copy"]
+                if codec == "opus"
+                else ["-c:a", "libopus", "-b:a", CACHE_BITRATE]
+            )
+            self.log.info(f"Caching {key}")
+            process = await asyncio.create_subprocess_exec(
+                self.executable,
+                "-nostdin",
+                "-loglevel",
+                "error",
+                "-reconnect",
+                "1",
+                "-reconnect_streamed",
+                "1",
+                "-reconnect_delay_max",
+                "5",
+                "-i",
+                download_url,
+                "-vn",
+                *encode,
+                "-f",
+                "opus",
+                "-y",
+                tmp,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await asyncio.wait_for(
+                    process.communicate(), DOWNLOAD_TIMEOUT
+                )
+                if process.returncode != 0 or os.path.getsize(tmp) == 0:
+                    raise IOError(
+                        f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace')}"
+                    )
+
+                checksum = await asyncio.get_running_loop().run_in_executor(
+                    None, _sha256, tmp
+                )
+                os.replace(tmp, path)
+            except BaseException as e:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                if isinstance(e, Exception):
+                    self.log.error(f"Failed to cache {key}: {e}")
+                    return
+                raise
+
+        self._entries[key] = {
+            "size": os.path.getsize(path),
+            "sha256": checksum,
+            "last_used": time.time(),
+        }
+        self._verified.add(key)
+        self.log.info(f"Cached {key} with {self._entries[key]['size']} bytes")
+        self.evict()
+        self.persist()
@@ -0,0 +1,282 @@
+import audioop
+import itertools
+import logging
+import queue
+import struct
+import subprocess
+import sys
+import threading
+from typing import Dict, List
+
+from discord import AudioSource, opus
+
+DEFAULT_STREAMS_PER_WORKER = 8
+# frames that may be on their way to and from the worker, 1s of audio
+DEFAULT_WINDOW = 50
+# waits are interrupted this often to check whether the stream or worker ended
+READ_TIMEOUT = 5
+
+# stream id, op, volume and payload length of a message to the worker
+REQUEST = struct.Struct("<IBfI")
+# stream id, op and payload length of a message from the worker
+RESPONSE = struct.Struct("<IBI")
+
+OP_FRAME = 1
+OP_CLOSE = 2
+OP_ERROR = 3
+
+
+class WorkerOpusSource(AudioSource):
+    """Opus source whose frames are encoded by an EncoderWorker.
+    A feeder thread reads the PCM frames of inner and sends them to the worker, which
+    applies the volume and encodes them. read only takes the next encoded frame, so the
+    player thread of the voice client does not need the GIL for the encoding.
+    The feeder stays at most window frames ahead of read (credit-based flow control).
+    """
+
+    log = logging.getLogger("encoder")
+
+    def __init__(
+        self,
+        worker: "EncoderWorker",
+        id: int,
+        inner: AudioSource,
+        volume: float,
+        window: int = DEFAULT_WINDOW,
+    ):
+        self.worker = worker
+        self.id = id
+        self.inner = inner
+        self.volume = volume
+        self._frames: "queue.Queue[bytes]" = queue.Queue()
+        self._credits = threading.Semaphore(window)
+        self._closed = threading.Event()
+        self._done = False
+        self._feeder = threading.Thread(
+            target=self._feed, name=f"encoder-feed-{worker.index}-{id}", daemon=True
+        )
+
+    def start(self):
+        self._feeder.start()
+
+    def _feed(self):
+        try:
+            while not self._closed.is_set():
+                data = self.inner.read()
+                if not data:
+                    break
+                while not self._credits.acquire(timeout=READ_TIMEOUT):
+                    if self._closed.is_set():
+                        return
+                self.worker.send(self.id, OP_FRAME, self.volume, data)
+        except Exception as e:
+            if not self._closed.is_set():
+                self.log.warn(f"Failed to feed stream {self.id} to the encoder: {e}")
+        finally:
+            # the worker answers once all frames before it are encoded
+            try:
+                self.worker.send(self.id, OP_CLOSE)
+            except Exception:
+                self.deliver(OP_CLOSE, b"")
+
+    def deliver(self, op: int, payload: bytes):
+        """Called by the reader thread of the worker for every response of this stream."""
+        if op == OP_FRAME:
+            self._frames.put(payload)
+        else:
+            if op == OP_ERROR:
+                self.log.error(f"Failed to encode stream {self.id}: {payload.decode()}")
+            self._frames.put(b"")
+
+    def read(self) -> bytes:
+        if self._done:
+            return b""
+        while True:
+            try:
+                frame = self._frames.get(timeout=READ_TIMEOUT)
+                break
+            except queue.Empty:
+                # FFmpeg may be reconnecting, the stream only ends with OP_CLOSE,
+                # OP_ERROR or the exit of the worker
+                if self._closed.is_set() or not self.worker.is_alive():
+                    self.log.warn(f"Stream {self.id} lost its encoder")
+                    frame = b""
+                    break
+
+        if not frame:
+            self._done = True
+            return b""
+        self._credits.release()
+        return frame
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._closed.set()
+        # wakes up a read that is still waiting
+        self._frames.put(b"")
+        self.inner.cleanup()
+        self.worker.release(self.id)
+
+
+class EncoderWorker:
+    """A process that encodes the PCM frames of many streams to opus."""
+
+    log = logging.getLogger("encoder")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.streams: Dict[int, WorkerOpusSource] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stopped = False
+        self.process = subprocess.Popen(
+            [sys.executable, __file__],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._reader = threading.Thread(
+            target=self._read, name=f"encoder-read-{index}", daemon=True
+        )
+        self._reader.start()
+        self.log.info(f"Started audio worker {index} with pid {self.process.pid}")
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def open(
+        self, inner: AudioSource, volume: float, window: int = DEFAULT_WINDOW
+    ) -> WorkerOpusSource:
+        id = next(self._ids)
+        source = self.streams[id] = WorkerOpusSource(self, id, inner, volume, window)
+        source.start()
+        return source
+
+    def release(self, id: int):
+        self.streams.pop(id, None)
+
+    def send(self, id: int, op: int, volume: float = 1.0, payload: bytes = b""):
+        with self._lock:
+            self.process.stdin.write(
+                REQUEST.pack(id, op, volume, len(payload)) + payload
+            )
+            self.process.stdin.flush()
+
+    def _read(self):
+        stdout = self.process.stdout
+        try:
+            while True:
+                header = stdout.read(RESPONSE.size)
+                if len(header) < RESPONSE.size:
+                    break
+                id, op, length = RESPONSE.unpack(header)
+                payload = stdout.read(length) if length > 0 else b""
+                source = self.streams.get(id)
+                if source is not None:
+                    source.deliver(op, payload)
+        finally:
+            if self.process.poll() is None:
+                self.process.kill()
+            if not self._stopped:
+                self.log.warn(
+                    f"Audio worker {self.index} exited with {self.process.wait()}"
+                )
+            # end the streams that were waiting for this worker
+            for source in list(self.streams.values()):
+                source.deliver(OP_ERROR, b"audio worker exited")
+
+    def stop(self):
+        self._stopped = True
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=READ_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class EncoderPool:
+    """Spreads the encoding of streams over worker processes, streams_per_worker per process.
+    Workers are started on demand up to max_workers, then streams share the least busy one.
+    """
+
+    log = logging.getLogger("encoder")
+    workers: List[EncoderWorker]
+
+    def __init__(
+        self,
+        max_workers: int = 1,
+        streams_per_worker: int = DEFAULT_STREAMS_PER_WORKER,
+        window: int = DEFAULT_WINDOW,
+    ):
+        self.max_workers = max_workers
+        self.streams_per_worker = streams_per_worker
+        self.window = window
+        self.workers = []
+        self._started = 0
+
+    def _worker(self) -> EncoderWorker:
+        self.workers = [w for w in self.workers if w.is_alive()]
+        worker = min(self.workers, key=lambda w: len(w.streams), default=None)
+        if worker is None or (
+            len(worker.streams) >= self.streams_per_worker
+            and len(self.workers) < self.max_workers
+        ):
+            worker = EncoderWorker(self._started)
+            self._started += 1
+            self.workers.append(worker)
+        return worker
+
+    def open(self, inner: AudioSource, volume: float) -> WorkerOpusSource:
+        """Returns an opus source with the PCM frames of inner encoded by a worker."""
+        return self._worker().open(inner, volume, self.window)
+
+    def stats(self):
+        return {
+            "workers": len(self.workers),
+            "streams": {w.index: len(w.streams) for w in self.workers},
+        }
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+
+def serve(stdin, stdout):
+    """Main loop of a worker process: encode the frames of every stream in order of arrival."""
+    encoders: Dict[int, opus.Encoder] = {}
+
+    def respond(id: int, op: int, payload: bytes = b""):
+        stdout.write(RESPONSE.pack(id, op, len(payload)) + payload)
+
+    while True:
+        header = stdin.read(REQUEST.size)
+        if len(header) < REQUEST.size:
+            break
+        id, op, volume, length = REQUEST.unpack(header)
+        payload = stdin.read(length) if length > 0 else b""
+
+        if op == OP_FRAME:
+            try:
+                encoder = encoders.get(id)
+                if encoder is None:
+                    encoder = encoders[id] = opus.Encoder()
+                if volume != 1:
+                    payload = audioop.mul(payload, 2, min(volume, 2.0))
+                respond(
+                    id, OP_FRAME, encoder.encode(payload, encoder.SAMPLES_PER_FRAME)
+                )
+            except Exception as e:
+                respond(id, OP_ERROR, str(e).encode() or type(e).__name__.encode())
+        elif op == OP_CLOSE:
+            encoders.pop(id, None)
+            respond(id, OP_CLOSE)
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer)
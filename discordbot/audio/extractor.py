@@ -0,0 +1,134 @@
+import logging
+import threading
+from asyncio import AbstractEventLoop, CancelledError, Semaphore, wrap_future
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import yt_dlp
+from common.metrics import external_request
+
+EXTRACTOR_MODE_THREAD = "thread"
+EXTRACTOR_MODE_PROCESS = "process"
+DEFAULT_EXTRACTOR_WORKERS = 4
+DEFAULT_GUILD_CONCURRENCY = 2
+
+_local = threading.local()
+
+
+def _get_ytdl(opts: Dict[str, Any]) -> yt_dlp.YoutubeDL:
+    """Returns a YoutubeDL instance for opts that is private to the calling worker thread."""
+    instances: Dict[str, yt_dlp.YoutubeDL] = getattr(_local, "instances", None)
+    if instances is None:
+        instances = _local.instances = {}
+
+    key = repr(sorted(opts.items()))
+    ytdl = instances.get(key)
+    if ytdl is None:
+        ytdl = instances[key] = yt_dlp.YoutubeDL(opts)
+    return ytdl
+
+
+def extract_info(opts: Dict[str, Any], url: str, download: bool) -> Dict[str, Any]:
+    """Runs yt-dlp for url inside a worker. Must stay a module level function so it can be pickled."""
+    ytdl = _get_ytdl(opts)
+    data = ytdl.sanitize_info(ytdl.extract_info(url, download=download))
+
+    if not download:
+        return data
+
+    # the filename can only be prepared by the worker that owns the ytdl instance
+    if "entries" in data:
+        for entry in data["entries"]:
+            if entry is not None:
+                entry["filename"] = ytdl.prepare_filename(entry)
+    else:
+        data["filename"] = ytdl.prepare_filename(data)
+    return data
+
+
+class ExtractionEngine:
+    """Dispatches yt-dlp extractions to a worker pool so they do not block the event loop."""
+
+    log = logging.getLogger("extractor")
+    executor: Executor
+    guild_concurrency: int
+    _semaphores: Dict[str, Semaphore]
+    _waiting: Dict[str, int]
+    _running: Dict[str, int]
+
+    def __init__(
+        self,
+        mode: str = EXTRACTOR_MODE_THREAD,
+        max_workers: int = DEFAULT_EXTRACTOR_WORKERS,
+        guild_concurrency: int = DEFAULT_GUILD_CONCURRENCY,
+        loop: Optional[AbstractEventLoop] = None,
+    ):
+        if mode == EXTRACTOR_MODE_PROCESS:
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif mode == EXTRACTOR_MODE_THREAD:
+            self.executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="ytdl"
+            )
+        else:
+            raise ValueError(f"Invalid extractor mode {mode}")
+
+        self.mode = mode
+        self.max_workers = max_workers
+        self.guild_concurrency = guild_concurrency
+        self.loop = loop
+        self._semaphores = {}
+        self._waiting = {}
+        self._running = {}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _semaphore(self, guild_id: str) -> Semaphore:
+        if guild_id not in self._semaphores:
+            self._semaphores[guild_id] = Semaphore(self.guild_concurrency)
+        return self._semaphores[guild_id]
+
+    def _change(self, counter: Dict[str, int], guild_id: str, delta: int):
+        counter[guild_id] = counter.get(guild_id, 0) + delta
+        if counter[guild_id] <= 0:
+            del counter[guild_id]
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the current queue depth of the engine, in total and per guild."""
+        return {
+            "mode": self.mode,
+            "workers": self.max_workers,
+            "waiting": sum(self._waiting.values()),
+            "running": sum(self._running.values()),
+            "waiting_per_guild": dict(self._waiting),
+            "running_per_guild": dict(self._running),
+        }
+
+    async def extract(
+        self, guild_id: str, opts: Dict[str, Any], url: str, download=False
+    ) -> Dict[str, Any]:
+        """Extracts the info of url with yt-dlp.
+        At most guild_concurrency extractions of the same guild run at once.
+        Cancelling the awaiting task drops the extraction if it has not started yet.
+        """
+        self._change(self._waiting, guild_id, 1)
+        waiting = True
+        self.log.debug(f"{guild_id}: Queued extraction of {url}")
+        try:
+            async with self._semaphore(guild_id):
+                self._change(self._waiting, guild_id, -1)
+                waiting = False
+                self._change(self._running, guild_id, 1)
+                try:
+                    future = self.executor.submit(extract_info, opts, url, download)
+                    with external_request("ytdl"):
+                        return await wrap_future(future, loop=self.loop)
+                finally:
+                    self._change(self._running, guild_id, -1)
+
+        except CancelledError:
+            self.log.info(f"{guild_id}: Cancelled extraction of {url}")
+            raise
+        finally:
+            if waiting:
+                self._change(self._waiting, guild_id, -1)
@@ -1,9 +1,22 @@
 import logging
+import threading
+import time
+from asyncio import TimeoutError, wait_for, wrap_future
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 import streamlink
+from common.cache import TTLCache
+from common.latency import LatencyStats
+from common.metrics import external_request
+from common.single_flight import SingleFlight
 from streamlink.stream import Stream
 
+DEFAULT_QUALITIES = ["best", "good", "720p", "480p"]
+DEFAULT_RESOLVE_TIMEOUT = 15
+# resolved HLS urls are signed and only valid for a limited time
+DEFAULT_STREAM_URL_TTL = 300
+
 
 class LinksError(Exception):
     def __init__(self, msg, thrown=None):
@@ -20,35 +33,99 @@ def first_desired_in_list(given: List[str], desired: List[str]):
 
 
 class LinksService:
+    """Resolves stream urls with streamlink on a worker pool.
+    The resolved urls of all qualities are cached per url for a short time.
+    """
 
     log = logging.getLogger()
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        max_workers: int = 4,
+        flight: SingleFlight = None,
+        timeout: float = DEFAULT_RESOLVE_TIMEOUT,
+        cache: TTLCache = None,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="streamlink"
+        )
+        self.flight = flight if flight is not None else SingleFlight()
+        self.timeout = timeout
+        self.cache = (
+            cache
+            if cache is not None
+            else TTLCache(maxsize=256, ttl=DEFAULT_STREAM_URL_TTL)
+        )
+        self.latency = LatencyStats()
+        self._local = threading.local()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {"latency": self.latency.stats(), "cache": self.cache.stats()}
 
     def is_url(self, url: str) -> bool:
         return "https://" in url
 
-    def find_stream(
-        self, url: str, qualities: List[str] = ["best", "good", "720p", "480p"]
+    async def find_stream(
+        self, url: str, qualities: List[str] = DEFAULT_QUALITIES
     ) -> str:
+        """Resolves the stream url of url in the first available of qualities.
+        Concurrent lookups of the same url share one request.
+        """
+        url = url.strip()
+        urls = self.cache.get(url)
+        if urls is None:
+            urls = await self.flight.do(("streamlink", url), lambda: self._resolve(url))
+
+        quality = first_desired_in_list(list(urls.keys()), qualities)
+        if quality is None:
+            self.log.warn(f"Missing any value of {qualities} in {list(urls.keys())}")
+            quality = next(iter(urls))  # select any quality
+        return urls[quality]
+
+    async def _resolve(self, url: str) -> Dict[str, str]:
+        start = time.monotonic()
         try:
-            streams: Dict[str, Stream] = streamlink.streams(url)
-            if streams is not None:
-                available_qualities = streams.keys()
-
-            if available_qualities is None or len(available_qualities) == 0:
-                raise LinksError(f"No stream found for {url}")
-
-            quality = first_desired_in_list(available_qualities, qualities)
-
-            if quality is None:
-                self.log.warn(
-                    f"Missing any value of {qualities} in {available_qualities}"
-                )
-                quality = available_qualities[0]  # select any quality
-
-            return streams[quality].url
-
+            # waiting lookups are dropped on timeout, running ones are bounded by the http timeout
+            urls = await wait_for(
+                wrap_future(self.executor.submit(self._streams, url)), self.timeout
+            )
+        except TimeoutError:
+            self.latency.record(time.monotonic() - start, failed=True)
+            raise LinksError(f"Timed out resolving {url}")
+        except BaseException:
+            self.latency.record(time.monotonic() - start, failed=True)
+            raise
+
+        elapsed = time.monotonic() - start
+        self.latency.record(elapsed)
+        self.log.info(f"Resolved {len(urls)} streams of {url} in {elapsed:.2f}s")
+        self.cache.set(url, urls)
+        return urls
+
+    def _session(self) -> streamlink.Streamlink:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = streamlink.Streamlink()
+            session.set_option("http-timeout", self.timeout)
+        return session
+
+    def _streams(self, url: str) -> Dict[str, str]:
+        try:
+            with external_request("streamlink"):
+                streams: Dict[str, Stream] = self._session().streams(url)
         except streamlink.NoPluginError:
             raise LinksError("Provided URL is not supported")
+        except streamlink.PluginError as e:
+            raise LinksError(f"Failed to resolve {url}", e)
+
+        urls = {
+            quality: stream.url
+            for quality, stream in (streams or {}).items()
+            if getattr(stream, "url", None) is not None
+        }
+        if len(urls) == 0:
+            raise LinksError(f"No stream found for {url}")
+        return urls
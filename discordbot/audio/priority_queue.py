@@ -1,91 +1,103 @@
 import logging
-from asyncio import AbstractEventLoop, PriorityQueue
-from typing import List
+from asyncio import AbstractEventLoop, Queue
+from heapq import heapify, heappop, heappush
+from itertools import count
+from typing import Any, List, Optional
 
 
 class Item:
     priority: int
 
 
-class AwarePriorityQueue:
-    """(workaround) Minimized implementation of PriorityQueue that makes the entire content accessible."""
+class QueueEntry:
+    """Handle of an item in the AwarePriorityQueue. Can be used to remove the item again."""
+
+    __slots__ = ("priority", "seq", "item", "removed")
+
+    def __init__(self, priority: int, seq: int, item: Item):
+        self.priority = priority
+        self.seq = seq
+        self.item = item
+        self.removed = False
+
+    def __lt__(self, other: "QueueEntry") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AwarePriorityQueue(Queue):
+    """PriorityQueue that makes its entire content accessible.
+    Items with the same priority are returned in insertion order.
+    put and get are O(log n), peek is O(1) and items can be removed by their handle.
+    """
 
     log = logging.getLogger("priority_queue")
-    _queue: PriorityQueue
-    _current_prio: int
-    _content: List[Item]
-
-    def __init__(self, maxsize: int, loop: AbstractEventLoop):
-        self._queue = PriorityQueue(maxsize, loop=loop)
-        self._content = []
-        self._current_prio = None
-
-    def __del__(self):
-        del self._queue
-        del self._content
-
-    def content(self):
-        return self._content
-
-    def empty(self):
-        return self._queue.empty()
-
-    def full(self):
-        return self._queue.full()
-
-    def qsize(self):
-        return self._queue.qsize()
-
-    def task_done(self):
-        return self._queue.task_done()
-
-    async def get(self):
-        item = await self._queue.get()
-        self._pop()
-        return item
-
-    def get_nowait(self):
-        try:
-            item = self._queue.get_nowait()
-        except Exception as e:
-            raise e
-
-        self._pop()
-        return item
-
-    def _higher_prio(self, prio: int):
-        return self._current_prio <= prio
-
-    def _pop(self) -> Item:
-        """Pop the first item in the content list.
-        Should only be used after the item was already removed from the internal queue.
-        """
-        self._content.pop()
-        if len(self._content) > 0:
-            self._current_prio = self._content[0].priority
-        else:
-            self._current_prio = None
-
-        self.log.debug(f"Current prio is {self._current_prio}")
-        self.log.debug(f"Content is {self._content}")
-
-    def _put(self, item: Item):
-        if self._current_prio is None:
-            self._current_prio = item.priority
-
-        if self._higher_prio(item.priority):
-            self._current_prio = item.priority
-            self._content.insert(0, item)
-        else:
-            self._content.append(item)
-
-    def put_nowait(self, item: Item):
-        try:
-            self._queue.put_nowait(item)
-        except Exception as e:
-            raise e
-
-        if self._current_prio is None:
-            self._current_prio = item.priority
-
-        self._put(item)
+    _queue: List[QueueEntry]
+
+    def __init__(self, maxsize: int = 0, loop: Optional[AbstractEventLoop] = None):
+        # loop is only kept for compatibility, asyncio binds to the running loop
+        super().__init__(maxsize)
+
+    def _init(self, maxsize: int):
+        self._queue = []
+        self._seq = count()
+        self._size = 0
+
+    def _put(self, entry: QueueEntry):
+        heappush(self._queue, entry)
+        self._size += 1
+
+    def _get(self) -> Item:
+        self._prune()
+        entry = heappop(self._queue)
+        entry.removed = True
+        self._size -= 1
+        return entry.item
+
+    def _prune(self):
+        """Drop removed entries from the top of the heap."""
+        while self._queue and self._queue[0].removed:
+            heappop(self._queue)
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def qsize(self) -> int:
+        return self._size
+
+    def put_nowait(self, item: Item) -> QueueEntry:
+        entry = QueueEntry(item.priority, next(self._seq), item)
+        super().put_nowait(entry)
+        return entry
+
+    async def put(self, item: Item) -> QueueEntry:
+        return await super().put(item)
+
+    def peek(self) -> Optional[Item]:
+        """Returns the item that would be returned next without removing it."""
+        self._prune()
+        if not self._queue:
+            return None
+        return self._queue[0].item
+
+    def remove(self, entry: QueueEntry) -> bool:
+        """Remove the item of entry from the queue. Returns False if it is not queued anymore."""
+        if entry.removed:
+            return False
+        entry.removed = True
+        self._size -= 1
+        self._prune()
+        if len(self._queue) > 2 * self._size + 16:
+            # too many removed entries are left in the heap, rebuild it
+            self._queue = [e for e in self._queue if not e.removed]
+            heapify(self._queue)
+        self.task_done()
+        self._wakeup_next(self._putters)
+        return True
+
+    def entries(self) -> List[QueueEntry]:
+        """Returns the handles of all queued items in the order they will be returned."""
+        return sorted(e for e in self._queue if not e.removed)
+
+    def content(self) -> List[Any]:
+        """Returns all queued items in the order they will be returned."""
+        return [e.item for e in self.entries()]
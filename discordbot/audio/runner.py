@@ -1,14 +1,72 @@
 import logging
-from asyncio import AbstractEventLoop, Future, Task, get_running_loop, sleep
-from typing import Dict, Optional
+import time
+from asyncio import (
+    AbstractEventLoop,
+    Event,
+    Future,
+    Task,
+    TimeoutError,
+    get_running_loop,
+    run_coroutine_threadsafe,
+    wait_for,
+)
+from typing import Callable, Dict, Optional
 
 from common import Context, format_exception
+from common.metrics import REGISTRY
+from discord import AudioSource
 from discord.ext.commands import Bot
+from discord.opus import Encoder as OpusEncoder
 from discord.voice_client import VoiceClient
 
 from .track import Track
 from .track_queue import TrackQueue
 
+FRAME_LENGTH = OpusEncoder.FRAME_LENGTH / 1000
+
+# fallback in case a voice state change was missed, e. g. while connecting
+VOICE_WAIT_TIMEOUT = 5
+
+FIRST_FRAME_SECONDS = REGISTRY.histogram(
+    "discordbot_first_frame_seconds",
+    "Time from starting to play an entry until its first audio frame was read",
+)
+
+
+class FirstFrameSource(AudioSource):
+    """Wraps a source and calls on_first_frame once its first frame was read.
+    Also counts the frames to know the position in the song, starting at start frames.
+    """
+
+    def __init__(
+        self,
+        inner: AudioSource,
+        on_first_frame: Callable[[], None],
+        start: int = 0,
+    ):
+        self.inner = inner
+        self.on_first_frame = on_first_frame
+        self.frames = start
+
+    @property
+    def position(self) -> float:
+        """Seconds of audio that were read."""
+        return self.frames * FRAME_LENGTH
+
+    def read(self) -> bytes:
+        data = self.inner.read()
+        self.frames += 1
+        if self.on_first_frame is not None:
+            callback, self.on_first_frame = self.on_first_frame, None
+            callback()
+        return data
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self):
+        self.inner.cleanup()
+
 
 class QueueRunner:
     log = logging.getLogger("runner")
@@ -16,30 +74,56 @@ class QueueRunner:
     loop: AbstractEventLoop
     track_queue: TrackQueue
     background_tasks: Dict[str, Task] = dict()
+    current_tracks: Dict[str, Track] = dict()
+    playing_tracks: Dict[str, Track] = dict()
+    _wakeups: Dict[str, Event]
 
     def __init__(
         self,
         bot: Bot,
         track_queue: TrackQueue,
         loop: Optional[AbstractEventLoop] = None,
+        prefetch_count: int = 2,
+        prefetch_player: bool = False,
     ):
         self.bot = bot
         self.loop = loop or get_running_loop()
         self.track_queue = track_queue
+        self.prefetch_count = prefetch_count
+        self.prefetch_player = prefetch_player
+        self._wakeups = {}
 
     def __del__(self):
-        for key in self.track_queue.keys():
+        for key in list(self.track_queue.keys()):
             self.remove(key)
 
     def find_relevant_voice_client(self, guild_id: str) -> VoiceClient:
-        self.log.debug(f"Trying to match voice_client for guild {guild_id}")
-        for c in self.bot.voice_clients:
-            if c.guild.id == guild_id:
-                return c
-        self.log.debug(f"Guild {guild_id} does not have a voice_client")
-        return None
+        guild = self.bot.get_guild(guild_id)
+        if guild is None or guild.voice_client is None:
+            self.log.debug(f"Guild {guild_id} does not have a voice_client")
+            return None
+        return guild.voice_client
+
+    def notify(self, guild_id: str):
+        """Wake the runner of guild_id, e. g. because its playback finished or the voice state changed."""
+        wakeup = self._wakeups.get(guild_id)
+        if wakeup is not None:
+            wakeup.set()
+
+    def notify_threadsafe(self, guild_id: str):
+        self.loop.call_soon_threadsafe(self.notify, guild_id)
+
+    def _finished(self, guild_id: str, track: Track):
+        if self.playing_tracks.get(guild_id) is track:
+            del self.playing_tracks[guild_id]
+        if Track.ffmpeg is not None:
+            # the player was stopped or skipped, collect the FFmpeg processes that exited
+            Track.ffmpeg.reap()
+        self.notify(guild_id)
 
     def _task_callback(self, future: Future):
+        if future.cancelled():
+            return
         e = future.exception()
         if e is not None:
             self.log.error(e)
@@ -48,6 +132,7 @@ class QueueRunner:
         if not self.track_queue.has(id):
             self.track_queue.new(id)
 
+        self._wakeups[id] = Event()
         task = self.loop.create_task(self.run(guild_id=id))
         self.background_tasks[id] = task
         task.add_done_callback(self._task_callback)
@@ -61,107 +146,170 @@ class QueueRunner:
             task = self.background_tasks[id]
             if not task.done():
                 task.cancel()
-            else:
+            elif not task.cancelled():
                 if task.exception() is not None:
                     self.log.warn(
                         f"Task for {id} raised an exception: {task.exception()}"
                     )
             del self.background_tasks[id]
 
+        if id in self.current_tracks:
+            self.current_tracks.pop(id).cancel()
+        self.playing_tracks.pop(id, None)
+        if Track.ffmpeg is not None:
+            # e. g. players that were built ahead of time for queued tracks
+            Track.ffmpeg.reap_guild(id)
+
+        self._wakeups.pop(id, None)
+
+    def prefetch(self, guild_id: str):
+        """Resolve the next prefetch_count entries of the queue of guild_id in the background."""
+        if self.prefetch_count <= 0 or not self.track_queue.has(guild_id):
+            return
+
+        remaining = self.prefetch_count
+        for item in self.track_queue.content(guild_id):
+            if remaining <= 0:
+                break
+            track: Track = item.item
+            if not track.prefetchable:
+                continue
+            count = min(remaining, len(track))
+            self.log.debug(f"{guild_id}: Prefetching {count} entries of {track}")
+            track.prefetch(count, self.prefetch_player)
+            remaining -= count
+
     async def play(
         self,
         guild_id: str,
         voice_client: VoiceClient,
         track: Track,
-        cur_try=0,
         max_try=3,
-    ):
-        if voice_client is not None:
-            ctx = track.context
+    ) -> bool:
+        """Play the next entry of track. Returns whether playback was started."""
+        ctx = track.context
+        start = time.monotonic()
+
+        def first_frame():
+            # called from the player thread of the voice_client
+            FIRST_FRAME_SECONDS.observe(time.monotonic() - start)
 
-            def handle_error(e: Exception, ctx: Context):
+        def after(e: Exception):
+            # called from the player thread of the voice_client
+            if e is not None:
                 msg = format_exception(e)
                 self.log.warn(f"{guild_id}: Error in queue_runner: {msg}")
-                ctx.reply_formatted_error(f"Failed to play: {msg}")
+                run_coroutine_threadsafe(
+                    ctx.reply_formatted_error(f"Failed to play: {msg}"), self.loop
+                )
+            self.loop.call_soon_threadsafe(self._finished, guild_id, track)
 
-            async with ctx.typing():
-                cur_try += 1
+        async with ctx.typing():
+            try:
+                self.current_tracks[guild_id] = track
+                for cur_try in range(1, max_try + 1):
+                    try:
+                        player = await track.next()
+                        if track.is_cancelled():
+                            self.log.info(
+                                f"{guild_id}: Track was cancelled. Skipping..."
+                            )
+                            return False
 
-                try:
-                    player = await track.next()
-                    if track.is_failed():
-                        await ctx.reply_formatted_error(
-                            f"Failed to play due to {track.error}"
+                        if track.is_failed():
+                            await ctx.reply_formatted_error(
+                                f"Failed to play due to {track.error}"
+                            )
+                            return False
+
+                        if player is None:
+                            self.log.info(f"{guild_id}: Track has no entries left")
+                            return False
+
+                        voice_client.play(
+                            FirstFrameSource(player, first_frame), after=after
                         )
-                        return
+                        self.playing_tracks[guild_id] = track
 
-                    voice_client.play(
-                        player,
-                        after=lambda e: handle_error(e, ctx) if e else None,
-                    )
+                    except Exception as e:
+                        self.log.warn(
+                            f"{guild_id}: Failed to play audio in queue {guild_id}: {e}"
+                        )
+                        if cur_try < max_try:
+                            self.log.warn(f"{guild_id}: Retrying...")
+                            continue
 
-                    title = "Bottich Audio Player"
-                    if track.hasNext():
-                        await self.track_queue.put_back(guild_id, track)
-                        title = (
-                            f"Bottich Audio Player ({track.current}/{track.max_len()})"
+                        self.log.error(f"{guild_id}: Exceeded retry limit")
+                        await ctx.reply_formatted_error(
+                            f"Failed to play {track.pretty_print()}. Skipping..."
                         )
+                        return False
 
-                    info = track.get_current_info()
-                    self.log.info(f"Playing track: {info.pretty_print()}")
+                    break
 
-                    await ctx.reply_formatted_msg(
-                        f'Now playing "{info.title}"',
-                        title=title,
-                        thumbnail_url=info.thumbnail,
-                    )
+                title = "Bottich Audio Player"
+                if track.hasMore():
+                    await self.track_queue.put_back(guild_id, track)
+                    title = f"Bottich Audio Player ({track.current}/{track.max_len()})"
 
-                except Exception as e:
-                    self.log.warn(
-                        f"{guild_id}: Failed to play audio in queue {guild_id}: {e}"
-                    )
-                    info = track.get_current_info()
+                self.prefetch(guild_id)
 
-                    if cur_try >= max_try:
-                        self.log.warn(f"Failed to play {info.title}. Retrying...", e)
-                        return await self.play(
-                            guild_id, voice_client, track, cur_try, max_try
-                        )
-                    else:
-                        self.log.error(
-                            "Failed to play {info.title}. Exceeded retry limit", e
-                        )
-                        await ctx.reply_formatted_error(
-                            f"Failed to play {info.title}. Skipping..."
-                        )
-                finally:
-                    self.log.debug(f"{guild_id}: Popping item from queue")
-                    self.track_queue.task_done(guild_id)
+                info = track.get_current_info()
+                self.log.info(f"Playing track: {info.pretty_print()}")
 
-    async def run(self, guild_id: str):
-        self.log.info(f"{guild_id}: Started queue_runner")
+                await ctx.reply_formatted_msg(
+                    f'Now playing "{info.title}"',
+                    title=title,
+                    thumbnail_url=info.thumbnail,
+                )
+                return True
 
-        voice_client = self.find_relevant_voice_client(guild_id)
+            finally:
+                self.log.debug(f"{guild_id}: Popping item from queue")
+                if self.current_tracks.get(guild_id) is track:
+                    del self.current_tracks[guild_id]
+                self.track_queue.task_done(guild_id)
 
-        while not self.bot.is_closed():
+    async def wait_until_idle(self, guild_id: str) -> VoiceClient:
+        """Wait until the voice_client of guild_id is connected and neither playing nor paused.
+        The runner is woken by notify. While the voice client is disconnected, the timeout
+        guards against missed voice state events. A playing or paused player always ends
+        with its after callback, which notifies the runner, so it is awaited without one.
+        """
+        wakeup = self._wakeups.setdefault(guild_id, Event())
+        while True:
             voice_client = self.find_relevant_voice_client(guild_id)
+            connected = voice_client is not None and voice_client.is_connected()
             if (
-                voice_client is not None
-                and voice_client.is_connected()
+                connected
                 and not voice_client.is_playing()
                 and not voice_client.is_paused()
             ):
+                return voice_client
 
-                self.log.info(f"{guild_id}: Getting new track from queue")
-                track: Track = (
-                    await self.track_queue.get(guild_id)
-                ).item  # this blocks until a track is available
-                self.log.info(f"Got new track from queue: {track.pretty_print()}")
+            wakeup.clear()
+            if connected:
+                await wakeup.wait()
+                continue
+            try:
+                await wait_for(wakeup.wait(), VOICE_WAIT_TIMEOUT)
+            except TimeoutError:
+                pass
 
-                if not voice_client.is_connected():
-                    voice_client = self.find_relevant_voice_client(guild_id)
+    async def run(self, guild_id: str):
+        self.log.info(f"{guild_id}: Started queue_runner")
+
+        while not self.bot.is_closed():
+            await self.wait_until_idle(guild_id)
 
-                if voice_client is not None:
-                    await self.play(guild_id, voice_client, track, 0, 3)
+            self.log.info(f"{guild_id}: Getting new track from queue")
+            track: Track = (
+                await self.track_queue.get(guild_id)
+            ).item  # this blocks until a track is available
+            self.log.info(f"Got new track from queue: {track.pretty_print()}")
+
+            voice_client = self.find_relevant_voice_client(guild_id)
+            if voice_client is None or not voice_client.is_connected():
+                voice_client = await self.wait_until_idle(guild_id)
 
-            await sleep(1)
+            await self.play(guild_id, voice_client, track)
@@ -1,2 +1,3 @@
+from .matches import *
 from .service import *
 from .track import *
@@ -0,0 +1,91 @@
+import logging
+import sqlite3
+import time
+from asyncio import wrap_future
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .track import SpotifyTrackInfo
+
+DEFAULT_MATCHES_FILE = "spotify_matches.db"
+
+
+@dataclass
+class SpotifyMatch:
+    video_id: str
+    title: str
+    thumbnail: str
+
+
+def match_keys(info: SpotifyTrackInfo) -> List[str]:
+    """Returns the keys a track is stored under, the most specific first."""
+    keys = []
+    if info.isrc:
+        keys.append(f"isrc:{info.isrc.upper()}")
+    keys.append(f"name:{info.artist.strip().lower()} - {info.name.strip().lower()}")
+    return keys
+
+
+class SpotifyMatchStore:
+    """Persistent mapping of Spotify tracks to the YouTube video that was chosen for them.
+    The database is only used by one thread, so reads and commits never block the event loop.
+    """
+
+    log = logging.getLogger("spotify_matches")
+
+    def __init__(self, filename: str = DEFAULT_MATCHES_FILE):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="spotify-matches"
+        )
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS matches ("
+                "key TEXT PRIMARY KEY, video_id TEXT NOT NULL, title TEXT, thumbnail TEXT, updated_at REAL)"
+            )
+
+    def close(self):
+        """Wait for the queued writes and close the database."""
+        self.executor.shutdown(wait=True)
+        self.db.close()
+
+    async def get(self, info: SpotifyTrackInfo) -> Optional[SpotifyMatch]:
+        return await wrap_future(self.executor.submit(self._get, info))
+
+    def put(self, info: SpotifyTrackInfo, match: SpotifyMatch) -> Future:
+        """Queue the write of match, the caller does not wait for the commit."""
+        future = self.executor.submit(self._put, info, match)
+        future.add_done_callback(self._put_done)
+        return future
+
+    def _put_done(self, future: Future):
+        if not future.cancelled() and future.exception() is not None:
+            self.log.error(f"Failed to store match: {future.exception()}")
+
+    def _get(self, info: SpotifyTrackInfo) -> Optional[SpotifyMatch]:
+        for key in match_keys(info):
+            row = self.db.execute(
+                "SELECT video_id, title, thumbnail FROM matches WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self.hits += 1
+                self.log.info(f'Found stored match "{row[0]}" for "{key}"')
+                return SpotifyMatch(*row)
+
+        self.misses += 1
+        return None
+
+    def _put(self, info: SpotifyTrackInfo, match: SpotifyMatch):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO matches (key, video_id, title, thumbnail, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (key, match.video_id, match.title, match.thumbnail, now)
+                    for key in match_keys(info)
+                ],
+            )
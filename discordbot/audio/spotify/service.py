@@ -1,12 +1,20 @@
 import logging
 import re
-from typing import Dict, List
+from asyncio import wrap_future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, Optional
 
 import spotipy
+from common.metrics import external_request
+from common.single_flight import SingleFlight
 
 from .track import SpotifyTrackInfo
 
 SPOTIFY_MARKET = "DE"
+SPOTIFY_PAGE_SIZE = 50
+SPOTIFY_PLAYLIST_FIELDS = (
+    "items(track(name, artists.name, album(images(url)), external_ids)),next"
+)
 SPOTIFY_TRACK_ID_REGEX = re.compile(r".*spotify\.com\/track\/(.*?)\?si=.*")
 SPOTIFY_ALBUM_ID_REGEX = re.compile(r".*spotify\.com\/album\/(.*?)\?si=.*")
 SPOTIFY_PLAYLIST_ID_REGEX = re.compile(r".*spotify\.com\/playlist\/(.*?)\?si=.*")
@@ -22,9 +30,37 @@ class SpotifyService:
 
     log = logging.getLogger("svc")
 
-    def __init__(self, service: spotipy.Spotify, max_entries: int = 10):
+    def __init__(
+        self,
+        service: spotipy.Spotify,
+        max_entries: int = 1000,
+        max_workers: int = 4,
+        flight: SingleFlight = None,
+    ):
         self.service = service
         self.max_entries = max_entries
+        self.flight = flight if flight is not None else SingleFlight()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="spotify"
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    async def _call(self, func, *args, **kwargs) -> Dict[str, Any]:
+        """Run a blocking spotipy call on the executor."""
+        with external_request("spotify"):
+            return await wrap_future(self.executor.submit(func, *args, **kwargs))
+
+    async def _shared_call(self, key, func, *args, **kwargs) -> Dict[str, Any]:
+        """Like _call but concurrent calls with the same key share one request.
+        The raw response is shared, it must not be modified.
+        """
+        return await self.flight.do(key, lambda: self._call(func, *args, **kwargs))
+
+    def _normalize(self, id_or_url: str) -> str:
+        # shared links only differ in their query parameters
+        return id_or_url.split("?")[0].rstrip("/")
 
     def is_spotify_url(self, url: str) -> bool:
         return (
@@ -43,26 +79,78 @@ class SpotifyService:
         return bool(SPOTIFY_PLAYLIST_ID_REGEX.match(url))
 
     async def get_info(self, url: str) -> List[SpotifyTrackInfo]:
-        tracks: List[SpotifyTrackInfo] = []
+        """Returns all tracks of url at once. Prefer iter_info_pages for albums and playlists."""
+        return [info async for info in self.iter_info(url)]
+
+    async def iter_info(self, url: str) -> AsyncIterator[SpotifyTrackInfo]:
+        pages = self.iter_info_pages(url)
+        try:
+            async for page in pages:
+                for info in page:
+                    yield info
+        finally:
+            await pages.aclose()
+
+    async def iter_info_pages(self, url: str) -> AsyncIterator[List[SpotifyTrackInfo]]:
+        """Yields the tracks of url page by page. The next page is only requested once the previous one was consumed."""
         if self.is_spotify_track(url):
-            tracks.append(await self.get_track_info(url))
+            pages = self._single_track_pages(url)
 
         elif self.is_spotify_album(url):
-            tracks = await self.get_album_tracks_info(url)
+            pages = self.iter_album_tracks_info(url)
 
         elif self.is_spotify_playlist(url):
-            tracks = await self.get_playlist_tracks_info(url)
+            pages = self.iter_playlist_tracks_info(url)
 
         else:
             raise SpotifyError("Invalid spotify url")
 
-        return tracks
+        count = 0
+        try:
+            async for page in pages:
+                if count + len(page) > self.max_entries:
+                    self.log.warn(
+                        f"{url} has more than {self.max_entries} tracks, only the first {self.max_entries} will be played"
+                    )
+                    page = page[: self.max_entries - count]
+
+                count += len(page)
+                if len(page) > 0:
+                    yield page
+                if count >= self.max_entries:
+                    break
+        finally:
+            # stops the request of the next page when the caller stops early
+            await pages.aclose()
+
+    async def _single_track_pages(
+        self, id_or_url: str
+    ) -> AsyncIterator[List[SpotifyTrackInfo]]:
+        yield [await self.get_track_info(id_or_url)]
+
+    async def _next_page(
+        self, page: Dict[str, Any], kind: str, id_or_url: str
+    ) -> Optional[Dict[str, Any]]:
+        if page.get("next") is None:
+            return None
+        try:
+            self.log.info(f"Requesting next {kind} page from Spotify API")
+            return await self._shared_call(
+                ("spotify_next", page["next"]), self.service.next, page
+            )
+        except Exception as e:
+            raise SpotifyError(f"failed to get {kind} {id_or_url}", e)
 
     async def get_track_info(self, id_or_url: str) -> SpotifyTrackInfo:
         self.log.info(f'Searching spotify for track "{id_or_url}"')
         try:
             self.log.warn("Sending track request to Spotify API")
-            track = self.service.track(id_or_url, market=SPOTIFY_MARKET)
+            track = await self._shared_call(
+                ("spotify_track", self._normalize(id_or_url)),
+                self.service.track,
+                id_or_url,
+                market=SPOTIFY_MARKET,
+            )
 
         except Exception as e:
             raise SpotifyError(f"failed to get track {id_or_url}", e)
@@ -74,71 +162,75 @@ class SpotifyService:
             track["artists"][0]["name"],
             track["name"],
             track["album"]["images"][0]["url"],
+            track.get("external_ids", {}).get("isrc"),
         )
 
-    async def get_playlist_tracks_info(self, id_or_url: str) -> List[SpotifyTrackInfo]:
+    async def iter_playlist_tracks_info(
+        self, id_or_url: str
+    ) -> AsyncIterator[List[SpotifyTrackInfo]]:
         self.log.info(f'Searching spotify for playlist "{id_or_url}"')
 
         try:
             self.log.warn("Sending playlist request to Spotify API")
-            playlist = self.service.playlist(
+            page = await self._shared_call(
+                ("spotify_playlist", self._normalize(id_or_url)),
+                self.service.playlist_items,
                 id_or_url,
                 market=SPOTIFY_MARKET,
-                fields="tracks.items(track(name, artists.name, album(images(url))))",
+                fields=SPOTIFY_PLAYLIST_FIELDS,
+                limit=SPOTIFY_PAGE_SIZE,
             )
 
         except Exception as e:
             raise SpotifyError(f"failed to get playlist {id_or_url}", e)
 
-        playlist_tracks = [t["track"] for t in playlist["tracks"]["items"]]
-        tracks: List[SpotifyTrackInfo] = []
-
-        if len(playlist_tracks) > self.max_entries:
-            self.log.warn(
-                f"Playlist has more than {self.max_entries} tracks, only the first {self.max_entries} will be played"
-            )
-            playlist_tracks = playlist_tracks[: self.max_entries]
-
-        for track in playlist_tracks:
-            tracks.append(
-                SpotifyTrackInfo(
-                    "",
-                    track["name"],
-                    track["artists"][0]["name"],
-                    track["album"]["images"][0]["url"],
+        while page is not None:
+            tracks: List[SpotifyTrackInfo] = []
+            for item in page["items"]:
+                track = item.get("track")
+                if track is None or len(track.get("artists", [])) == 0:
+                    # deleted tracks and podcast episodes cannot be played
+                    continue
+                images = track["album"]["images"]
+                tracks.append(
+                    SpotifyTrackInfo(
+                        "",
+                        track["artists"][0]["name"],
+                        track["name"],
+                        images[0]["url"] if len(images) > 0 else None,
+                        track.get("external_ids", {}).get("isrc"),
+                    )
                 )
-            )
-
-        return tracks
+            yield tracks
+            page = await self._next_page(page, "playlist", id_or_url)
 
-    async def get_album_tracks_info(self, id_or_url: str) -> List[SpotifyTrackInfo]:
+    async def iter_album_tracks_info(
+        self, id_or_url: str
+    ) -> AsyncIterator[List[SpotifyTrackInfo]]:
         self.log.info(f'Searching spotify for album "{id_or_url}"')
         try:
             self.log.warn("Sending album request to Spotify API")
-            album = self.service.album(id_or_url)
+            album = await self._shared_call(
+                ("spotify_album", self._normalize(id_or_url)),
+                self.service.album,
+                id_or_url,
+            )
 
         except Exception as e:
             raise SpotifyError(f"failed to get album {id_or_url}", e)
 
         self.log.info(
-            f'Found album "{album["name"]}" with {len(album["tracks"]["items"])} tracks'
+            f'Found album "{album["name"]}" with {album["tracks"]["total"]} tracks'
         )
 
-        album_tacks = album["tracks"]["items"]
-        tracks: List[SpotifyTrackInfo] = []
         album_thumbnail = album["images"][0]["url"]
+        page = album["tracks"]
 
-        if len(album_tacks) > self.max_entries:
-            self.log.warn(
-                f"Album has more than {self.max_entries} tracks, only the first {self.max_entries} will be played"
-            )
-            album_tacks = album_tacks[: self.max_entries]
-
-        for track in album_tacks:
-            tracks.append(
+        while page is not None:
+            yield [
                 SpotifyTrackInfo(
                     "", track["artists"][0]["name"], track["name"], album_thumbnail
                 )
-            )
-
-        return tracks
+                for track in page["items"]
+            ]
+            page = await self._next_page(page, "album", id_or_url)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from common.context import Context
 
@@ -8,11 +8,20 @@ from ..track import Track, TrackInfo
 class SpotifyTrackInfo(TrackInfo):
     artist: str
     name: str
-
-    def __init__(self, url: str, artist: str, name: str, thumbnail_url: str):
+    isrc: Optional[str]
+
+    def __init__(
+        self,
+        url: str,
+        artist: str,
+        name: str,
+        thumbnail_url: str,
+        isrc: Optional[str] = None,
+    ):
         super().__init__(url, f"{artist} - {name}", thumbnail_url)
         self.artist = artist
         self.name = name
+        self.isrc = isrc
 
     def pretty_print(self):
         return f'"{self.artist} - {self.name}"{" (" + self.url + ")" if self.url != "" else ""}'
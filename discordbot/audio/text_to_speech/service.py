@@ -1,14 +1,29 @@
+import hashlib
 import logging
 import os
+import re
+import tempfile
+from asyncio import wrap_future
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from contextlib import closing
+from functools import partial
+from typing import Callable, Deque, Dict, List
 
 from botocore.exceptions import BotoCoreError, ClientError, ValidationError
+from common.metrics import external_request
 
 from ..track import TrackInfo
 
 ENGINE = "standard"  # 'standard'|'neural'
 OUTPUT_FORMAT = "mp3"  # 'json'|'mp3'|'ogg_vorbis'|'pcm'
 SAMPLE_RATE = "16000"
+DEFAULT_CACHE_MAX_BYTES = 100 * 1024 * 1024
+DEFAULT_POLLY_WORKERS = 4
+DEFAULT_SYNTHESIS_PARALLELISM = 2
+CHUNK_CHARACTERS = 500
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
 
 
 class TextToSpeechError(Exception):
@@ -17,6 +32,146 @@ class TextToSpeechError(Exception):
         self.thrown = thrown
 
 
+def split_sentences(text: str, max_length: int = CHUNK_CHARACTERS) -> List[str]:
+    """Splits text into chunks of whole sentences that are at most max_length long.
+    The first chunk is a single sentence so that playback can start as early as possible.
+    """
+    sentences = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        while len(sentence) > max_length:
+            cut = sentence.rfind(" ", 0, max_length)
+            if cut <= 0:
+                cut = max_length
+            sentences.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            sentences.append(sentence)
+
+    if not sentences:
+        return []
+
+    chunks = [sentences[0]]
+    current = ""
+    for sentence in sentences[1:]:
+        if current and len(current) + 1 + len(sentence) > max_length:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SpeechPipeline:
+    """File-like object that synthesizes text chunk by chunk and returns the audio in order.
+    At most parallelism chunks are synthesized ahead of the reader.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        synthesize: Callable[[str], bytes],
+        chunks: List[str],
+        parallelism: int = DEFAULT_SYNTHESIS_PARALLELISM,
+    ):
+        self.executor = executor
+        self.synthesize = synthesize
+        self.parallelism = max(parallelism, 1)
+        self._chunks: Deque[str] = deque(chunks)
+        self._pending: Deque[Future] = deque()
+        self._buffer = memoryview(b"")
+        self._fill()
+
+    def _fill(self):
+        while self._chunks and len(self._pending) < self.parallelism:
+            self._pending.append(
+                self.executor.submit(self.synthesize, self._chunks.popleft())
+            )
+
+    def first(self) -> Future:
+        """Returns the future of the first chunk, if there is one."""
+        return self._pending[0] if self._pending else None
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._buffer:
+            if not self._pending:
+                return b""
+            future = self._pending.popleft()
+            self._fill()
+            self._buffer = memoryview(future.result())
+
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size].tobytes()
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._chunks.clear()
+        while self._pending:
+            self._pending.popleft().cancel()
+        self._buffer = memoryview(b"")
+
+
+class CachingStream:
+    """File-like wrapper around a Polly audio stream that is piped into FFmpeg.
+    Everything that is read is written to a temporary file which is moved into
+    the cache once the stream was read completely.
+    """
+
+    log = logging.getLogger("text2speech")
+
+    def __init__(
+        self, stream, output: str, dir: str, on_complete: Callable[[str], None] = None
+    ):
+        self.stream = stream
+        self.output = output
+        self.on_complete = on_complete
+        fd, self.tmp = tempfile.mkstemp(dir=dir, suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def __del__(self):
+        self.close()
+
+    def read(self, size: int = -1) -> bytes:
+        if self.file is None:
+            return b""
+        try:
+            data = self.stream.read(size if size >= 0 else None)
+        except Exception as e:
+            # read by the pipe writer of FFmpeg, end the stream instead of raising there
+            self.log.error(f"Failed to read speech: {e}")
+            self.close()
+            return b""
+        if data:
+            self.file.write(data)
+        else:
+            self._finish()
+        return data
+
+    def _finish(self):
+        self.file.close()
+        self.file = None
+        self.stream.close()
+        os.replace(self.tmp, self.output)
+        self.log.debug(f"Cached speech at {self.output}")
+        if self.on_complete is not None:
+            self.on_complete(self.output)
+
+    def close(self):
+        """Abort the stream, e. g. because playback was stopped. Nothing is cached."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.stream.close()
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+
 class TextToSpeechService:
 
     log = logging.getLogger("text2speech")
@@ -25,41 +180,133 @@ class TextToSpeechService:
         self,
         polly_client,
         dir="./polly/",
+        max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        max_workers=DEFAULT_POLLY_WORKERS,
+        parallelism=DEFAULT_SYNTHESIS_PARALLELISM,
     ):
         self.polly = polly_client
         self.dir = dir
+        self.max_bytes = max_bytes
+        self.parallelism = parallelism
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="polly"
+        )
+        self.hits = 0
+        self.misses = 0
+        self._pinned: Dict[str, int] = {}
 
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
 
-    def synthesize_speech(
-        self, id: str, message: str, lang_code: str, voice_id: str
-    ) -> TrackInfo:
-        try:
-            self.log.info(
-                f"{id}: Trying to synthesize speech with length {len(message)}"
-            )
-            response = self.polly.synthesize_speech(
-                Engine=ENGINE,
-                OutputFormat=OUTPUT_FORMAT,
-                SampleRate=SAMPLE_RATE,
-                LanguageCode=lang_code,
-                Text=message,
-                VoiceId=voice_id,
-            )
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def cache_path(self, message: str, lang_code: str, voice_id: str) -> str:
+        """Returns the path the speech is cached at. It is derived from everything that affects the audio."""
+        key = hashlib.sha256(
+            "\0".join(
+                [ENGINE, OUTPUT_FORMAT, SAMPLE_RATE, lang_code, voice_id, message]
+            ).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.dir, f"{key}.{OUTPUT_FORMAT}")
 
-            output = os.path.join(self.dir, f"{id}.mp3")
-            if "AudioStream" in response:
-                with closing(response["AudioStream"]) as stream:
+    def pin(self, path: str):
+        """Protect path from eviction, e. g. while it is queued for playback."""
+        self._pinned[path] = self._pinned.get(path, 0) + 1
 
-                    with closing(open(output, "wb")) as file:
-                        file.write(stream.read())
-            else:
-                raise TextToSpeechError("no audiostream found in the polly response")
+    def release(self, path: str):
+        count = self._pinned.get(path, 0) - 1
+        if count > 0:
+            self._pinned[path] = count
+        else:
+            self._pinned.pop(path, None)
 
+    def evict(self, *_):
+        """Remove the least recently used files until the cache fits into max_bytes."""
+        files = []
+        for entry in os.scandir(self.dir):
+            # temporary files are still being written
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path in self._pinned:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+                self.log.debug(f"Evicted {path} from the speech cache")
+            except OSError as e:
+                self.log.warn(f"Failed to evict {path}: {e}")
+
+    def _request(self, message: str, lang_code: str, voice_id: str):
+        try:
+            with external_request("polly"):
+                response = self.polly.synthesize_speech(
+                    Engine=ENGINE,
+                    OutputFormat=OUTPUT_FORMAT,
+                    SampleRate=SAMPLE_RATE,
+                    LanguageCode=lang_code,
+                    Text=message,
+                    VoiceId=voice_id,
+                )
         except ClientError as e:
             raise TextToSpeechError("failed to synthesize speech", e)
         except (BotoCoreError, ValidationError) as e:
             raise TextToSpeechError(f"failed to synthesize speech: {e.fmt}")
 
-        return TrackInfo("", "SynthesizeSpeech", None, output)
+        if "AudioStream" not in response:
+            raise TextToSpeechError("no audiostream found in the polly response")
+        return response["AudioStream"]
+
+    def _synthesize_chunk(self, lang_code: str, voice_id: str, message: str) -> bytes:
+        with closing(self._request(message, lang_code, voice_id)) as stream:
+            return stream.read()
+
+    async def synthesize_speech(
+        self, id: str, message: str, lang_code: str, voice_id: str
+    ) -> TrackInfo:
+        """Returns the speech for message. Cached speech is played from its file and must
+        be released once it was played. Otherwise the Polly response is streamed into
+        FFmpeg as it arrives and written to the cache on the way.
+        Long messages are synthesized sentence by sentence so that playback starts
+        after the first sentence.
+        """
+        output = self.cache_path(message, lang_code, voice_id)
+        if os.path.exists(output):
+            self.hits += 1
+            self.log.info(f"{id}: Using cached speech {output}")
+            os.utime(output)  # mark as recently used
+            self.pin(output)
+            return TrackInfo("", "SynthesizeSpeech", None, output)
+
+        self.misses += 1
+        self.log.info(f"{id}: Trying to synthesize speech with length {len(message)}")
+        chunks = split_sentences(message)
+        if len(chunks) > 1:
+            stream = SpeechPipeline(
+                self.executor,
+                partial(self._synthesize_chunk, lang_code, voice_id),
+                chunks,
+                self.parallelism,
+            )
+            try:
+                # errors of the first chunk are reported like those of a single request
+                await wrap_future(stream.first())
+            except BaseException:
+                stream.close()
+                raise
+        else:
+            stream = await wrap_future(
+                self.executor.submit(self._request, message, lang_code, voice_id)
+            )
+
+        return TrackInfo(
+            "",
+            "SynthesizeSpeech",
+            source=CachingStream(stream, output, self.dir, self.evict),
+        )
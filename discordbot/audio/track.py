@@ -1,8 +1,20 @@
+import logging
+from asyncio import CancelledError, Event, Task, ensure_future
 from dataclasses import dataclass, field
-from typing import Callable, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 from common.context import Context
-from discord import FFmpegPCMAudio, PCMVolumeTransformer
+from common.ffmpeg import FFmpegProcessManager
+from discord import AudioSource, FFmpegOpusAudio, FFmpegPCMAudio, PCMVolumeTransformer
+
+from .encoder import EncoderPool
+
+PLAYBACK_MODE_PCM = "pcm"
+PLAYBACK_MODE_OPUS = "opus"
+PLAYBACK_MODE_WORKER = "worker"
+OPUS_BITRATE = 128
+# PCM playback starts at half volume, opus at full volume so it can be passed through
+DEFAULT_PCM_VOLUME = 0.5
 
 STREAM_FFMPEG_OPTS = {
     "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
@@ -21,6 +33,11 @@ class TrackInfo:
     title: str
     thumbnail: Optional[str] = ""
     download_url: Optional[str] = ""
+    codec: Optional[str] = None
+    # file-like object that is piped into FFmpeg instead of reading download_url
+    source: Optional[Any] = None
+    # key of the video in the audio cache, set when it was resolved by the YoutubeService
+    cache_key: Optional[str] = None
     stream = True
 
     def print(self):
@@ -31,20 +48,38 @@ class TrackInfo:
 
 
 class Track:
+    log = logging.getLogger("track")
     priority: int
     context: Context
     info: List[TrackInfo]
-    _player: PCMVolumeTransformer
+    _player: AudioSource
     current = 0
     length = 0
     volume: float
     error: Exception = None
-
+    cancelled = False
+    _prepared: Dict[int, Task]
+    _complete = True
+    _extended: Optional[Event] = None
+
+    playback_mode = PLAYBACK_MODE_OPUS
+    # encodes the streams in worker processes if the playback mode is worker
+    encoder: Optional[EncoderPool] = None
+    # limits and tracks the FFmpeg processes of the players of all guilds
+    ffmpeg: Optional[FFmpegProcessManager] = None
     before_build: Callable[[TrackInfo], None] = None
-    after_build: Callable[[TrackInfo, PCMVolumeTransformer], None] = None
+    after_build: Callable[[TrackInfo, AudioSource], None] = None
+    # false if before_build must only run right before the entry is played
+    prefetchable = True
+    # called for entries that ran before_build but never reach after_build
+    on_discard: Callable[[TrackInfo], None] = None
 
     def __init__(
-        self, ctx: Context, info: List[TrackInfo], volume=0.5, error: Exception = None
+        self,
+        ctx: Context,
+        info: List[TrackInfo],
+        volume: float = None,
+        error: Exception = None,
     ):
         if isinstance(info, list):
             self.info = info
@@ -55,8 +90,16 @@ class Track:
         self.length = len(self.info)
         self.current = 0
         self._player = None
+        if volume is None:
+            volume = (
+                1 if self.playback_mode == PLAYBACK_MODE_OPUS else DEFAULT_PCM_VOLUME
+            )
         self.volume = volume
         self.error = error
+        self.cancelled = False
+        self._prepared = {}
+        self._complete = True
+        self._extended = None
 
     def __len__(self):
         return self.length - self.current
@@ -64,20 +107,129 @@ class Track:
     def __del__(self):
         print(f"Deleting track {self.info}")
 
-    def _build_player(self, download_url: str, stream=True):
-        return PCMVolumeTransformer(
-            FFmpegPCMAudio(
-                download_url, **STREAM_FFMPEG_OPTS if stream else FFMPEG_OPTS
-            ),
-            self.volume,
+    async def _build_player(
+        self, track_info: TrackInfo, prefetch: bool = False, start: float = 0
+    ) -> Optional[AudioSource]:
+        """Build the player of track_info, starting start seconds into it. Returns None if
+        a prefetched player would exceed the FFmpeg processes that are left for prefetching.
+        """
+        if self.ffmpeg is None:
+            return await self._spawn_player(track_info, start)
+        return await self.ffmpeg.spawn(
+            self.context.guild.id,
+            lambda: self._spawn_player(track_info, start),
+            prefetch,
         )
 
+    async def _spawn_player(
+        self, track_info: TrackInfo, start: float = 0
+    ) -> AudioSource:
+        pipe = track_info.source is not None
+        source = track_info.source if pipe else track_info.download_url
+        opts = STREAM_FFMPEG_OPTS if track_info.stream and not pipe else FFMPEG_OPTS
+        if start > 0:
+            opts = {
+                **opts,
+                "before_options": f'{opts["before_options"]} -ss {start:.2f}',
+            }
+
+        if self.playback_mode == PLAYBACK_MODE_PCM:
+            # decoded to PCM and encoded to opus frame by frame in python, volume can be changed at any time
+            return PCMVolumeTransformer(
+                FFmpegPCMAudio(source, pipe=pipe, **opts), self.volume
+            )
+
+        if self.playback_mode == PLAYBACK_MODE_WORKER and self.encoder is not None:
+            # like PCM, but the volume and the opus encoding are applied by a worker process
+            return self.encoder.open(
+                FFmpegPCMAudio(source, pipe=pipe, **opts), self.volume
+            )
+
+        if self.volume != 1 or pipe:
+            # FFmpeg applies the volume and encodes to opus itself, pipes cannot be probed
+            options = opts["options"]
+            if self.volume != 1:
+                options = f"{options} -filter:a volume={self.volume}"
+            return FFmpegOpusAudio(
+                source,
+                bitrate=OPUS_BITRATE,
+                pipe=pipe,
+                before_options=opts["before_options"],
+                options=options,
+            )
+
+        if track_info.codec is not None:
+            # opus sources are passed through without transcoding
+            return FFmpegOpusAudio(
+                track_info.download_url,
+                bitrate=OPUS_BITRATE,
+                codec=track_info.codec,
+                **opts,
+            )
+        return await FFmpegOpusAudio.from_probe(track_info.download_url, **opts)
+
+    def can_rebuild_player(self) -> bool:
+        """Whether the current entry can be played again from a position, piped sources cannot."""
+        return self.current > 0 and self.get_current_info().source is None
+
+    async def rebuild_player(self, start: float) -> AudioSource:
+        """Build a new player of the current entry that starts start seconds into it,
+        e. g. to apply a new volume to the song that is playing.
+        """
+        return await self._build_player(self.get_current_info(), start=start)
+
     def as_prio_item(self):
         return PrioritizedItem(self.priority, self)
 
     def is_failed(self):
         return self.error is not None
 
+    def is_cancelled(self):
+        return self.cancelled
+
+    def cancel(self):
+        """Cancel the track, e. g. because it was removed from the queue.
+        Aborts the running before_build step like a pending extraction
+        and drops everything that was prefetched.
+        """
+        self.cancelled = True
+        self.invalidate()
+        if self._extended is not None:
+            self._extended.set()
+
+    def invalidate(self):
+        """Drop all prefetched entries and clean up players that were built ahead of time."""
+        prepared = self._prepared
+        self._prepared = {}
+        for index, task in prepared.items():
+            if not task.done():
+                # _prepare discards the entry once the cancellation arrives
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                player = task.result()
+                if player is not None:
+                    player.cleanup()
+                self._discard(self.info[index])
+
+    def _discard(self, track_info: TrackInfo):
+        if self.on_discard is not None:
+            try:
+                self.on_discard(track_info)
+            except Exception as e:
+                self.log.warning(f"Failed to discard {track_info}: {e}")
+
+    def prefetch(self, count=1, build_player=False):
+        """Resolve the next count entries in the background so that next() does not have to wait.
+        If build_player is set, the FFmpeg process is spawned ahead of time as well.
+        """
+        if self.cancelled or not self.prefetchable:
+            return
+        for index in range(self.current, min(self.current + count, self.length)):
+            if index not in self._prepared:
+                self._prepared[index] = ensure_future(
+                    self._prepare(self.info[index], build_player)
+                )
+
     def max_len(self):
         return self.length
 
@@ -90,9 +242,12 @@ class Track:
     def set_before_build(self, func: Callable[[TrackInfo], None]):
         self.before_build = func
 
-    def set_after_build(self, func: Callable[[TrackInfo, PCMVolumeTransformer], None]):
+    def set_after_build(self, func: Callable[[TrackInfo, AudioSource], None]):
         self.after_build = func
 
+    def set_on_discard(self, func: Callable[[TrackInfo], None]):
+        self.on_discard = func
+
     # get the info about the currently active track
     def get_current_info(self) -> TrackInfo:
         if self.current == 0:
@@ -102,20 +257,71 @@ class Track:
     def hasNext(self):
         return self.current < self.length
 
-    async def next(self):
-        if not self.hasNext():
-            return None
+    def hasMore(self):
+        """Like hasNext but also true while entries are still being added."""
+        return self.hasNext() or not self._complete
 
-        track_info = self.info[self.current]
+    def expect_more(self):
+        """Mark the track as incomplete. next() waits for extend() until complete() is called."""
+        self._complete = False
+        self._extended = Event()
 
+    def extend(self, info: List[TrackInfo]):
+        self.info.extend(info)
+        self.length = len(self.info)
+        if self._extended is not None:
+            self._extended.set()
+
+    def complete(self):
+        self._complete = True
+        if self._extended is not None:
+            self._extended.set()
+
+    async def _prepare(self, track_info: TrackInfo, build_player: bool):
         if self.before_build is not None:
+            await self.before_build(track_info)
+        if build_player:
             try:
-                await self.before_build(track_info)
-            except Exception as e:
-                self.error = e
-                return
+                return await self._build_player(track_info, prefetch=True)
+            except BaseException:
+                self._discard(track_info)
+                raise
+
+    async def next(self):
+        while not self.hasNext() and not self._complete and not self.cancelled:
+            self._extended.clear()
+            await self._extended.wait()
+
+        if not self.hasNext() or self.cancelled:
+            return None
 
-        self._player = self._build_player(track_info.download_url, track_info.stream)
+        index = self.current
+        track_info = self.info[index]
+
+        task = self._prepared.get(index)
+        if task is None:
+            task = self._prepared[index] = ensure_future(
+                self._prepare(track_info, False)
+            )
+
+        try:
+            player = await task
+        except CancelledError:
+            if not self.cancelled:
+                raise
+            return
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            if self._prepared.get(index) is task:
+                del self._prepared[index]
+
+        try:
+            self._player = player or await self._build_player(track_info)
+        except BaseException:
+            self._discard(track_info)
+            raise
 
         if self.after_build is not None:
             try:
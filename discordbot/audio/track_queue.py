@@ -51,29 +51,59 @@ class TrackQueue:
             self.queue[id] = AwarePriorityQueue(maxsize=self.maxsize, loop=self.loop)
         return self.queue[id]
 
+    def _cancel_all(self, queue: AwarePriorityQueue):
+        """Cancel all tracks that are still queued so no work is done for them anymore."""
+        while not queue.empty():
+            queue.get_nowait().item.cancel()
+            queue.task_done()
+
     def remove(self, id: str):
         """Remove the queue with id."""
         if self.has(id):
             self.log.info(f"Removing queue {id}")
+            self._cancel_all(self.queue[id])
             del self.queue[id]
 
     def clear(self, id: str):
-        """Clear the queue with id by removing the queue entirely."""
+        """Clear the queue with id by cancelling and dropping all queued tracks."""
         if self.has(id):
             self.log.info(f"Clearing queue {id}")
-            self.queue[id] = AwarePriorityQueue(maxsize=self.maxsize, loop=self.loop)
+            self._cancel_all(self.queue[id])
 
     def pop(self, id: str):
         """Pop the first item from the queue."""
         queue = self.queue.get(id)
         if queue is not None:
             try:
-                queue.get_nowait()
+                item = queue.get_nowait()
             except:
                 pass
             else:
+                item.item.cancel()
                 queue.task_done()
 
+    def peek(self, id: str) -> Optional[Track]:
+        """Returns the next track of the queue without removing it."""
+        queue = self.queue.get(id)
+        if queue is not None:
+            item = queue.peek()
+            if item is not None:
+                return item.item
+
+    def remove_at(self, id: str, position: int) -> Optional[Track]:
+        """Remove the track at position (starting at 1) of the queue."""
+        queue = self.queue.get(id)
+        if queue is None:
+            return None
+        entries = queue.entries()
+        if position < 1 or position > len(entries):
+            return None
+
+        entry = entries[position - 1]
+        queue.remove(entry)
+        entry.item.item.cancel()
+        return entry.item.item
+
     def task_done(self, id: str):
         if self.has(id):
             self.queue[id].task_done()
@@ -1,2 +1,4 @@
+from .api import *
+from .quota import *
 from .service import *
 from .track import *
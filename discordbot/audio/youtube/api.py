@@ -0,0 +1,52 @@
+import logging
+import threading
+from asyncio import wrap_future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+import httplib2
+from common.metrics import external_request
+from googleapiclient.http import HttpRequest
+
+DEFAULT_API_WORKERS = 8
+DEFAULT_API_TIMEOUT = 10
+DEFAULT_API_RETRIES = 1
+
+
+class YoutubeApiClient:
+    """Executes YouTube Data API requests on a thread pool instead of the event loop.
+    httplib2 connections are not thread-safe, so every worker thread owns its own
+    Http object which keeps its connections alive between requests.
+    """
+
+    log = logging.getLogger("youtube_api")
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_API_WORKERS,
+        timeout: float = DEFAULT_API_TIMEOUT,
+        num_retries: int = DEFAULT_API_RETRIES,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="youtube-api"
+        )
+        self.timeout = timeout
+        self.num_retries = num_retries
+        self._local = threading.local()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def _http(self) -> httplib2.Http:
+        http = getattr(self._local, "http", None)
+        if http is None:
+            self.log.debug(f"Creating http for {threading.current_thread().name}")
+            http = self._local.http = httplib2.Http(timeout=self.timeout)
+        return http
+
+    def _execute(self, req: HttpRequest) -> Dict[str, Any]:
+        with external_request("youtube_api"):
+            return req.execute(http=self._http(), num_retries=self.num_retries)
+
+    async def execute(self, req: HttpRequest) -> Dict[str, Any]:
+        return await wrap_future(self.executor.submit(self._execute, req))
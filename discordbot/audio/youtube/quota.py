@@ -0,0 +1,109 @@
+import logging
+import time
+from typing import Any, Dict
+
+DEFAULT_DAILY_QUOTA = 10000
+DEFAULT_QUOTA_RESERVE = 1000
+
+QUOTA_SEARCH = "search"
+QUOTA_LIST = "list"
+QUOTA_COSTS = {QUOTA_SEARCH: 100, QUOTA_LIST: 1}
+
+# the quota resets at midnight Pacific Time, daylight saving time is ignored
+QUOTA_RESET_UTC_OFFSET = -8 * 3600
+SECONDS_PER_DAY = 86400
+
+
+class QuotaBudget:
+    """Tracks the spend of the daily YouTube Data API quota.
+    Searches are only allowed while more than reserve units are left, so that
+    direct lookups keep working all day. Additionally searches are paced by a
+    token bucket that refills the searchable part of the quota over the day.
+    """
+
+    log = logging.getLogger("youtube_quota")
+    spent: Dict[str, int]
+
+    def __init__(
+        self,
+        daily_quota: int = DEFAULT_DAILY_QUOTA,
+        reserve: int = DEFAULT_QUOTA_RESERVE,
+        burst: int = None,
+    ):
+        self.daily_quota = daily_quota
+        self.reserve = min(reserve, daily_quota)
+        self.burst = burst if burst is not None else max(daily_quota // 10, 1)
+        self.rate = (daily_quota - self.reserve) / SECONDS_PER_DAY
+        self.spent = {}
+        self.denied = {}
+        self._day = self._current_day()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def _current_day(self) -> int:
+        return int((time.time() + QUOTA_RESET_UTC_OFFSET) // SECONDS_PER_DAY)
+
+    def _reset_if_new_day(self):
+        day = self._current_day()
+        if day != self._day:
+            self.log.info(f"Resetting quota, spent {self.spent} yesterday")
+            self._day = day
+            self.spent = {}
+            self.denied = {}
+            self._tokens = float(self.burst)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def remaining(self) -> int:
+        self._reset_if_new_day()
+        return max(self.daily_quota - sum(self.spent.values()), 0)
+
+    def seconds_until_reset(self) -> float:
+        now = time.time() + QUOTA_RESET_UTC_OFFSET
+        return SECONDS_PER_DAY - now % SECONDS_PER_DAY
+
+    def acquire(self, kind: str) -> bool:
+        """Spend the cost of a call of kind. Returns False if the budget does not allow the call."""
+        cost = QUOTA_COSTS[kind]
+        remaining = self.remaining
+        allowed = remaining >= cost
+
+        if allowed and kind == QUOTA_SEARCH:
+            self._refill()
+            allowed = remaining - cost >= self.reserve and self._tokens >= cost
+            if allowed:
+                self._tokens -= cost
+
+        if not allowed:
+            self.denied[kind] = self.denied.get(kind, 0) + 1
+            self.log.warn(f"Denied {kind} call, {remaining} units remaining")
+            return False
+
+        self.spent[kind] = self.spent.get(kind, 0) + cost
+        return True
+
+    def exhaust(self):
+        """Mark the quota as used up, e. g. because the API rejected a call."""
+        self._reset_if_new_day()
+        used = sum(self.spent.values())
+        if used < self.daily_quota:
+            self.spent["unaccounted"] = (
+                self.spent.get("unaccounted", 0) + self.daily_quota - used
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        remaining = self.remaining
+        self._refill()
+        return {
+            "daily_quota": self.daily_quota,
+            "remaining": remaining,
+            "reserve": self.reserve,
+            "search_tokens": int(self._tokens),
+            "spent": dict(self.spent),
+            "denied": dict(self.denied),
+            "resets_in": int(self.seconds_until_reset()),
+        }
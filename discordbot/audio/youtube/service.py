@@ -1,17 +1,30 @@
 import logging
 import os
 import re
+import time
 from typing import List
+from urllib.parse import parse_qs, urlparse
 
-import yt_dlp
+from common.cache import TTLCache
+from common.single_flight import SingleFlight
 from googleapiclient.errors import HttpError
 
+from ..audio_cache import AudioCache
+from ..extractor import ExtractionEngine
+from ..track import TrackInfo
+from .api import YoutubeApiClient
+from .quota import QUOTA_LIST, QUOTA_SEARCH, QuotaBudget
 from .track import YoutubeTrackInfo
 
 YOUTUBE_VIDEO_BASE_URL = "https://www.youtube.com/watch?v="
+YOUTUBE_THUMBNAIL_URL = "https://i.ytimg.com/vi/{id}/mqdefault.jpg"
 YOUTUBE_VIDEO_ID_REGEX = re.compile(r"^.*v=([^&]*).*$")
 YOUTUBE_PLAYLIST_ID_REGEX = re.compile(r"^.*list=([^&]*).*$")
 
+# resolved stream urls are dropped from the cache this many seconds before they expire
+URL_EXPIRY_MARGIN = 300
+DEFAULT_URL_TTL = 1800
+
 YTDL_OUTPUT_DIR = "./ytdl"
 YTDL_FORMAT_OPTS = {
     "format": "bestaudio/best",
@@ -43,24 +56,64 @@ def set_additional_ytdl_opts(*opts: str):
     return ydtl_opts
 
 
+def url_ttl(download_url: str) -> float:
+    """Returns how long a resolved stream url stays usable, based on its expire parameter."""
+    expire = parse_qs(urlparse(download_url).query).get("expire")
+    if expire is None:
+        return DEFAULT_URL_TTL
+    try:
+        return float(expire[0]) - time.time() - URL_EXPIRY_MARGIN
+    except ValueError:
+        return DEFAULT_URL_TTL
+
+
 class YouTubeError(Exception):
     def __init__(self, msg, thrown=None):
         super().__init__(msg)
         self.thrown = thrown
 
 
+class QuotaExceededError(YouTubeError):
+    pass
+
+
 class YoutubeService:
 
     log = logging.getLogger("svc")
 
-    def __init__(self, service, ytdl_opts=None):
+    def __init__(
+        self,
+        service,
+        ytdl_opts=None,
+        extractor: ExtractionEngine = None,
+        url_cache: TTLCache = None,
+        api: YoutubeApiClient = None,
+        flight: SingleFlight = None,
+        quota: QuotaBudget = None,
+        audio_cache: AudioCache = None,
+    ):
         self.service = service
-        self.ytdl = yt_dlp.YoutubeDL(ytdl_opts or YTDL_FORMAT_OPTS)
-
-    @classmethod
-    def new_with_credentials(cls, service, username: str, password: str):
+        self.ytdl_opts = ytdl_opts or YTDL_FORMAT_OPTS
+        self.extractor = extractor or ExtractionEngine()
+        self.url_cache = url_cache if url_cache is not None else TTLCache()
+        self.api = api or YoutubeApiClient()
+        self.flight = flight if flight is not None else SingleFlight()
+        self.quota = quota if quota is not None else QuotaBudget()
+        self.audio_cache = audio_cache
+
+    def with_credentials(self, username: str, password: str):
+        """Returns a service that uses the given account for yt-dlp and shares everything else."""
         ytdl_opts = set_additional_ytdl_opts("username", username, "password", password)
-        return cls(service, ytdl_opts)
+        return YoutubeService(
+            self.service,
+            ytdl_opts,
+            self.extractor,
+            self.url_cache,
+            self.api,
+            self.flight,
+            self.quota,
+            self.audio_cache,
+        )
 
     def __del__(self):
         self.service.close()
@@ -84,7 +137,7 @@ class YoutubeService:
         return None
 
     async def get_playlist_info(
-        self, id: str, max_entries=20
+        self, id: str, max_entries=20, guild_id: str = None
     ) -> List[YoutubeTrackInfo]:
         req = self.service.playlistItems().list(
             playlistId=id,
@@ -92,9 +145,21 @@ class YoutubeService:
             fields="items(snippet(title,thumbnails(medium),resourceId(videoId)))",
             maxResults=max_entries,
         )
-        return await self._fetch_video_info(req)
+        return await self.flight.do(
+            ("youtube_playlist", id, max_entries),
+            lambda: self._lookup(
+                QUOTA_LIST,
+                req,
+                f"https://www.youtube.com/playlist?list={id}",
+                max_entries,
+                guild_id,
+            ),
+            copy_result=True,
+        )
 
-    async def get_video_info(self, id: str) -> List[YoutubeTrackInfo]:
+    async def get_video_info(
+        self, id: str, guild_id: str = None
+    ) -> List[YoutubeTrackInfo]:
         self.log.info(f'Getting video info for id "{id}"')
         req = self.service.videos().list(
             id=id,
@@ -102,9 +167,17 @@ class YoutubeService:
             fields="items(id,snippet(title,thumbnails(medium)))",
             maxResults=1,
         )
-        return await self._fetch_video_info(req)
+        return await self.flight.do(
+            ("youtube_video", id),
+            lambda: self._lookup(
+                QUOTA_LIST, req, YOUTUBE_VIDEO_BASE_URL + id, 1, guild_id
+            ),
+            copy_result=True,
+        )
 
-    async def get_video_info_by_query(self, query: str) -> List[YoutubeTrackInfo]:
+    async def get_video_info_by_query(
+        self, query: str, guild_id: str = None
+    ) -> List[YoutubeTrackInfo]:
         self.log.info(f'Getting video info for query "{query}"')
         req = self.service.search().list(
             part="id,snippet",
@@ -113,30 +186,109 @@ class YoutubeService:
             q=query,
             maxResults=1,
         )
-        return await self._fetch_video_info(req)
+        return await self.flight.do(
+            ("youtube_search", " ".join(query.lower().split())),
+            lambda: self._lookup(QUOTA_SEARCH, req, f"ytsearch1:{query}", 1, guild_id),
+            copy_result=True,
+        )
 
-    async def get_info(self, url: str) -> List[YoutubeTrackInfo]:
+    async def get_info(self, url: str, guild_id: str = None) -> List[YoutubeTrackInfo]:
         if self.is_yt_playlist_url(url):
             id = self.url_to_playlist_id(url)
-            return await self.get_playlist_info(id)
+            return await self.get_playlist_info(id, guild_id=guild_id)
 
         elif self.is_yt_url(url):
             id = self.url_to_video_id(url)
         else:
             raise YouTubeError(f"Invalid input {url}")
 
-        return await self.get_video_info(id)
+        return await self.get_video_info(id, guild_id)
+
+    async def get_download_url(
+        self, info: YoutubeTrackInfo, stream=True, guild_id: str = None
+    ) -> List[YoutubeTrackInfo]:
+        """Resolves the download url of info. Concurrent requests for the same video share one extraction.
+        Videos in the audio cache are played from disk instead. Call record_play
+        once the player of the result has its input open, or release if it is dropped.
+        """
+        key = self.url_to_video_id(info.url) or info.url
+        use_cache = stream and self.audio_cache is not None
+
+        if use_cache:
+            path = await self.audio_cache.get(key)
+            if path is not None:
+                self.log.info(f'Playing "{key}" from the audio cache')
+                cached = YoutubeTrackInfo(
+                    info.url, info.title, info.thumbnail, path, "opus"
+                )
+                cached.stream = False
+                cached.cache_key = key
+                return [cached]
+
+        info_list = await self.flight.do(
+            ("youtube_download", key, stream),
+            lambda: self._get_download_url(key, info, stream, guild_id),
+            copy_result=True,
+        )
+        if use_cache and len(info_list) > 0:
+            info_list[0].cache_key = key
+        return info_list
+
+    def record_play(self, info: TrackInfo):
+        """Count a play of info for the audio cache. Called once its player has the input
+        open, which is also when the cached file of info no longer needs to be pinned.
+        """
+        if self.audio_cache is None or info.cache_key is None:
+            return
+        if info.stream:
+            self.audio_cache.record_play(info.cache_key, info.download_url, info.codec)
+        else:
+            self.audio_cache.release(info.cache_key)
 
-    async def get_download_url(self, info: YoutubeTrackInfo, stream=True):
-        return await self._extract_info(info, stream=stream)
+    def release(self, info: TrackInfo):
+        """Release the cached file of info if it will not be played."""
+        if self.audio_cache is not None and info.cache_key is not None:
+            if not info.stream:
+                self.audio_cache.release(info.cache_key)
+
+    async def _get_download_url(
+        self, key: str, info: YoutubeTrackInfo, stream: bool, guild_id: str
+    ) -> List[YoutubeTrackInfo]:
+        if not stream:
+            return await self._extract_info(info, stream=stream, guild_id=guild_id)
+
+        cached = self.url_cache.get(key)
+        if cached is not None:
+            self.log.info(f'Using cached download url for "{key}"')
+            return [
+                YoutubeTrackInfo(info.url, info.title, info.thumbnail, url, codec)
+                for url, codec in cached
+            ]
+
+        info_list = await self._extract_info(info, stream=stream, guild_id=guild_id)
+        if len(info_list) > 0:
+            self.url_cache.set(
+                key,
+                [[i.download_url, i.codec] for i in info_list],
+                ttl=min(url_ttl(i.download_url) for i in info_list),
+            )
+        return info_list
 
     async def _extract_info(
-        self, info: YoutubeTrackInfo, stream=True, max_entries=1, cur_try=0, max_try=3
+        self,
+        info: YoutubeTrackInfo,
+        stream=True,
+        max_entries=1,
+        cur_try=0,
+        max_try=3,
+        guild_id: str = None,
     ) -> List[YoutubeTrackInfo]:
         self.log.warn("Sending request via YTDL")
         try:
             cur_try += 1
-            data = self.ytdl.extract_info(info.url, download=not stream)
+            data = await self.extractor.extract(
+                guild_id, self.ytdl_opts, info.url, download=not stream
+            )
             info_list: List[YoutubeTrackInfo] = []
 
             self.log.debug(data)
@@ -145,38 +297,88 @@ class YoutubeService:
                 for data in data["entries"]:
                     if len(info_list) >= max_entries:
                         break
-                    download_url = (
-                        data["url"] if stream else self.ytdl.prepare_filename(data)
-                    )
+                    download_url = data["url"] if stream else data["filename"]
                     info_list.append(
                         YoutubeTrackInfo(
-                            info.url, info.title, info.thumbnail, download_url
+                            info.url,
+                            info.title,
+                            info.thumbnail,
+                            download_url,
+                            data.get("acodec"),
                         )
                     )
 
             else:
-                download_url = (
-                    data["url"] if stream else self.ytdl.prepare_filename(data)
-                )
+                download_url = data["url"] if stream else data["filename"]
                 info_list.append(
-                    YoutubeTrackInfo(info.url, info.title, info.thumbnail, download_url)
+                    YoutubeTrackInfo(
+                        info.url,
+                        info.title,
+                        info.thumbnail,
+                        download_url,
+                        data.get("acodec"),
+                    )
                 )
             return info_list
         except Exception as e:
-            if cur_try >= max_try:
-                self.log.warn("Failed to extract youtube info. Retrying...", e)
-                return self._extract_info(info, stream, max_entries, cur_try, max_try)
+            if cur_try < max_try:
+                self.log.warn(f"Failed to extract youtube info: {e}. Retrying...")
+                return await self._extract_info(
+                    info, stream, max_entries, cur_try, max_try, guild_id
+                )
             else:
                 self.log.error(
-                    "Failed to extract youtube info. Exceeded retry limit", e
+                    f"Failed to extract youtube info: {e}. Exceeded retry limit"
                 )
                 raise e
 
+    async def _lookup(
+        self, kind: str, req, ytdl_query: str, max_entries: int, guild_id: str
+    ) -> List[YoutubeTrackInfo]:
+        """Runs req if the quota budget allows it, otherwise ytdl_query is resolved with yt-dlp."""
+        if self.quota.acquire(kind):
+            try:
+                return await self._fetch_video_info(req)
+            except QuotaExceededError:
+                self.quota.exhaust()
+
+        return await self._fetch_video_info_with_ytdl(ytdl_query, max_entries, guild_id)
+
+    async def _fetch_video_info_with_ytdl(
+        self, query: str, max_entries: int, guild_id: str
+    ) -> List[YoutubeTrackInfo]:
+        self.log.warn(f'Resolving "{query}" via YTDL to save quota')
+        opts = {
+            **self.ytdl_opts,
+            "extract_flat": "in_playlist",
+            "noplaylist": False,
+            "playlistend": max_entries,
+        }
+        try:
+            data = await self.extractor.extract(guild_id, opts, query)
+        except Exception as e:
+            raise YouTubeError("Failed to fetch videos", e)
+
+        entries = data["entries"] if "entries" in data else [data]
+        info_list = [
+            YoutubeTrackInfo(
+                YOUTUBE_VIDEO_BASE_URL + entry["id"],
+                entry.get("title"),
+                YOUTUBE_THUMBNAIL_URL.format(id=entry["id"]),
+                "",
+            )
+            for entry in entries[:max_entries]
+            if entry is not None
+        ]
+        if len(info_list) == 0:
+            raise YouTubeError(f'No videos found for "{query}"')
+        return info_list
+
     async def _fetch_video_info(self, req) -> List[YoutubeTrackInfo]:
         info_list = []
         try:
             self.log.warn("Sending request to Youtube API")
-            res = req.execute()
+            res = await self.api.execute(req)
             self.log.debug(res)
 
             for item in res["items"]:
@@ -199,6 +401,8 @@ class YoutubeService:
                 info_list.append(info)
 
         except HttpError as e:
+            if e.status_code == 403 and "quotaExceeded" in str(e.error_details):
+                raise QuotaExceededError("Exceeded the YouTube quota", e)
             self.log.error(
                 f"failed to fetch videos failed with {e.status_code}: {e.error_details}"
             )
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from common.context import Context
 
@@ -6,8 +6,15 @@ from ..track import Track, TrackInfo
 
 
 class YoutubeTrackInfo(TrackInfo):
-    def __init__(self, url: str, title: str, thumbnail_url: str, download_url: str):
-        super().__init__(url, title, thumbnail_url, download_url)
+    def __init__(
+        self,
+        url: str,
+        title: str,
+        thumbnail_url: str,
+        download_url: str,
+        codec: Optional[str] = None,
+    ):
+        super().__init__(url, title, thumbnail_url, download_url, codec)
 
     def pretty_print(self):
         return f'"{self.title}"{" (" + self.url + ")" if self.url != "" else ""}'
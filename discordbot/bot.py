@@ -6,23 +6,37 @@ import os
 import signal
 import sys
 import traceback
-from typing import List
+from typing import List, Optional
 
 import boto3
 import discord
 import spotipy
 from audio import (
+    PLAYBACK_MODE_WORKER,
+    AudioCache,
+    EncoderPool,
+    ExtractionEngine,
     LinksService,
     QueueRunner,
+    QuotaBudget,
+    SpotifyMatchStore,
     SpotifyService,
     TextToSpeechService,
+    Track,
     TrackQueue,
+    YoutubeApiClient,
     YoutubeService,
 )
-from cogs import Config, Func, Music, TextToSpeech, Wikipedia
+from cogs import Config, Debug, Func, Music, TextToSpeech, Wikipedia
+from common.cache import TTLCache
 from common.config import ConfigMap
 from common.config_store import ConfigStore
 from common.context import Context
+from common.ffmpeg import FFmpegProcessManager, count_processes
+from common.loop_monitor import LoopMonitor
+from common.mediawiki import MediaWikiClient
+from common.metrics import REGISTRY, MetricsServer
+from common.single_flight import SingleFlight
 from discord.errors import HTTPException, NotFound
 from discord.ext import commands
 from discord.message import Attachment, Message
@@ -33,11 +47,13 @@ LEAVE_AFTER_INACTIVITY_DELAY = 120
 LEAVE_AFTER_INACTIVITY_DURATION = 600
 
 
-class Bot(commands.Bot):
+class Bot(commands.AutoShardedBot):
     configstore: ConfigStore
     config: ConfigMap
     queue: TrackQueue
     runner: QueueRunner
+    extractor: ExtractionEngine
+    url_cache: TTLCache
     log = logging.getLogger("bot")
 
     def __init__(
@@ -47,24 +63,69 @@ class Bot(commands.Bot):
         configstore: ConfigStore,
         configmap: ConfigMap = None,
         dir="./uploads/",
+        shard_ids: Optional[List[int]] = None,
+        shard_count: Optional[int] = None,
     ):
         intents = discord.Intents.default()
         intents.message_content = True
 
+        # without shard_ids all shards are run by this process
         super().__init__(
-            command_prefix=command_prefix, description=description, intents=intents
+            command_prefix=command_prefix,
+            description=description,
+            intents=intents,
+            shard_ids=shard_ids,
+            shard_count=shard_count,
         )
 
         self.dir = dir
-        self.config = configmap or ConfigMap(self, [])
+        self.config = configmap if configmap is not None else ConfigMap([])
         self.configstore = configstore
 
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
 
     async def handle_shutdown(self, *args):
-        self.config.persist(args)
-        await self.close()
+        """Stop the services and close the bot. A step that fails is logged and skipped,
+        e. g. if the signal arrived before setup_hook created the service.
+        """
+        steps = [
+            ("config", lambda: self.config.persist(args)),
+            ("extractor", lambda: self.extractor.shutdown()),
+            (
+                "youtube",
+                lambda: self.youtube is not None and self.youtube.api.shutdown(),
+            ),
+            ("spotify", lambda: self.spotify is not None and self.spotify.shutdown()),
+            ("links", lambda: self.links.shutdown()),
+            (
+                "spotify matches",
+                lambda: self.matches is not None and self.matches.close(),
+            ),
+            ("encoder", lambda: Track.encoder is not None and Track.encoder.shutdown()),
+            ("speech", lambda: self.speech.shutdown()),
+            ("url cache", lambda: self.url_cache.persist()),
+            (
+                "audio cache",
+                lambda: self.audio_cache is not None and self.audio_cache.shutdown(),
+            ),
+            ("wiki", lambda: self.wiki.close()),
+            ("metrics", lambda: self.metrics is not None and self.metrics.stop()),
+            (
+                "loop monitor",
+                lambda: self.loop_monitor is not None and self.loop_monitor.stop(),
+            ),
+        ]
+        try:
+            for name, step in steps:
+                try:
+                    result = step()
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception as e:
+                    self.log.error(f"Failed to shut down {name}: {e}")
+        finally:
+            await self.close()
 
     async def setup_hook(self):
         for signame in ("SIGINT", "SIGTERM"):
@@ -75,27 +136,76 @@ class Bot(commands.Bot):
                 ),
             )
 
+        Track.playback_mode = self.configstore.get_env_first("AUDIO_MODE", "opus")
+        if Track.playback_mode == PLAYBACK_MODE_WORKER:
+            Track.encoder = EncoderPool(
+                max_workers=int(
+                    self.configstore.get_env_first(
+                        "AUDIO_WORKERS", str(os.cpu_count() or 1)
+                    )
+                ),
+                streams_per_worker=int(
+                    self.configstore.get_env_first("AUDIO_STREAMS_PER_WORKER", "8")
+                ),
+            )
+
+        Track.ffmpeg = FFmpegProcessManager(
+            max_processes=int(
+                self.configstore.get_env_first("FFMPEG_MAX_PROCESSES", "64")
+            ),
+            reserved=int(self.configstore.get_env_first("FFMPEG_RESERVED", "2")),
+        )
+        self.loop.run_in_executor(None, Track.ffmpeg.warm_up)
+
         self.queue = TrackQueue(50, self.loop)
-        self.runner = QueueRunner(self, self.queue, self.loop)
+        self.runner = QueueRunner(
+            self,
+            self.queue,
+            self.loop,
+            prefetch_count=int(self.configstore.get_env_first("PREFETCH_COUNT", "2")),
+            prefetch_player=self.configstore.get_env_first("PREFETCH_PLAYER")
+            in ["true", "True"],
+        )
+        self.extractor = ExtractionEngine(
+            mode=self.configstore.get_env_first("EXTRACTOR_MODE", "thread"),
+            max_workers=int(self.configstore.get_env_first("EXTRACTOR_WORKERS", "4")),
+            guild_concurrency=int(
+                self.configstore.get_env_first("EXTRACTOR_GUILD_CONCURRENCY", "2")
+            ),
+        )
 
         await self.add_cog(Config(self))
         await self.add_cog(Func(self))
 
-        t2s = TextToSpeech(
-            self,
-            TextToSpeechService(
-                boto3.client(
-                    "polly",
-                    aws_access_key_id=self.configstore.get("ACCESS_KEY"),
-                    aws_secret_access_key=self.configstore.get("SECRET_KEY"),
-                    region_name="eu-central-1",
+        self.speech = TextToSpeechService(
+            boto3.client(
+                "polly",
+                aws_access_key_id=self.configstore.get("ACCESS_KEY"),
+                aws_secret_access_key=self.configstore.get("SECRET_KEY"),
+                region_name="eu-central-1",
+            ),
+            max_bytes=int(
+                self.configstore.get_env_first(
+                    "POLLY_CACHE_MAX_BYTES", str(100 * 1024 * 1024)
                 )
             ),
+            parallelism=int(self.configstore.get_env_first("POLLY_PARALLELISM", "2")),
         )
+        t2s = TextToSpeech(self, self.speech)
         await self.add_cog(t2s)
-        await self.add_cog(Wikipedia(self, t2s))
+        self.wiki = MediaWikiClient(
+            TTLCache(
+                maxsize=int(self.configstore.get_env_first("WIKI_CACHE_SIZE", "512")),
+                ttl=int(self.configstore.get_env_first("WIKI_CACHE_TTL", "3600")),
+            )
+        )
+        await self.add_cog(Wikipedia(self, self.wiki, t2s))
+
+        # coalesces identical concurrent lookups of all services
+        self.flight = SingleFlight()
 
         spotify = None
+        matches = None
         SPOTIFY_CLIENT_ID = self.configstore.get("SPOTIFY_CLIENT_ID")
         SPOTIFY_CLIENT_SECRET = self.configstore.get("SPOTIFY_CLIENT_SECRET")
 
@@ -105,31 +215,179 @@ class Bot(commands.Bot):
                     client_id=SPOTIFY_CLIENT_ID, client_secret=SPOTIFY_CLIENT_SECRET
                 )
             )
-            spotify = SpotifyService(s)
+            spotify = SpotifyService(
+                s,
+                max_entries=int(
+                    self.configstore.get_env_first("SPOTIFY_MAX_ENTRIES", "1000")
+                ),
+                flight=self.flight,
+            )
+            matches = SpotifyMatchStore(
+                self.configstore.get_env_first(
+                    "SPOTIFY_MATCHES_FILE", "spotify_matches.db"
+                )
+            )
+
+        self.url_cache = TTLCache(
+            maxsize=int(self.configstore.get_env_first("URL_CACHE_SIZE", "2048")),
+            filename=self.configstore.get_env_first("URL_CACHE_FILE"),
+        )
+        self.url_cache.load()
+
+        self.audio_cache = None
+        AUDIO_CACHE_DIR = self.configstore.get_env_first("AUDIO_CACHE_DIR")
+        if AUDIO_CACHE_DIR is not None:
+            self.audio_cache = AudioCache(
+                AUDIO_CACHE_DIR,
+                max_bytes=int(
+                    self.configstore.get_env_first(
+                        "AUDIO_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)
+                    )
+                ),
+                min_plays=int(
+                    self.configstore.get_env_first("AUDIO_CACHE_MIN_PLAYS", "2")
+                ),
+            )
+            self.audio_cache.load()
 
         youtube = None
         YOUTUBE_API_KEY = self.configstore.get("YOUTUBE_API_KEY")
         if YOUTUBE_API_KEY is not None:
             service = build("youtube", "v3", developerKey=YOUTUBE_API_KEY)
-            youtube = YoutubeService(service)
+            youtube = YoutubeService(
+                service,
+                extractor=self.extractor,
+                url_cache=self.url_cache,
+                api=YoutubeApiClient(
+                    max_workers=int(
+                        self.configstore.get_env_first("YOUTUBE_API_WORKERS", "8")
+                    )
+                ),
+                flight=self.flight,
+                audio_cache=self.audio_cache,
+                quota=QuotaBudget(
+                    daily_quota=int(
+                        self.configstore.get_env_first("YOUTUBE_DAILY_QUOTA", "10000")
+                    ),
+                    reserve=int(
+                        self.configstore.get_env_first("YOUTUBE_QUOTA_RESERVE", "1000")
+                    ),
+                ),
+            )
+
+        links = LinksService(
+            flight=self.flight,
+            timeout=int(self.configstore.get_env_first("STREAMLINK_TIMEOUT", "15")),
+            cache=TTLCache(
+                maxsize=256,
+                ttl=int(self.configstore.get_env_first("STREAM_URL_TTL", "300")),
+            ),
+        )
 
-        links = LinksService()
+        # their executors are shut down with the bot
+        self.youtube = youtube
+        self.spotify = spotify
+        self.links = links
+        self.matches = matches
 
-        music = Music(self, youtube, spotify, links)
+        music = Music(self, youtube, spotify, links, matches)
         await self.add_cog(music)
 
+        self.metrics = None
+        METRICS_PORT = self.configstore.get_env_first("METRICS_PORT")
+        if METRICS_PORT is not None:
+            self.register_metrics()
+            self.metrics = MetricsServer(
+                int(METRICS_PORT),
+                self.configstore.get_env_first("METRICS_HOST", "127.0.0.1"),
+            )
+            await self.metrics.start()
+
         debug_enabled = self.configstore.get_env_first("DEBUG") in ["true", "True"]
-        debug_enabled = True
+
+        self.loop_monitor = None
+        if debug_enabled or self.configstore.get_env_first("LOOP_MONITOR") in [
+            "true",
+            "True",
+        ]:
+            self.loop_monitor = LoopMonitor(
+                self.loop,
+                threshold=float(
+                    self.configstore.get_env_first("LOOP_MONITOR_THRESHOLD", "0.1")
+                ),
+            )
+            self.loop_monitor.start()
+
         if debug_enabled:
-            self.log.warn("Currently no debugging cog available")
+            await self.add_cog(Debug(self, self.loop_monitor))
+
+    def register_metrics(self):
+        """Register the gauges that are read from the state of the bot when they are scraped."""
+        REGISTRY.gauge(
+            "discordbot_queue_depth",
+            "Number of tracks queued per guild",
+            ["guild"],
+            lambda: {(id,): self.queue.size(id) for id in list(self.queue.keys())},
+        )
+        REGISTRY.gauge(
+            "discordbot_shard_latency_seconds",
+            "Gateway latency per shard of this process",
+            ["shard"],
+            lambda: {(id,): latency for id, latency in self.latencies},
+        )
+        REGISTRY.gauge(
+            "discordbot_voice_clients",
+            "Number of connected voice clients",
+            callback=lambda: {(): len(self.voice_clients)},
+        )
+        if Track.encoder is not None:
+            REGISTRY.gauge(
+                "discordbot_audio_worker_streams",
+                "Number of streams encoded per audio worker",
+                ["worker"],
+                lambda: {(w,): n for w, n in Track.encoder.stats()["streams"].items()},
+            )
+        REGISTRY.gauge(
+            "discordbot_ffmpeg_processes",
+            "Number of running FFmpeg processes",
+            callback=lambda: {(): count_processes("ffmpeg")},
+        )
+        # reads /proc for every process, so it is only collected once per scrape
+        ffmpeg_stats = REGISTRY.once_per_scrape(Track.ffmpeg.stats)
+        REGISTRY.gauge(
+            "discordbot_ffmpeg_player_processes",
+            "Number of FFmpeg processes of players by state",
+            ["state"],
+            lambda: {
+                (state,): ffmpeg_stats()[state]
+                for state in ("running", "pending", "prefetched")
+            },
+        )
+        REGISTRY.gauge(
+            "discordbot_ffmpeg_player_cpu_seconds",
+            "CPU time used by the running FFmpeg processes of players",
+            callback=lambda: {(): ffmpeg_stats()["cpu_seconds"]},
+        )
+        REGISTRY.gauge(
+            "discordbot_ffmpeg_player_rss_bytes",
+            "Resident memory of the running FFmpeg processes of players",
+            callback=lambda: {(): ffmpeg_stats()["rss_bytes"]},
+        )
+        extractor_stats = REGISTRY.once_per_scrape(self.extractor.stats)
+        REGISTRY.gauge(
+            "discordbot_extractions",
+            "Number of yt-dlp extractions by state",
+            ["state"],
+            lambda: {
+                ("waiting",): extractor_stats()["waiting"],
+                ("running",): extractor_stats()["running"],
+            },
+        )
 
     async def on_ready(self):
-        self.log.info(f"Logged in as {self.user.name} with id {self.user.id}")
-
-        for guild in self.guilds:
-            id = guild.id
-            if not self.config.exists(id):
-                self.config.set_defaults_for(id)
+        self.log.info(
+            f"Logged in as {self.user.name} with id {self.user.id} on shards {list(self.shards.keys())} of {self.shard_count}"
+        )
 
         self.loop.create_task(self.leave_after_inactivity())
 
@@ -177,11 +435,21 @@ class Bot(commands.Bot):
             except (HTTPException, NotFound) as e:
                 raise commands.CommandError("unable to handle attachment", e)
 
+    async def on_voice_state_update(
+        self,
+        member: discord.Member,
+        before: discord.VoiceState,
+        after: discord.VoiceState,
+    ):
+        if member.id == self.user.id:
+            self.runner.notify(member.guild.id)
+
     async def join_author(self, ctx: commands.Context):
         if ctx.author.voice:
             if ctx.voice_client is not None:
                 return await ctx.voice_client.move_to(ctx.author.voice.channel)
             await ctx.author.voice.channel.connect()
+            self.runner.notify(ctx.guild.id)
         else:
             await ctx.send("You are not connected to a voice channel")
 
@@ -223,7 +491,7 @@ class Bot(commands.Bot):
                         ]
 
                         await voice_client.disconnect()
-                        self.queue.remove(id)
+                        self.runner.remove(id)
                         left.append(id)
 
             for id in left:
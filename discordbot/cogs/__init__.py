@@ -1,4 +1,5 @@
 from .config import *
+from .debug import *
 from .func import *
 from .music import *
 from .text_to_speech import *
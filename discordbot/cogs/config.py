@@ -49,12 +49,8 @@ class Config(commands.Cog):
             return
         val = val.strip()
         try:
-            if not self.bot.config.exists(id):
-                self.log.info(f"{id} - Setting initial config with {key}={val}")
-                self.bot.config.add_config_for(id, {key: val})
-            else:
-                self.log.info(f"{id} - Updating config with {key}={val}")
-                self.bot.config.update_config_for(id, key, val)
+            self.log.info(f"{id} - Updating config with {key}={val}")
+            await self.bot.config.update_config_for(id, key, val)
 
         except ConfigValidationError as e:
             return await ctx.reply_formatted_error(f"{e}", error_title="Config Error")
@@ -69,22 +65,19 @@ class Config(commands.Cog):
         id = await self.get_session_ctx_guild_id(ctx)
         if id is None:
             return
-        if self.bot.config.exists(id):
-            if len(args) <= 0:
-                val = self.bot.config.get_config_for(id)
-                return await ctx.send(f"Current config is {val}")
-            key = args[0]
-            val = self.bot.config.get_config_for(id, key)
-            return await ctx.send(f"Current config for {key} is {val}")
+        if len(args) <= 0:
+            val = await self.bot.config.get_config_for(id)
+            return await ctx.send(f"Current config is {val}")
+        key = args[0]
+        val = await self.bot.config.get_config_for(id, key)
+        return await ctx.send(f"Current config for {key} is {val}")
 
     @commands.Command
     @commands.dm_only()
     async def reset(self, ctx: Context):
         """Reset the config to default"""
         id = ctx.message.guild.id
-        if self.bot.config.exists(id):
-            self.bot.config.remove_config_for(id)
-            self.bot.config.set_defaults_for(id)
+        await self.bot.config.remove_config_for(id)
         return await ctx.tick(True)
 
     @commands.Command
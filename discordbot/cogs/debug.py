@@ -0,0 +1,62 @@
+import datetime
+import logging
+
+from audio.track import Track
+from common.context import Context
+from common.loop_monitor import LoopMonitor
+from discord.ext import commands
+
+MAX_MESSAGE_LENGTH = 1900
+
+
+class Debug(commands.Cog):
+    def __init__(self, bot: commands.Bot, monitor: LoopMonitor = None):
+        self.log = logging.getLogger("cog")
+        self.bot = bot
+        self.monitor = monitor
+
+    async def cog_check(self, ctx: Context) -> bool:
+        # checks on the class are ignored, only the ones of commands and cog_check are run
+        return await commands.has_permissions(administrator=True).predicate(ctx)
+
+    @commands.command()
+    async def blocking(self, ctx: Context, index: int = 0):
+        """Show how long the event loop was blocked recently. Pass the position of a report to see its stack."""
+        if self.monitor is None:
+            return await ctx.reply_formatted_error("The loop monitor is not running")
+
+        reports = list(reversed(self.monitor.reports))
+        if index > 0:
+            if index > len(reports):
+                return await ctx.reply_formatted_error(f"There is no report #{index}")
+            stack = "".join(reports[index - 1].stack)[-MAX_MESSAGE_LENGTH:]
+            return await ctx.send(f"```\n{stack}\n```")
+
+        lag = self.monitor.lag.stats()
+        lines = [
+            f'Lag: p50 {lag["p50"] * 1000:.1f}ms, p95 {lag["p95"] * 1000:.1f}ms, max {lag["max"] * 1000:.1f}ms',
+            f"Blocked longer than {self.monitor.threshold * 1000:.0f}ms: {len(reports)} times",
+        ]
+        for position, report in enumerate(reports[:10], 1):
+            at = datetime.datetime.fromtimestamp(report.started_at).strftime("%H:%M:%S")
+            lines.append(f"#{position} {at} {report.pretty_print()}")
+
+        await ctx.reply_formatted_msg(
+            "\n".join(lines)[:MAX_MESSAGE_LENGTH], title="Event Loop"
+        )
+
+    @commands.command()
+    async def ffmpeg(self, ctx: Context):
+        """Show the FFmpeg processes of the players with their CPU time and memory."""
+        if Track.ffmpeg is None:
+            return await ctx.reply_formatted_error("FFmpeg processes are not tracked")
+
+        stats = Track.ffmpeg.stats()
+        lines = [
+            f'{stats["running"]} of {Track.ffmpeg.max_processes} running, {stats["pending"]} starting',
+            f'cpu {stats["cpu_seconds"]:.1f}s, rss {stats["rss_bytes"] / 2**20:.1f}MB',
+        ]
+        lines.extend(Track.ffmpeg.pretty_print()[:20])
+        await ctx.reply_formatted_msg(
+            "\n".join(lines)[:MAX_MESSAGE_LENGTH], title="FFmpeg"
+        )
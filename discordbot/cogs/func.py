@@ -22,6 +22,7 @@ class Func(commands.Cog):
         if ctx.voice_client is not None:
             return await ctx.voice_client.move_to(channel)
         await channel.connect()
+        self.bot.runner.notify(ctx.guild.id)
 
     @commands.command()
     async def summon(self, ctx):
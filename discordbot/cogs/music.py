@@ -1,22 +1,39 @@
 import logging
-from typing import List
+from asyncio import Task
+from typing import AsyncIterator, List, Set
 
 from audio import (
+    FirstFrameSource,
     LinksService,
     PrioritizedItem,
+    SpotifyError,
+    SpotifyMatch,
+    SpotifyMatchStore,
     SpotifyService,
     SpotifyTrackInfo,
     Track,
     TrackInfo,
+    WorkerOpusSource,
     YoutubeService,
     YoutubeTrackInfo,
 )
+from audio.youtube.service import YOUTUBE_VIDEO_BASE_URL
 from cogs import Context
 from cogs.utils import reply_track_list
 from common.context import Context
+from common.metrics import REGISTRY, StageTimer
+from discord import PCMVolumeTransformer
 from discord.embeds import Embed
 from discord.ext import commands
 
+REPLACED_PLAYER_CLEANUP_DELAY = 1
+
+STREAM_STAGE_SECONDS = REGISTRY.histogram(
+    "discordbot_stream_stage_seconds",
+    "Duration of the stages of the stream command",
+    ["stage"],
+)
+
 
 def extract_embedded_info(ctx: Context) -> TrackInfo:
     embeds: List[Embed] = ctx.message.embeds
@@ -33,11 +50,83 @@ class Music(commands.Cog):
         youtube: YoutubeService = None,
         spotify: SpotifyService = None,
         links: LinksService = None,
+        matches: SpotifyMatchStore = None,
     ):
         self.bot = bot
         self.youtube = youtube
         self.spotify = spotify
         self.links = links
+        self.matches = matches
+        self.background_tasks: Set[Task] = set()
+
+    async def enqueue_remaining(
+        self, track: Track, pages: AsyncIterator[List[SpotifyTrackInfo]]
+    ):
+        """Add the remaining pages to an already queued track until it is cancelled."""
+        try:
+            async for page in pages:
+                if track.is_cancelled():
+                    break
+                self.log.info(f"Adding {len(page)} more entries to {track}")
+                track.extend(page)
+        except Exception as e:
+            self.log.error(f"Failed to load remaining entries: {e}")
+        finally:
+            await pages.aclose()
+            track.complete()
+
+    async def resolve_download_url(
+        self, youtube_svc: YoutubeService, info: YoutubeTrackInfo, guild_id: str
+    ) -> YoutubeTrackInfo:
+        with STREAM_STAGE_SECONDS.time("resolve"):
+            return (await youtube_svc.get_download_url(info, True, guild_id=guild_id))[
+                0
+            ]
+
+    def use_audio_cache(self, youtube_svc: YoutubeService, track: Track):
+        """Count the plays of the resolved videos of track for the audio cache
+        and release their cached files once FFmpeg opened them.
+        """
+
+        async def record_play(track_info: TrackInfo, player):
+            youtube_svc.record_play(track_info)
+
+        track.set_after_build(record_play)
+        track.set_on_discard(youtube_svc.release)
+
+    async def match_spotify_track(
+        self,
+        youtube_svc: YoutubeService,
+        track_info: SpotifyTrackInfo,
+        guild_id: str = None,
+    ) -> YoutubeTrackInfo:
+        """Find the YouTube video for a Spotify track. Stored matches are preferred over a search."""
+        if self.matches is not None:
+            match = await self.matches.get(track_info)
+            if match is not None:
+                return YoutubeTrackInfo(
+                    YOUTUBE_VIDEO_BASE_URL + match.video_id,
+                    match.title,
+                    match.thumbnail,
+                    "",
+                )
+
+        youtube_info = (
+            await youtube_svc.get_video_info_by_query(
+                f"{track_info.artist} - {track_info.name}", guild_id
+            )
+        )[0]
+
+        if self.matches is not None:
+            self.matches.put(
+                track_info,
+                SpotifyMatch(
+                    youtube_svc.url_to_video_id(youtube_info.url),
+                    youtube_info.title,
+                    youtube_info.thumbnail,
+                ),
+            )
+        return youtube_info
 
     @commands.command()
     async def volume(self, ctx, volume: int):
@@ -45,7 +134,38 @@ class Music(commands.Cog):
         if ctx.voice_client is None:
             return await ctx.send("Not connected to a voice channel.")
 
-        ctx.voice_client.source.volume = volume / 100
+        # the runner wraps the player to measure when its first frame is read
+        source = getattr(ctx.voice_client.source, "inner", ctx.voice_client.source)
+        if isinstance(source, (PCMVolumeTransformer, WorkerOpusSource)):
+            source.volume = volume / 100
+            return await ctx.send(f"Changed volume to {volume}%")
+
+        # the volume of opus sources is applied by FFmpeg when the player is built
+        track = self.bot.runner.playing_tracks.get(ctx.guild.id)
+        if track is None:
+            return await ctx.send("Nothing is playing.")
+        track.volume = volume / 100
+
+        playing = ctx.voice_client.source
+        if not isinstance(playing, FirstFrameSource) or not track.can_rebuild_player():
+            return await ctx.send(
+                f"Changed volume to {volume}%, starting with the next song"
+            )
+
+        # continue the song where it is with a player that applies the new volume
+        player = await track.rebuild_player(playing.position)
+        if ctx.voice_client is None or ctx.voice_client.source is not playing:
+            # the song ended or was skipped in the meantime
+            player.cleanup()
+            return await ctx.send(
+                f"Changed volume to {volume}%, starting with the next song"
+            )
+        ctx.voice_client.source = FirstFrameSource(player, None, playing.frames)
+        # a read of the player thread may still be in progress, let it finish first
+        self.bot.loop.call_later(
+            REPLACED_PLAYER_CLEANUP_DELAY,
+            lambda: self.bot.loop.run_in_executor(None, playing.cleanup),
+        )
         await ctx.send(f"Changed volume to {volume}%")
 
     @commands.command()
@@ -53,7 +173,7 @@ class Music(commands.Cog):
         """Command the bot to disconnect from the voice channel"""
         if ctx.voice_client is not None:
             await ctx.voice_client.disconnect()
-        self.bot.queue.remove(ctx.message.guild.id)
+        self.bot.runner.remove(ctx.message.guild.id)
 
     @commands.command()
     async def pause(self, ctx: commands.Context):
@@ -79,9 +199,12 @@ class Music(commands.Cog):
             ctx.voice_client.resume()
 
     @commands.command()
-    async def remove(self, ctx: Context):
-        """Remove the next track. If the next track is part of a playlist, remove the entire playlist."""
-        self.bot.queue.pop(ctx.message.guild.id)
+    async def remove(self, ctx: Context, position: int = 1):
+        """Remove the track at the given position of the queue (default: the next one). If it is part of a playlist, remove the entire playlist."""
+        if position == 1:
+            self.bot.queue.pop(ctx.message.guild.id)
+        elif self.bot.queue.remove_at(ctx.message.guild.id, position) is None:
+            return await ctx.tick(False)
         await ctx.tick(True)
 
     @commands.command()
@@ -107,9 +230,25 @@ class Music(commands.Cog):
                 content = self.bot.queue.content(id)
                 items: List[PrioritizedItem] = content
                 tracks = [i.item for i in items]
-                tracks.reverse()
                 await reply_track_list(ctx, tracks)
 
+    @commands.command()
+    async def quota(self, ctx: Context):
+        """Show how much of the daily YouTube quota is left."""
+        if self.youtube is None:
+            return await ctx.reply_formatted_error("YouTube is not configured")
+
+        stats = self.youtube.quota.stats()
+        spent = ", ".join(f"{k}: {v}" for k, v in stats["spent"].items()) or "-"
+        hours, rest = divmod(stats["resets_in"], 3600)
+        await ctx.reply_formatted_msg(
+            f'Remaining: {stats["remaining"]}/{stats["daily_quota"]} units\n'
+            f"Spent: {spent}\n"
+            f'Searches fall back to yt-dlp below {stats["reserve"]} units\n'
+            f"Resets in {hours}h {rest // 60}m",
+            title="YouTube Quota",
+        )
+
     @commands.command()
     async def play(self, ctx: Context, *, query_or_url: str):
         """Alias for stream"""
@@ -123,71 +262,85 @@ class Music(commands.Cog):
             await self.bot.join_author(ctx)
 
         async with ctx.typing():
+            stages = StageTimer(STREAM_STAGE_SECONDS)
             info = extract_embedded_info(ctx)
             id = ctx.guild.id
+            pages = None
 
-            username = self.bot.config.get_config_for(
+            username = await self.bot.config.get_config_for(
                 id, key="youtubeUsername", default=None
             )
-            password = self.bot.config.get_config_for(
+            password = await self.bot.config.get_config_for(
                 id, key="youtubePassword", default=None
             )
             if username is not None and password is not None:
-                youtube_svc = YoutubeService.new_with_credentials(
-                    self.youtube.service, username, password
-                )
+                youtube_svc = self.youtube.with_credentials(username, password)
             else:
                 youtube_svc = self.youtube
 
             try:
                 if self.spotify.is_spotify_url(query_or_url):
                     self.log.info("input is a spotify url")
-                    spotify_info_list = await self.spotify.get_info(query_or_url)
+                    stages.mark("classify")
+                    pages = self.spotify.iter_info_pages(query_or_url)
+                    try:
+                        spotify_info_list = await pages.__anext__()
+                    except StopAsyncIteration:
+                        raise SpotifyError(f"No playable tracks in {query_or_url}")
+                    stages.mark("metadata")
 
                     track = Track(ctx, spotify_info_list)
+                    track.expect_more()
 
                     async def fetch_download_url(track_info: SpotifyTrackInfo):
                         self.log.debug(f"Running before_build: {track_info}")
-                        youtube_info = (
-                            await youtube_svc.get_video_info_by_query(
-                                f"{track_info.artist} - {track_info.name}"
-                            )
-                        )[0]
-                        youtube_download_info = (
-                            await youtube_svc.get_download_url(youtube_info, True)
-                        )[0]
+                        youtube_info = await self.match_spotify_track(
+                            youtube_svc, track_info, id
+                        )
+                        youtube_download_info = await self.resolve_download_url(
+                            youtube_svc, youtube_info, id
+                        )
 
                         track_info.title = youtube_info.title
                         track_info.download_url = youtube_download_info.download_url
+                        track_info.codec = youtube_download_info.codec
+                        track_info.stream = youtube_download_info.stream
+                        track_info.cache_key = youtube_download_info.cache_key
                         track_info.thumbnail = youtube_info.thumbnail
 
                     track.set_before_build(fetch_download_url)
 
                 elif youtube_svc.is_yt_url(query_or_url):
                     self.log.info("input is a youtube url")
+                    stages.mark("classify")
 
                     if youtube_svc.is_yt_playlist_url(query_or_url) or info is None:
                         self.log.info(
                             "embedded info is insufficient. Fetching info from Youtube."
                         )
-                        info = await youtube_svc.get_info(query_or_url)
+                        info = await youtube_svc.get_info(query_or_url, id)
                     else:
                         info.url = query_or_url
+                    stages.mark("metadata")
 
                     track = Track(ctx, info)
 
                     async def fetch_download_url(track_info: YoutubeTrackInfo):
                         self.log.debug(f"Running before_build: {track_info}")
-                        youtube_info = (
-                            await youtube_svc.get_download_url(track_info, True)
-                        )[0]
+                        youtube_info = await self.resolve_download_url(
+                            youtube_svc, track_info, id
+                        )
                         track_info.title = youtube_info.title
                         track_info.download_url = youtube_info.download_url
+                        track_info.codec = youtube_info.codec
+                        track_info.stream = youtube_info.stream
+                        track_info.cache_key = youtube_info.cache_key
                         track_info.thumbnail = youtube_info.thumbnail
 
                     track.set_before_build(fetch_download_url)
 
                 elif "soundcloud" in query_or_url:
+                    stages.mark("classify")
                     if info is None:
                         info = TrackInfo(
                             query_or_url,
@@ -199,18 +352,23 @@ class Music(commands.Cog):
 
                     async def fetch_download_url(track_info: YoutubeTrackInfo):
                         self.log.debug(f"Running before_build: {track_info}")
-                        youtube_info = (
-                            await youtube_svc.get_download_url(track_info, True)
-                        )[0]
+                        youtube_info = await self.resolve_download_url(
+                            youtube_svc, track_info, id
+                        )
                         track_info.title = youtube_info.title
                         track_info.download_url = youtube_info.download_url
+                        track_info.codec = youtube_info.codec
+                        track_info.stream = youtube_info.stream
+                        track_info.cache_key = youtube_info.cache_key
                         track_info.thumbnail = youtube_info.thumbnail
 
                     track.set_before_build(fetch_download_url)
 
                 elif self.links.is_url(query_or_url):
                     self.log.info("input is a url")
-                    stream_url = self.links.find_stream(query_or_url)
+                    stages.mark("classify")
+                    stream_url = await self.links.find_stream(query_or_url)
+                    stages.mark("resolve")
                     if info is None:
                         info = TrackInfo(
                             query_or_url,
@@ -223,18 +381,35 @@ class Music(commands.Cog):
 
                 else:
                     self.log.info("input is a query")
+                    stages.mark("classify")
                     youtube_info = (
-                        await youtube_svc.get_video_info_by_query(query_or_url)
+                        await youtube_svc.get_video_info_by_query(query_or_url, id)
                     )[0]
-                    youtube_download_info = await youtube_svc.get_download_url(
-                        youtube_info
-                    )
-                    track = Track(ctx, youtube_download_info)
+                    stages.mark("metadata")
+                    track = Track(ctx, youtube_info)
+
+                    async def fetch_download_url(track_info: YoutubeTrackInfo):
+                        self.log.debug(f"Running before_build: {track_info}")
+                        youtube_info = await self.resolve_download_url(
+                            youtube_svc, track_info, id
+                        )
+                        track_info.download_url = youtube_info.download_url
+                        track_info.codec = youtube_info.codec
+                        track_info.stream = youtube_info.stream
+                        track_info.cache_key = youtube_info.cache_key
+
+                    track.set_before_build(fetch_download_url)
 
             except Exception as e:
                 self.log.error(e)
+                if pages is not None:
+                    await pages.aclose()
                 return await ctx.reply_formatted_error(e, "Error")
 
+            # all tracks with a before_build are resolved by the YoutubeService
+            if track.before_build is not None:
+                self.use_audio_cache(youtube_svc, track)
+
             id = ctx.guild.id
 
             if not self.bot.queue.has(id):
@@ -242,9 +417,24 @@ class Music(commands.Cog):
 
             tracks_count = len(track)
             self.log.info(f"Trying to enqueue {tracks_count} track(s) for {id}")
-            await self.bot.queue.put(id, track)
+            try:
+                await self.bot.queue.put(id, track)
+            except Exception:
+                # the remaining pages are only loaded for an enqueued track
+                if pages is not None:
+                    await pages.aclose()
+                raise
+            stages.mark("enqueue")
             self.log.info(f"Successfully enqueued {tracks_count} track(s) for {id}")
 
+            if pages is not None:
+                task = self.bot.loop.create_task(self.enqueue_remaining(track, pages))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+
+            if ctx.voice_client is not None and ctx.voice_client.is_playing():
+                self.bot.runner.prefetch(id)
+
             if tracks_count > 1:
                 await ctx.reply_formatted_msg(
                     f"Successfully enqueued {tracks_count} tracks."
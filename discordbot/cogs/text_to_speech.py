@@ -1,6 +1,6 @@
 import logging
 
-from audio import TextToSpeechService, Track
+from audio import TextToSpeechService, Track, TrackInfo
 from common.context import Context
 from discord.ext import commands
 
@@ -34,19 +34,59 @@ class TextToSpeech(commands.Cog):
                 f"Length of message cannot exceed {self.max_characters}"
             )
 
+        await self.speak(ctx, message)
+
+    async def speak(self, ctx: Context, message: str):
+        """Queue message for playback. Unlike say its length is not limited."""
         async with ctx.typing():
             id = ctx.message.guild.id
 
-            lang_code = self.bot.config.get_config_for(
+            lang_code = await self.bot.config.get_config_for(
                 id, key="languageCode", default=self.languageCode
             )
-            voice_id = self.bot.config.get_config_for(
+            voice_id = await self.bot.config.get_config_for(
                 id, key="voiceId", default=self.voiceId
             )
 
-            info = self.service.synthesize_speech(id, message, lang_code, voice_id)
+            info = TrackInfo("", "SynthesizeSpeech")
             info.stream = False
             track = Track(ctx, info)
+            # the Polly stream would go stale while it waits in the queue
+            track.prefetchable = False
+
+            # the synthesized file is pinned in the cache until FFmpeg has it open
+            pinned = None
+
+            async def synthesize(track_info: TrackInfo):
+                nonlocal pinned
+                speech = await self.service.synthesize_speech(
+                    id, message, lang_code, voice_id
+                )
+                track_info.download_url = speech.download_url
+                track_info.source = speech.source
+                if speech.source is None:
+                    pinned = speech.download_url
+
+            def release(track_info: TrackInfo):
+                nonlocal pinned
+                if pinned is not None:
+                    self.service.release(pinned)
+                    pinned = None
+
+            async def after_build(track_info: TrackInfo, player):
+                # FFmpeg has the file open now, it may be evicted from the cache
+                release(track_info)
+
+            def discard(track_info: TrackInfo):
+                # the track was cancelled or its player failed to build
+                release(track_info)
+                if track_info.source is not None:
+                    track_info.source.close()
+                    track_info.source = None
+
+            track.set_before_build(synthesize)
+            track.set_after_build(after_build)
+            track.set_on_discard(discard)
 
             if not self.bot.queue.has(id):
                 self.bot.runner.register(id)
@@ -16,7 +16,7 @@ async def reply_track_list(ctx: Context, tracks: List[Track]) -> discord.Message
     )
 
     fields = 1
-    for track in tracks:
+    for position, track in enumerate(tracks, start=1):
         i = track.current
         for info in track.get_remaining_tracks():
             i += 1
@@ -31,7 +31,7 @@ async def reply_track_list(ctx: Context, tracks: List[Track]) -> discord.Message
             else:
                 fields += 1
                 embed.add_field(
-                    name=f"Track ({i}/{track.max_len()}):",
+                    name=f"#{position} Track ({i}/{track.max_len()}):",
                     value=info.pretty_print(),
                     inline=False,
                 )
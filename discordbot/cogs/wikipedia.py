@@ -1,8 +1,8 @@
 import logging
 
-import wikipedia
 from cogs.text_to_speech import TextToSpeech
 from common.context import Context
+from common.mediawiki import DisambiguationError, MediaWikiClient, PageNotFoundError
 from discord.ext import commands
 
 
@@ -16,14 +16,18 @@ class Wikipedia(commands.Cog):
     def __init__(
         self,
         bot: commands.Bot,
+        client: MediaWikiClient,
         t2s: TextToSpeech = None,
         language="en",
         max_characters=2000,
+        max_speech_characters=6000,
     ):
         self.bot = bot
+        self.client = client
         self.log = logging.getLogger("cog")
         self.langugage = language
         self.max_characters = max_characters
+        self.max_speech_characters = max_speech_characters
         self.t2s = t2s
 
     @commands.Command
@@ -31,30 +35,37 @@ class Wikipedia(commands.Cog):
         """Let the bot explain a topic to you"""
 
         id = ctx.message.guild.id
-        lang = self.bot.config.get_config_for(id, "wikiLanguage", self.langugage)
-        wikipedia.set_lang(lang)
+        lang = await self.bot.config.get_config_for(id, "wikiLanguage", self.langugage)
 
-        self.log.info(f'Getting suggestion for "{query}" from Wikipedia')
+        self.log.info(f'Searching for "{query}" on Wikipedia')
         try:
-            suggestion = wikipedia.suggest(query)
-            if suggestion is None:
-                self.log.info("No good suggestion found. Using supplied query")
-                suggestion = query
+            title = await self.client.search(query, lang)
+            if title is None:
+                raise PageNotFoundError(query)
 
-            self.log.info(f'Getting summary of page "{suggestion}" from Wikipedia')
-            page = wikipedia.summary(suggestion)
+            self.log.info(f'Getting summary of page "{title}" from Wikipedia')
+            page = await self.client.summary(title, lang)
 
+            # the chat message is limited by discord, the speech is synthesized in chunks
             until_last_sentence = page[: self.max_characters].rfind(".")
             await ctx.send(f"{page[:until_last_sentence]}...")
 
             if self.t2s is not None:
-                await self.t2s.say(ctx, message=page[:until_last_sentence])
+                if ctx.voice_client is None:
+                    await self.bot.join_author(ctx)
+                spoken = page[: self.max_speech_characters]
+                if len(page) > self.max_speech_characters and "." in spoken:
+                    spoken = spoken[: spoken.rfind(".") + 1]
+                await self.t2s.speak(ctx, spoken)
             else:
                 raise WikipediaError("text_to_speech plugin is not configured")
 
-        except wikipedia.DisambiguationError as e:
+        except DisambiguationError as e:
             return await ctx.send(f"{query} may refer to {e.options}")
 
+        except PageNotFoundError:
+            return await ctx.reply_formatted_error(f'Found nothing about "{query}"')
+
         except WikipediaError as e:
             return await ctx.reply_formatted_error(e)
         except Exception as e:
@@ -1,5 +1,10 @@
+from .cache import *
 from .config import *
 from .config_store import *
 from .context import *
 from .ffmpeg import *
+from .latency import *
+from .mediawiki import *
+from .metrics import *
+from .single_flight import *
 from .utils import *
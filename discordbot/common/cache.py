@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """In-memory LRU cache whose entries expire after a time to live.
+    Expiry timestamps are wall-clock based so that the content can be persisted across restarts.
+    """
+
+    log = logging.getLogger("cache")
+    _entries: "OrderedDict[Hashable, Tuple[float, Any]]"
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600, filename: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[float, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def load(self):
+        """Restore the entries from filename, if configured. Expired entries are skipped."""
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, "r") as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.warn(f"failed to restore cache from {self.filename}: {e}")
+            return
+
+        now = time.time()
+        for key, expires_at, value in data:
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+        self.log.info(f"Restored {len(self._entries)} entries from {self.filename}")
+
+    def persist(self):
+        """Write the non-expired entries to filename, if configured. Keys must be JSON serializable."""
+        if self.filename is None:
+            return
+        now = time.time()
+        out = [
+            [key, expires_at, value]
+            for key, (expires_at, value) in self._entries.items()
+            if expires_at > now
+        ]
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(out, f)
+        os.replace(tmp, self.filename)
+        self.log.info(f"Persisted {len(out)} entries to {self.filename}")
@@ -1,11 +1,19 @@
+import asyncio
+import fcntl
 import json
 import logging
+import os
 import re
-from typing import Any, Dict, List
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+from .config_db import DEFAULT_CONFIGDB_NAME, ConfigDatabase
 
 DEFAULT_CONFIG = {"languageCode": "en-US", "voiceId": "Amy", "wikiLanguage": "en"}
 
 DEFAULT_CONFIGFILE_NAME = "discordbot_config.json"
+# configs that are kept in memory if they are stored in a database
+DEFAULT_CACHE_SIZE = 1024
 
 
 # See https://docs.aws.amazon.com/de_de/polly/latest/dg/voicelist.html
@@ -139,6 +147,11 @@ VALID_CONFIG_PARAM_KEYS = {
 }
 
 
+def overrides_of(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the values of config that differ from DEFAULT_CONFIG."""
+    return {key: val for key, val in config.items() if DEFAULT_CONFIG.get(key) != val}
+
+
 class ConfigError(Exception):
     pass
 
@@ -148,49 +161,95 @@ class ConfigValidationError(ConfigError):
 
 
 class ConfigMap:
-    def __init__(self, configs: List[Dict[str, Any]], configfile_name: str = None):
+    """The configs of the guilds. Only the values that differ from DEFAULT_CONFIG are stored.
+    With a database, configs are loaded on first access and at most maxsize of them are
+    kept in memory, the least recently used are evicted. Without one, all are in memory.
+    The configs are loaded on an executor, so the accessors are coroutines.
+    """
+
+    def __init__(
+        self,
+        configs: List[Dict[str, Any]],
+        configfile_name: str = None,
+        owns: Callable[[Any], bool] = None,
+        db: Optional[ConfigDatabase] = None,
+        maxsize: int = DEFAULT_CACHE_SIZE,
+    ):
         self.log = logging.getLogger("config")
-        self._configs = dict()
+        # guild id -> overrides, None if the guild has none
+        self._configs: "OrderedDict[Any, Optional[Dict[str, Any]]]" = OrderedDict()
         self.configfile_name = configfile_name or DEFAULT_CONFIGFILE_NAME
+        # the guilds whose config this process manages if it shares the file with others
+        self.owns = owns
+        # every change is written to the database in the background if set
+        self.db = db
+        self.maxsize = maxsize
 
         for cfg in configs:
-            id = cfg["id"]
-            del cfg["id"]
-            self._configs[id] = cfg
-
-        self.log.debug("Setting atexit persistance")
-
-    def exists(self, id: str):
-        return id in self._configs
-
-    def get_config_for(self, id: str, key: str = "", default: Any = None):
-        if self.exists(id):
-            return (
-                self._configs[id]
-                if key == ""
-                else self._configs[id][key]
-                if key in self._configs[id]
-                else default
-            )
+            id = cfg.pop("id")
+            self._configs[id] = overrides_of(cfg) or None
+
+    def _changed(self, id: str, overrides: Optional[Dict[str, Any]]):
+        if self.db is None:
+            return
+        if overrides is not None:
+            self.db.put(id, overrides)
+        else:
+            self.db.delete(id)
+
+    async def _overrides(self, id: str) -> Optional[Dict[str, Any]]:
+        if id in self._configs:
+            self._configs.move_to_end(id)
+            return self._configs[id]
+        if self.db is None:
+            return None
+
+        config = await asyncio.get_running_loop().run_in_executor(None, self.db.get, id)
+        if id in self._configs:
+            # changed or loaded by another command in the meantime
+            self._configs.move_to_end(id)
+            return self._configs[id]
+        return self._cache(id, overrides_of(config) if config is not None else None)
+
+    def _cache(self, id: str, overrides: Optional[Dict[str, Any]]):
+        self._configs[id] = overrides or None
+        self._configs.move_to_end(id)
+        # evicted configs can be loaded from the database again
+        if self.db is not None and len(self._configs) > self.maxsize:
+            self._configs.popitem(last=False)
+        return overrides or None
+
+    async def exists(self, id: str):
+        """Whether the config of id differs from the defaults."""
+        return await self._overrides(id) is not None
+
+    async def get_config_for(self, id: str, key: str = "", default: Any = None):
+        """Returns the value of key for id, the one of DEFAULT_CONFIG or else default.
+        Without a key, the whole config of id merged with the defaults is returned.
+        """
+        overrides = await self._overrides(id) or {}
+        if key == "":
+            return {**DEFAULT_CONFIG, **overrides}
+        return overrides.get(key, DEFAULT_CONFIG.get(key, default))
 
     def add_config_for(self, id: str, config: Dict[str, Any]):
         for key in config:
             self.is_valid_config_parameter(key, config[key])
-        self._configs[id] = config
+        self._changed(id, self._cache(id, overrides_of(config)))
 
-    def update_config_for(self, id: str, key: str, val: str):
-        if self.exists(id) and self.is_valid_config_parameter(key, val):
-            self._configs[id][key] = val
+    async def update_config_for(self, id: str, key: str, val: str):
+        if self.is_valid_config_parameter(key, val):
+            # the cached overrides are never changed in place
+            overrides = {**(await self._overrides(id) or {}), key: val}
+            self._changed(id, self._cache(id, overrides_of(overrides)))
 
-    def remove_config_for(self, id: str):
-        if self.exists(id):
-            del self._configs[id]
+    async def remove_config_for(self, id: str):
+        """Reset the config of id to the defaults."""
+        if await self.exists(id):
+            self._changed(id, self._cache(id, None))
 
-    def set_defaults_for(self, id: str):
-        if not self.exists(id):
-            self.log.info("Setting default config")
-            self.add_config_for(id, DEFAULT_CONFIG)
-        self.log.info(f"Config for {id} already exists. Cannot set defaults...")
+    def stats(self) -> Dict[str, int]:
+        return {"cached": len(self._configs), "maxsize": self.maxsize}
 
     def is_valid_config_parameter(self, key: str, val: str) -> bool:
         if not key in VALID_CONFIG_PARAM_KEYS.keys():
@@ -206,19 +265,66 @@ class ConfigMap:
         return True
 
     @classmethod
-    def from_file(cls, configfile_name: str = DEFAULT_CONFIGFILE_NAME):
+    def from_file(
+        cls,
+        configfile_name: str = DEFAULT_CONFIGFILE_NAME,
+        owns: Callable[[Any], bool] = None,
+    ):
         try:
             with open(configfile_name, "r") as f:
                 data = json.load(f)
-                return cls(data, configfile_name=configfile_name)
+                return cls(data, configfile_name=configfile_name, owns=owns)
         except IOError:
             logging.warn("failed to restore config from file")
-            return cls([], configfile_name=configfile_name)
+            return cls([], configfile_name=configfile_name, owns=owns)
+
+    @classmethod
+    def from_database(
+        cls,
+        filename: str = DEFAULT_CONFIGDB_NAME,
+        configfile_name: str = DEFAULT_CONFIGFILE_NAME,
+        owns: Callable[[Any], bool] = None,
+        maxsize: int = DEFAULT_CACHE_SIZE,
+    ):
+        """Use the database for the configs, they are loaded when they are accessed. On the first
+        start the configs of the JSON file are imported, afterwards the file is only written as
+        a snapshot of the database.
+        """
+        db = ConfigDatabase(filename, snapshot_file=configfile_name)
+        db.import_file(configfile_name, overrides_of)
+        return cls(
+            [], configfile_name=configfile_name, owns=owns, db=db, maxsize=maxsize
+        )
 
     def persist(self, *args):
+        """Write the config to the file. If owns is set, only the configs of the own
+        guilds are written and those of the other processes are kept.
+        With a database, the queued changes are written and the file is a snapshot of it.
+        """
+        if self.db is not None:
+            self.log.info(f"Persisting current config state to {self.db.filename}...")
+            self.db.close()
+            return
+
         self.log.info(f"Persisting current config state to {self.configfile_name}...")
-        with open(self.configfile_name, "w") as f:
+        with open(f"{self.configfile_name}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
             out = []
-            for id in self._configs:
-                out.append({**self._configs[id], "id": id})
-            json.dump(out, f)
+            if self.owns is not None:
+                try:
+                    with open(self.configfile_name, "r") as f:
+                        out = [cfg for cfg in json.load(f) if not self.owns(cfg["id"])]
+                except FileNotFoundError:
+                    pass
+                except (IOError, ValueError) as e:
+                    self.log.warn(f"failed to read the configs of other processes: {e}")
+
+            for id, overrides in self._configs.items():
+                if overrides is not None and (self.owns is None or self.owns(id)):
+                    out.append({**overrides, "id": id})
+
+            tmp = f"{self.configfile_name}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(out, f)
+            os.replace(tmp, self.configfile_name)
@@ -0,0 +1,242 @@
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+DEFAULT_CONFIGDB_NAME = "discordbot_config.db"
+# changes are collected this long and written in one transaction
+FLUSH_INTERVAL = 0.5
+# the WAL is checkpointed and a JSON snapshot is written this often
+COMPACT_INTERVAL = 300
+# other workers may hold the write lock of the database
+BUSY_TIMEOUT = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS configs (id PRIMARY KEY, config TEXT NOT NULL, updated REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+class ConfigDatabase:
+    """Stores the config of every guild as a row of a SQLite database in WAL mode.
+    Changes are queued by put and delete and written by a background thread, so the
+    caller never waits for the disk. Several changes of a guild before the next flush
+    are written once. Workers that share the database only ever write their own rows.
+    """
+
+    log = logging.getLogger("config")
+
+    def __init__(
+        self,
+        filename: str = DEFAULT_CONFIGDB_NAME,
+        snapshot_file: Optional[str] = None,
+        flush_interval: float = FLUSH_INTERVAL,
+        compact_interval: float = COMPACT_INTERVAL,
+    ):
+        self.filename = filename
+        self.snapshot_file = snapshot_file
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        # guild id -> serialized config, None if the config was removed
+        self._pending: Dict[Any, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flushed = threading.Condition(self._lock)
+        # the changes that are being written
+        self._writing: Dict[Any, Optional[str]] = {}
+        self._closed = False
+        # configs are read on the event loop, written by the writer thread
+        self._reader: Optional[sqlite3.Connection] = None
+        self._read_lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+        self._writer = threading.Thread(
+            target=self._run, name="config-writer", daemon=True
+        )
+        self._writer.start()
+
+    def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.filename, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread
+        )
+        # a commit in WAL mode is durable once the WAL is synced, the database is synced on checkpoints
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, id: Any) -> Optional[Dict[str, Any]]:
+        """Returns the config of id, including a change that is not written yet."""
+        with self._lock:
+            # the batch that is being written is only visible to readers once committed
+            for changes in (self._pending, self._writing):
+                if id in changes:
+                    value = changes[id]
+                    return json.loads(value) if value is not None else None
+        with self._read_lock:
+            if self._reader is None:
+                self._reader = self._connect(check_same_thread=False)
+            row = self._reader.execute(
+                "SELECT config FROM configs WHERE id = ?", (id,)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def import_file(
+        self,
+        configfile_name: str,
+        convert: Callable[[Dict[str, Any]], Dict[str, Any]] = None,
+    ) -> int:
+        """Copy the configs of a JSON file written by ConfigMap.persist into the database.
+        convert is applied to every config, empty results are skipped.
+        Only done once, later calls return 0. Returns the number of imported configs.
+        """
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            # other workers wait until the import is done
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+                conn.execute("ROLLBACK")
+                return 0
+            try:
+                with open(configfile_name, "r") as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = []
+            now = time.time()
+            rows = []
+            for cfg in data:
+                id = cfg.pop("id")
+                if convert is not None:
+                    cfg = convert(cfg)
+                if len(cfg) > 0:
+                    rows.append((id, json.dumps(cfg), now))
+            # rows that were written in the meantime are newer than the file
+            conn.executemany(
+                "INSERT OR IGNORE INTO configs (id, config, updated) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('imported', ?)",
+                (configfile_name,),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if len(rows) > 0:
+            self.log.info(f"Imported {len(rows)} configs from {configfile_name}")
+        return len(rows)
+
+    def put(self, id: Any, config: Dict[str, Any]):
+        value = json.dumps(config)
+        with self._lock:
+            self._pending[id] = value
+        self._wakeup.set()
+
+    def delete(self, id: Any):
+        with self._lock:
+            self._pending[id] = None
+        self._wakeup.set()
+
+    def _write(self, conn: sqlite3.Connection):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._writing = pending
+        try:
+            if len(pending) > 0:
+                now = time.time()
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO configs (id, config, updated) VALUES (?, ?, ?)",
+                        [(id, v, now) for id, v in pending.items() if v is not None],
+                    )
+                    conn.executemany(
+                        "DELETE FROM configs WHERE id = ?",
+                        [(id,) for id, v in pending.items() if v is None],
+                    )
+                self.log.debug(f"Wrote {len(pending)} configs")
+        except sqlite3.Error:
+            with self._lock:
+                # changes that were queued in the meantime are newer
+                self._pending = {**pending, **self._pending}
+            raise
+        finally:
+            with self._lock:
+                self._writing = {}
+                self._flushed.notify_all()
+
+    def compact(self, conn: sqlite3.Connection):
+        """Move the WAL into the database and write the snapshot."""
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if self.snapshot_file is not None:
+            self.snapshot(conn)
+
+    def snapshot(self, conn: sqlite3.Connection):
+        """Write all configs to the JSON file in the format of ConfigMap.persist.
+        The file is replaced atomically, readers see either the old or the new one.
+        """
+        rows = conn.execute("SELECT id, config FROM configs").fetchall()
+        with open(f"{self.snapshot_file}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            tmp = f"{self.snapshot_file}.tmp"
+            with open(tmp, "w") as f:
+                json.dump([{**json.loads(config), "id": id} for id, config in rows], f)
+            os.replace(tmp, self.snapshot_file)
+
+    def _run(self):
+        conn = self._connect()
+        compacted = time.monotonic()
+        try:
+            while not self._closed:
+                self._wakeup.wait(self.compact_interval)
+                self._wakeup.clear()
+                if not self._closed:
+                    # collect the changes that follow this one
+                    time.sleep(self.flush_interval)
+                try:
+                    self._write(conn)
+                    if time.monotonic() - compacted > self.compact_interval:
+                        compacted = time.monotonic()
+                        self.compact(conn)
+                except (sqlite3.Error, OSError) as e:
+                    self.log.warn(f"Failed to persist the configs: {e}")
+                    if self._closed:
+                        break
+                    time.sleep(self.flush_interval)
+                    self._wakeup.set()
+        finally:
+            conn.close()
+
+    def flush(self, timeout: float = BUSY_TIMEOUT) -> bool:
+        """Wait until all queued changes are written. Returns whether they were."""
+        self._wakeup.set()
+        with self._lock:
+            return self._flushed.wait_for(
+                lambda: len(self._pending) == 0 and len(self._writing) == 0, timeout
+            )
+
+    def close(self):
+        """Write the queued changes, checkpoint the WAL and write the snapshot."""
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join(BUSY_TIMEOUT)
+        conn = self._connect()
+        try:
+            self._write(conn)
+            self.compact(conn)
+        except (sqlite3.Error, OSError) as e:
+            self.log.warn(f"Failed to persist the configs on close: {e}")
+        finally:
+            conn.close()
+            with self._read_lock:
+                if self._reader is not None:
+                    self._reader.close()
+                    self._reader = None
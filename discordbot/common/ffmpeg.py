@@ -1,10 +1,22 @@
+import asyncio
+import logging
 import os
 import tarfile
+import time
+from dataclasses import dataclass
 from shutil import which
-from subprocess import PIPE, Popen
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 import requests
 
+DEFAULT_MAX_PROCESSES = 64
+# slots that only players which are about to play may use, not the prefetched ones
+DEFAULT_RESERVED = 2
+ACQUIRE_TIMEOUT = 10
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
 
 def is_ffmpeg_installed():
     return which("ffmpeg") is not None
@@ -30,6 +42,243 @@ def rm(path: str):
         pass
 
 
+def count_processes(name: str = "ffmpeg") -> int:
+    """Count the child processes of this process that run name. Only works where /proc exists."""
+    pid = str(os.getpid())
+    count = 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command may contain spaces and parentheses, it ends at the last ")"
+        comm = stat[stat.index("(") + 1 : stat.rindex(")")]
+        ppid = stat[stat.rindex(")") + 2 :].split()[1]
+        if comm == name and ppid == pid:
+            count += 1
+    return count
+
+
+def process_usage(pid: int) -> Optional[tuple]:
+    """Returns the CPU seconds and the resident memory in bytes of pid. Only works where /proc exists."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            stat = f.read()
+        with open(f"/proc/{pid}/statm", "r") as f:
+            statm = f.read()
+    except OSError:
+        return None
+    # utime and stime are the 14th and 15th field, the first two end at the last ")"
+    fields = stat[stat.rindex(")") + 2 :].split()
+    cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu, int(statm.split()[1]) * PAGE_SIZE
+
+
+def find_process(source: Any) -> Optional[Popen]:
+    """Returns the FFmpeg process of an audio source, unwrapping sources like PCMVolumeTransformer."""
+    while source is not None:
+        process = getattr(source, "_process", None)
+        if isinstance(process, Popen):
+            return process
+        source = getattr(source, "original", None) or getattr(source, "inner", None)
+    return None
+
+
+class FFmpegLimitError(Exception):
+    def __init__(self, msg, thrown=None):
+        super().__init__(msg)
+        self.thrown = thrown
+
+
+@dataclass
+class FFmpegProcess:
+    guild_id: int
+    process: Popen
+    started: float
+    prefetched: bool = False
+
+    def usage(self) -> Optional[tuple]:
+        return process_usage(self.process.pid)
+
+
+class FFmpegProcessManager:
+    """Limits the number of FFmpeg processes that the players of all guilds run at the same time
+    and keeps track of them, so that the ones of a guild can be reaped when it leaves.
+    Players are built through spawn, which waits for a free slot first.
+    """
+
+    log = logging.getLogger("ffmpeg")
+
+    def __init__(
+        self,
+        max_processes: int = DEFAULT_MAX_PROCESSES,
+        reserved: int = DEFAULT_RESERVED,
+        timeout: float = ACQUIRE_TIMEOUT,
+        executable: str = "ffmpeg",
+    ):
+        self.max_processes = max_processes
+        self.reserved = min(reserved, max_processes - 1)
+        self.timeout = timeout
+        self.executable = executable
+        self.processes: List[FFmpegProcess] = []
+        self._pending = 0
+        # set when a slot was freed, created on the event loop by spawn
+        self._freed: Optional[asyncio.Event] = None
+
+    def __len__(self):
+        return len(self.processes) + self._pending
+
+    def reap(self) -> int:
+        """Forget the processes that exited. Polling them also collects their exit status,
+        so none of them stays a zombie. Returns the number of running processes.
+        """
+        running = [p for p in self.processes if p.process.poll() is None]
+        if len(running) < len(self.processes):
+            self._notify_freed()
+        self.processes = running
+        return len(self.processes)
+
+    def _notify_freed(self):
+        if self._freed is not None:
+            self._freed.set()
+
+    def _watch(self, process: Popen):
+        """Reap the processes as soon as process exits, so that spawns waiting for
+        a slot do not depend on the next song to end. Needs pidfds (Linux 5.3+),
+        elsewhere the processes are only reaped when a player finishes.
+        """
+        try:
+            fd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):
+            return
+        loop = asyncio.get_running_loop()
+
+        def exited():
+            loop.remove_reader(fd)
+            os.close(fd)
+            self.reap()
+
+        loop.add_reader(fd, exited)
+
+    def reap_guild(self, guild_id: int) -> int:
+        """Kill the processes of guild_id, e. g. because its voice client disconnected.
+        Returns the number of killed processes.
+        """
+        killed = 0
+        for p in self.processes:
+            if p.guild_id == guild_id and p.process.poll() is None:
+                p.process.kill()
+                killed += 1
+        if killed > 0:
+            self.log.info(f"{guild_id}: Killed {killed} FFmpeg processes")
+        self.reap()
+        return killed
+
+    def _free(self, prefetch: bool) -> bool:
+        self.reap()
+        limit = self.max_processes - self.reserved if prefetch else self.max_processes
+        return len(self) < limit
+
+    async def spawn(
+        self,
+        guild_id: int,
+        build: Callable[[], Awaitable[Any]],
+        prefetch: bool = False,
+    ) -> Optional[Any]:
+        """Await build once a slot is free and register the FFmpeg process of the source it returns.
+        Prefetched players are not built if only the reserved slots are free, None is returned instead.
+        """
+        if not self._free(prefetch):
+            if prefetch:
+                self.log.debug(
+                    f"{guild_id}: Not prefetching a player, {len(self)} FFmpeg processes are running"
+                )
+                return None
+            self.log.warn(
+                f"{guild_id}: Waiting for one of {len(self)} FFmpeg processes to exit"
+            )
+            if self._freed is None:
+                self._freed = asyncio.Event()
+            deadline = time.monotonic() + self.timeout
+            while not self._free(prefetch):
+                remaining = deadline - time.monotonic()
+                self._freed.clear()
+                try:
+                    await asyncio.wait_for(self._freed.wait(), max(remaining, 0))
+                except asyncio.TimeoutError:
+                    raise FFmpegLimitError(
+                        "Too many songs are playing right now, try again later"
+                    )
+
+        self._pending += 1
+        try:
+            source = await build()
+        except BaseException:
+            self._notify_freed()
+            raise
+        finally:
+            self._pending -= 1
+
+        process = find_process(source)
+        if process is not None:
+            self.processes.append(
+                FFmpegProcess(guild_id, process, time.monotonic(), prefetch)
+            )
+            self._watch(process)
+        else:
+            self._notify_freed()
+        return source
+
+    def warm_up(self):
+        """Run FFmpeg and FFprobe once, so their binaries and libraries are in the page cache
+        before the first player is built. Blocks, run it in an executor.
+        """
+        for executable in (self.executable, "ffprobe"):
+            try:
+                Popen([executable, "-version"], stdout=DEVNULL, stderr=DEVNULL).wait()
+            except OSError as e:
+                self.log.warn(f"Failed to warm up {executable}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Reads /proc for every process, but does not change the state of the manager,
+        so it can be called from an executor.
+        """
+        running = [p for p in list(self.processes) if p.process.poll() is None]
+        cpu, rss = 0.0, 0
+        for p in running:
+            usage = p.usage()
+            if usage is not None:
+                cpu += usage[0]
+                rss += usage[1]
+        return {
+            "running": len(running),
+            "pending": self._pending,
+            "prefetched": sum(1 for p in running if p.prefetched),
+            "cpu_seconds": cpu,
+            "rss_bytes": rss,
+        }
+
+    def pretty_print(self) -> List[str]:
+        """One line per running process with its guild, age, CPU time and memory."""
+        self.reap()
+        now = time.monotonic()
+        lines = []
+        for p in self.processes:
+            usage = p.usage() or (0.0, 0)
+            lines.append(
+                f"pid {p.process.pid} guild {p.guild_id}: {now - p.started:.0f}s, cpu {usage[0]:.1f}s, rss {usage[1] / 2**20:.1f}MB"
+                + (" (prefetched)" if p.prefetched else "")
+            )
+        return lines
+
+
 def get_installed_version() -> str:
     proc = Popen("ffmpeg", stdout=PIPE, stderr=PIPE)
     # Only need first 20 bytes to get version
@@ -46,6 +295,8 @@ def install(version: str, force=False):
     FFMPEG_LOCAL_PATH = f"{LOCAL_PATH}/ffmpeg-{version}-amd64-static"
     FFMPEG_LOCAL_BIN_PATH = f"{FFMPEG_LOCAL_PATH}/ffmpeg"
     FFMPEG_BIN_PATH = "/usr/bin/ffmpeg"
+    FFPROBE_LOCAL_BIN_PATH = f"{FFMPEG_LOCAL_PATH}/ffprobe"
+    FFPROBE_BIN_PATH = "/usr/bin/ffprobe"
 
     installed_version = None
     if is_ffmpeg_installed():
@@ -53,6 +304,11 @@ def install(version: str, force=False):
 
     if not force and installed_version == version:
         print(f"Version {version} is already installed. Use force=true to overwrite...")
+        # installs from before ffprobe was linked
+        if not os.path.exists(FFPROBE_BIN_PATH) and os.path.exists(
+            FFPROBE_LOCAL_BIN_PATH
+        ):
+            create_link(FFPROBE_LOCAL_BIN_PATH, FFPROBE_BIN_PATH)
         return False
 
     response = requests.get(FFMPEG_DOWNLOAD_URL)
@@ -74,6 +330,8 @@ def install(version: str, force=False):
     tar.close()
 
     create_link(FFMPEG_LOCAL_BIN_PATH, FFMPEG_BIN_PATH)
+    # ffprobe is used to detect whether a source can be passed through as opus
+    create_link(FFPROBE_LOCAL_BIN_PATH, FFPROBE_BIN_PATH)
 
     rm(FFMPEG_TAR_PATH)
     return is_ffmpeg_installed()
@@ -0,0 +1,37 @@
+from collections import deque
+from typing import Deque, Dict
+
+
+class LatencyStats:
+    """Keeps the latencies of the most recent operations and counts all of them."""
+
+    def __init__(self, window: int = 256):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float, failed: bool = False):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if failed:
+            self.failures += 1
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "avg": self.total / self.count if self.count > 0 else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
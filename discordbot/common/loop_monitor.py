@@ -0,0 +1,143 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from asyncio import AbstractEventLoop, TimerHandle
+from collections import deque
+from dataclasses import dataclass, field
+from types import FrameType
+from typing import Deque, List, Optional
+
+from discord.ext import commands
+
+from .latency import LatencyStats
+
+DEFAULT_BLOCK_THRESHOLD = 0.1
+HEARTBEAT_INTERVAL = 0.05
+MAX_REPORTS = 50
+
+# frames of this project are used to attribute a blocking call
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclass
+class BlockingReport:
+    started_at: float
+    duration: float
+    command: Optional[str]
+    location: Optional[str]
+    stack: List[str] = field(default_factory=list)
+
+    def pretty_print(self) -> str:
+        command = self.command or "no command"
+        return (
+            f"{self.duration * 1000:.0f}ms in {self.location or 'unknown'} ({command})"
+        )
+
+
+def _attribute(frame: Optional[FrameType]):
+    """Returns the command and the innermost function of this project on the stack of frame."""
+    command = None
+    location = None
+    while frame is not None:
+        code = frame.f_code
+        if location is None and code.co_filename.startswith(PROJECT_ROOT):
+            module = os.path.relpath(code.co_filename, PROJECT_ROOT)
+            location = f"{module}:{code.co_name}:{frame.f_lineno}"
+        if command is None:
+            ctx = frame.f_locals.get("ctx")
+            if isinstance(ctx, commands.Context) and ctx.command is not None:
+                guild = ctx.guild.id if ctx.guild is not None else "dm"
+                command = f"{ctx.prefix or ''}{ctx.command.qualified_name} in {guild}"
+        if command is not None and location is not None:
+            break
+        frame = frame.f_back
+    return command, location
+
+
+class LoopMonitor:
+    """Measures the lag of the event loop and detects callbacks that block it.
+    A heartbeat is scheduled on the loop while a watchdog thread checks that it keeps
+    beating. If the loop is blocked longer than threshold, the watchdog captures the
+    stack of the loop thread and attributes it to the running command and function.
+    """
+
+    log = logging.getLogger("loop_monitor")
+    reports: Deque[BlockingReport]
+
+    def __init__(
+        self,
+        loop: AbstractEventLoop,
+        threshold: float = DEFAULT_BLOCK_THRESHOLD,
+        interval: float = HEARTBEAT_INTERVAL,
+        max_reports: int = MAX_REPORTS,
+    ):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.reports = deque(maxlen=max_reports)
+        self.lag = LatencyStats()
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._handle: Optional[TimerHandle] = None
+        self._current: Optional[BlockingReport] = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start monitoring. Must be called from the thread that runs the loop."""
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._handle = self.loop.call_later(self.interval, self._heartbeat)
+        threading.Thread(target=self._watch, name="loop-monitor", daemon=True).start()
+        self.log.info(
+            f"Monitoring the event loop with a threshold of {self.threshold}s"
+        )
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        lag = max(now - self._beat - self.interval, 0)
+        self.lag.record(lag)
+        with self._lock:
+            self._beat = now
+            report, self._current = self._current, None
+        if report is not None:
+            report.duration = lag
+            self.log.warn(
+                f"Event loop was blocked for {report.pretty_print()}:\n"
+                + "".join(report.stack)
+            )
+        if not self._stopped.is_set():
+            self._handle = self.loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval / 2):
+            with self._lock:
+                blocked_for = time.monotonic() - self._beat - self.interval
+                if blocked_for < self.threshold or self._current is not None:
+                    continue
+
+                frame = sys._current_frames().get(self._loop_thread)
+                command, location = _attribute(frame)
+                self._current = BlockingReport(
+                    time.time() - blocked_for,
+                    blocked_for,
+                    command,
+                    location,
+                    traceback.format_stack(frame) if frame is not None else [],
+                )
+                self.reports.append(self._current)
+
+    def stats(self):
+        return {
+            "threshold": self.threshold,
+            "lag": self.lag.stats(),
+            "blocked": len(self.reports),
+        }
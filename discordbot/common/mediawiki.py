@@ -0,0 +1,157 @@
+import logging
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from .cache import TTLCache
+from .metrics import external_request
+from .single_flight import SingleFlight
+
+API_URL = "https://{lang}.wikipedia.org/w/api.php"
+USER_AGENT = "discordbot (https://github.com/ron96G/discordbot)"
+DEFAULT_TIMEOUT = 10
+
+_MISSING = object()
+
+
+class MediaWikiError(Exception):
+    def __init__(self, msg, thrown=None):
+        super().__init__(msg)
+        self.thrown = thrown
+
+
+class PageNotFoundError(MediaWikiError):
+    def __init__(self, title: str):
+        super().__init__(f'page "{title}" does not exist')
+        self.title = title
+
+
+class DisambiguationError(MediaWikiError):
+    def __init__(self, title: str, options: List[str]):
+        super().__init__(f'"{title}" may refer to {options}')
+        self.title = title
+        self.options = options
+
+
+class MediaWikiClient:
+    """Async client of the MediaWiki API of Wikipedia.
+    The language is chosen per request. Results are cached by (lang, query)
+    and concurrent identical requests only make one HTTP call.
+    """
+
+    log = logging.getLogger("mediawiki")
+
+    def __init__(
+        self,
+        cache: TTLCache = None,
+        session: aiohttp.ClientSession = None,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.cache = cache if cache is not None else TTLCache(maxsize=512, ttl=3600)
+        self.timeout = timeout
+        self.flight = SingleFlight()
+        self._session = session
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # the session must be created inside the running loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={"User-Agent": USER_AGENT},
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def _query(self, lang: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        params = {"action": "query", "format": "json", "formatversion": 2, **params}
+        try:
+            with external_request("wikipedia"):
+                async with self._get_session().get(
+                    API_URL.format(lang=lang), params=params
+                ) as resp:
+                    resp.raise_for_status()
+                    data = await resp.json()
+        except aiohttp.ClientError as e:
+            raise MediaWikiError(f"request to wikipedia failed: {e}", e)
+
+        if "error" in data:
+            raise MediaWikiError(f'wikipedia returned an error: {data["error"]}')
+        return data
+
+    async def _cached(self, key, func):
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        async def fetch():
+            value = await func()
+            self.cache.set(key, value)
+            return value
+
+        return await self.flight.do(key, fetch)
+
+    async def search(self, query: str, lang: str = "en") -> Optional[str]:
+        """Returns the title of the page for query like the auto-suggest of the search:
+        the spelling suggestion if there is one, otherwise the top result.
+        None if the search found nothing.
+        """
+
+        async def fetch():
+            data = await self._query(
+                lang,
+                {
+                    "list": "search",
+                    "srsearch": query,
+                    "srinfo": "suggestion",
+                    "srprop": "",
+                    "srlimit": 1,
+                },
+            )
+            suggestion = data["query"].get("searchinfo", {}).get("suggestion")
+            if suggestion is not None:
+                return suggestion
+            results = data["query"].get("search", [])
+            return results[0]["title"] if results else None
+
+        return await self._cached(("search", lang, query), fetch)
+
+    async def summary(self, title: str, lang: str = "en") -> str:
+        """Returns the plain text introduction of the page title."""
+
+        async def fetch():
+            data = await self._query(
+                lang,
+                {
+                    "prop": "extracts|pageprops",
+                    "exintro": 1,
+                    "explaintext": 1,
+                    "ppprop": "disambiguation",
+                    "redirects": 1,
+                    "titles": title,
+                },
+            )
+            pages = data["query"].get("pages", [])
+            if not pages or pages[0].get("missing") or pages[0].get("invalid"):
+                raise PageNotFoundError(title)
+
+            page = pages[0]
+            if "disambiguation" in page.get("pageprops", {}):
+                raise DisambiguationError(
+                    page["title"], await self._links(lang, page["title"])
+                )
+            return page.get("extract", "")
+
+        return await self._cached(("summary", lang, title), fetch)
+
+    async def _links(self, lang: str, title: str) -> List[str]:
+        data = await self._query(
+            lang,
+            {"prop": "links", "titles": title, "plnamespace": 0, "pllimit": "max"},
+        )
+        pages = data["query"].get("pages", [])
+        if not pages:
+            return []
+        return [link["title"] for link in pages[0].get("links", [])]
@@ -0,0 +1,316 @@
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LOOP_LAG_INTERVAL = 0.5
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence) -> Labels:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}")
+        return tuple(str(label) for label in labels)
+
+    def samples(self) -> Iterator[Tuple[str, Labels, Optional[str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labels, labels, extra)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield "", labels, None, value
+
+
+class Gauge(Metric):
+    """Gauge that is either set explicitly or read from callback when it is scraped.
+    The callback returns the values by their label values.
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        callback: Callable[[], Dict[Labels, float]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self.callback = callback
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.callback is not None:
+            values = list(self.callback().items())
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for labels, value in values:
+            yield "", tuple(str(label) for label in labels), None, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * len(self.buckets), [0.0])
+            )
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._values.items()
+            ]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", labels, f'le="{_format_value(bound)}"', cumulative
+            yield "_sum", labels, None, total
+            yield "_count", labels, None, cumulative
+
+
+class Registry:
+    """The metrics of the process. It is rendered on an executor, so the callbacks of
+    gauges must be safe to call from another thread.
+    """
+
+    _metrics: Dict[str, Metric]
+
+    def __init__(self):
+        self._metrics = {}
+        self._render_lock = threading.Lock()
+        self._scrape = 0
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            # modules may be imported more than once, e. g. when cogs are reloaded
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        callback: Callable[[], Dict[Labels, float]] = None,
+    ) -> Gauge:
+        return self._register(Gauge(name, help, labels, callback))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def once_per_scrape(self, func: Callable[[], Any]) -> Callable[[], Any]:
+        """Wraps func so that the callbacks of several gauges share one call per render."""
+        last = [None, None]
+
+        def wrapper():
+            if last[0] != self._scrape:
+                last[1] = func()
+                last[0] = self._scrape
+            return last[1]
+
+        return wrapper
+
+    def render(self) -> str:
+        with self._render_lock:
+            self._scrape += 1
+            lines = []
+            for metric in list(self._metrics.values()):
+                try:
+                    lines.extend(metric.render())
+                except Exception as e:
+                    logging.getLogger("metrics").warn(
+                        f"failed to render {metric.name}: {e}"
+                    )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+EXTERNAL_REQUEST_SECONDS = REGISTRY.histogram(
+    "discordbot_external_request_seconds",
+    "Latency of requests to external services",
+    ["service"],
+)
+EXTERNAL_REQUEST_ERRORS = REGISTRY.counter(
+    "discordbot_external_request_errors_total",
+    "Failed requests to external services",
+    ["service"],
+)
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "discordbot_event_loop_lag_seconds",
+    "Delay of the event loop when waking up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+class StageTimer:
+    """Observes the time between consecutive marks as the duration of the named stage."""
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self._last = time.monotonic()
+
+    def mark(self, stage: str):
+        now = time.monotonic()
+        self.histogram.observe(now - self._last, stage)
+        self._last = now
+
+
+@contextmanager
+def external_request(service: str):
+    """Measure a request to an external service. Works in threads and around awaits."""
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_REQUEST_ERRORS.inc(service)
+        raise
+    finally:
+        EXTERNAL_REQUEST_SECONDS.observe(time.monotonic() - start, service)
+
+
+class MetricsServer:
+    """Serves the metrics of a registry in the Prometheus text format on /metrics."""
+
+    log = logging.getLogger("metrics")
+
+    def __init__(
+        self, port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY
+    ):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        # the callbacks of the gauges may read /proc
+        text = await asyncio.get_running_loop().run_in_executor(
+            None, self.registry.render
+        )
+        return web.Response(
+            text=text,
+            content_type="text/plain",
+            headers={"X-Content-Type-Options": "nosniff"},
+        )
+
+    async def _measure_loop_lag(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            LOOP_LAG_SECONDS.observe(
+                max(time.monotonic() - start - LOOP_LAG_INTERVAL, 0)
+            )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._lag_task = asyncio.ensure_future(self._measure_loop_lag())
+        self.log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Dict, List, Optional
+
+GATEWAY_URL = "https://discord.com/api/v10/gateway/bot"
+# Discord allows one identify per 5 seconds unless the bot has a higher max_concurrency
+DEFAULT_START_DELAY = 5
+MAX_RESTART_DELAY = 60
+# a worker that ran this long before exiting is restarted without backoff
+STABLE_AFTER = 300
+STOP_TIMEOUT = 30
+# set by the supervisor for every worker
+WORKER_ENV_KEYS = [
+    "SHARD_WORKER",
+    "SHARD_IDS",
+    "SHARD_COUNT",
+    "METRICS_PORT",
+    "URL_CACHE_FILE",
+    "AUDIO_CACHE_DIR",
+    "AUDIO_CACHE_MAX_BYTES",
+]
+
+
+def shard_of(guild_id, shard_count: int) -> int:
+    """Returns the shard that receives the events of guild_id, see https://discord.com/developers/docs/topics/gateway#sharding"""
+    return (int(guild_id) >> 22) % shard_count
+
+
+def assign_shards(shard_count: int, workers: int) -> List[List[int]]:
+    """Distributes the shards round-robin between the workers."""
+    return [list(range(worker, shard_count, workers)) for worker in range(workers)]
+
+
+def parse_shard_ids(value: str) -> List[int]:
+    return [int(id) for id in value.split(",") if id.strip() != ""]
+
+
+def worker_overrides(env: Dict[str, str]) -> Dict[str, str]:
+    """Returns the values the supervisor set for this worker, they take precedence over the config."""
+    if "SHARD_WORKER" not in env:
+        return {}
+    return {key: env[key] for key in WORKER_ENV_KEYS if key in env}
+
+
+def recommended_shard_count(token: str, timeout: float = 10) -> Optional[int]:
+    """Asks Discord how many shards the bot should use."""
+    req = urllib.request.Request(
+        GATEWAY_URL,
+        headers={"Authorization": f"Bot {token}", "User-Agent": "discordbot"},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return int(json.load(resp)["shards"])
+    except Exception as e:
+        logging.getLogger("supervisor").warn(
+            f"Failed to get the recommended shard count: {e}"
+        )
+        return None
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: List[int], env: Dict[str, str]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = env
+        self.process: Optional[subprocess.Popen] = None
+        self.started = 0.0
+        self.restarts = 0
+        self.restart_at: Optional[float] = None
+
+
+class ShardSupervisor:
+    """Runs the bot in one worker process per group of shards and restarts workers that exit.
+    Every worker is the bot with its own queues and players, it only connects the shards
+    given by the environment variables SHARD_IDS and SHARD_COUNT.
+    """
+
+    log = logging.getLogger("supervisor")
+
+    def __init__(
+        self,
+        workers: int,
+        shard_count: int,
+        command: List[str] = None,
+        env: Dict[str, str] = None,
+        start_delay: float = DEFAULT_START_DELAY,
+    ):
+        if shard_count < workers:
+            raise ValueError(f"{workers} workers need at least {workers} shards")
+        self.shard_count = shard_count
+        self.command = command or [sys.executable, os.path.abspath(sys.argv[0])]
+        self.start_delay = start_delay
+        self.stopping = False
+
+        env = env if env is not None else dict(os.environ)
+        self.workers = [
+            Worker(index, shard_ids, self.worker_env(env, index, workers, shard_ids))
+            for index, shard_ids in enumerate(assign_shards(shard_count, workers))
+        ]
+
+    def worker_env(
+        self, env: Dict[str, str], index: int, workers: int, shard_ids: List[int]
+    ) -> Dict[str, str]:
+        """Returns the environment of a worker. Resources that cannot be shared between
+        processes, like ports and caches that keep an index, are split between the workers.
+        """
+        env = {
+            **env,
+            "SHARD_WORKER": str(index),
+            "SHARD_IDS": ",".join(str(id) for id in shard_ids),
+            "SHARD_COUNT": str(self.shard_count),
+        }
+        if env.get("METRICS_PORT"):
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + index)
+        if env.get("URL_CACHE_FILE"):
+            env["URL_CACHE_FILE"] = f'{env["URL_CACHE_FILE"]}.{index}'
+        if env.get("AUDIO_CACHE_DIR"):
+            env["AUDIO_CACHE_DIR"] = os.path.join(
+                env["AUDIO_CACHE_DIR"], f"worker-{index}"
+            )
+            if env.get("AUDIO_CACHE_MAX_BYTES"):
+                env["AUDIO_CACHE_MAX_BYTES"] = str(
+                    int(env["AUDIO_CACHE_MAX_BYTES"]) // workers
+                )
+        return env
+
+    def start(self, worker: Worker):
+        self.log.info(f"Starting worker {worker.index} with shards {worker.shard_ids}")
+        worker.process = subprocess.Popen(self.command, env=worker.env)
+        worker.started = time.monotonic()
+        worker.restart_at = None
+
+    def stop(self, *_):
+        """Terminate all workers. Called on SIGINT and SIGTERM."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.log.info("Stopping all workers")
+        for worker in self.workers:
+            if worker.process is not None and worker.process.poll() is None:
+                worker.process.terminate()
+
+    def check(self, worker: Worker):
+        """Schedule the restart of worker if it exited. Crash loops are backed off."""
+        if worker.process is None or worker.process.poll() is None:
+            return
+
+        if worker.restart_at is None:
+            runtime = time.monotonic() - worker.started
+            if runtime > STABLE_AFTER:
+                worker.restarts = 0
+            delay = min(2**worker.restarts, MAX_RESTART_DELAY)
+            worker.restarts += 1
+            worker.restart_at = time.monotonic() + delay
+            self.log.warn(
+                f"Worker {worker.index} exited with {worker.process.returncode} after {runtime:.0f}s. Restarting in {delay}s"
+            )
+        elif time.monotonic() >= worker.restart_at:
+            self.start(worker)
+
+    def run(self) -> int:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for position, worker in enumerate(self.workers):
+            if self.stopping:
+                break
+            if position > 0:
+                # the shards of a worker identify one after another as well
+                time.sleep(self.start_delay * len(self.workers[position - 1].shard_ids))
+            self.start(worker)
+
+        while not self.stopping:
+            for worker in self.workers:
+                self.check(worker)
+            time.sleep(1)
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            try:
+                worker.process.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                self.log.warn(f"Killing worker {worker.index}")
+                worker.process.kill()
+                worker.process.wait()
+        return 0
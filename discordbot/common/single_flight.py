@@ -0,0 +1,75 @@
+import copy
+import logging
+from asyncio import CancelledError, Future, ensure_future, shield
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key.
+    Callers that arrive while a call is in flight await its result instead of starting their own.
+    Cancelling one caller does not cancel the call for the others,
+    the call is only cancelled once all of its callers were.
+    """
+
+    log = logging.getLogger("single_flight")
+    _calls: Dict[Hashable, Future]
+    _waiters: Dict[Hashable, int]
+
+    def __init__(self):
+        self._calls = {}
+        self._waiters = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _done(self, key: Hashable, future: Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # mark the exception as retrieved in case every caller was cancelled
+            future.exception()
+
+    async def do(
+        self, key: Hashable, func: Callable[[], Awaitable[T]], copy_result=False
+    ) -> T:
+        """Returns the result of func(). func is only called if no call for key is in flight.
+        If copy_result is set, callers that joined a call get a deep copy of the result
+        so that they cannot modify each other's objects.
+        """
+        future = self._calls.get(key)
+        joined = future is not None
+        if not joined:
+            self.calls += 1
+            future = self._calls[key] = ensure_future(func())
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.shared += 1
+            self.log.debug(f"Joining call in flight for {key}")
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            result = await shield(future)
+        except CancelledError:
+            if self._waiters[key] == 1 and not future.done():
+                # nobody is waiting for the call anymore
+                self.log.debug(f"Cancelling call in flight for {key}")
+                if self._calls.get(key) is future:
+                    del self._calls[key]
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] == 0:
+                del self._waiters[key]
+        return copy.deepcopy(result) if copy_result and joined else result
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "shared": self.shared,
+        }
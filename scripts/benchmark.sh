@@ -0,0 +1,5 @@
+#!/usr/bin/env bash
+
+set -e
+
+poetry run python benchmarks/run.py "$@"
\ No newline at end of file
@@ -1,5 +1,5 @@
 #!/usr/bin/env bash
 set -e
 
-poetry run black discordbot
-poetry run isort --profile black discordbot
\ No newline at end of file
+poetry run black discordbot benchmarks
+poetry run isort --profile black discordbot benchmarks
\ No newline at end of file
@@ -2,5 +2,5 @@
 
 set -e
 
-poetry run black --check discordbot
-poetry run isort --profile black --check-only discordbot
\ No newline at end of file
+poetry run black --check discordbot benchmarks
+poetry run isort --profile black --check-only discordbot benchmarks
\ No newline at end of file